@@ -1,11 +1,14 @@
 #-*- coding: utf-8 -*-
 
 from findig.json import App
-from findig.extras.redis import RedisSet
+from findig.extras.redis import RedisPool, RedisSet
 from werkzeug.serving import run_simple
 
 app = App(indent=2)
 
+# Every request shares this pool's connections
+RedisPool(app=app, max_connections=20)
+
 ITEMS = {} # Fake data store
 
 @app.route("/items/<int:id>")
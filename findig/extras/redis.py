@@ -1,28 +1,393 @@
 from ast import literal_eval
+from collections import Counter as PyCounter
 from collections.abc import Callable, Mapping
 from contextlib import contextmanager
-from time import time
+from datetime import datetime
+from threading import Lock
+from time import monotonic, time
+import json
+import math
+import pickle
+import random
 
 import redis
+from redis.client import Script
 
 from findig.context import ctx
 from findig.resource import AbstractResource
-from findig.tools.dataset import MutableDataSet, MutableRecord, FilteredDataSet
+from findig.tools.asyncdataset import AsyncMutableDataSetAdapter
+from findig.tools.counter import (AbstractLog, Hit, HyperLogLog,
+                                  _counter_keys, _seconds)
+from findig.tools.dataset import (MutableDataSet, MutableRecord,
+                                  FilteredDataSet, RecordSchema, Comparison,
+                                  And, Or, Not)
+from findig.tools.ratelimit import AbstractRateStore
+
+
+# Converts an encoded field value to a number, or nil if it isn't one.
+# Booleans are numbers too, as they are in Python. The functions below
+# that compare or index numbers need this one.
+_NUMBER_LUA = """
+local function number(value)
+    if value == 'True' or value == 'true' then
+        return 1
+    elseif value == 'False' or value == 'false' then
+        return 0
+    end
+    return tonumber(value)
+end
+"""
+
+# Checks whether an item matches a filter, which is a postfix program
+# whose instructions are:
+#
+#   eq FIELD VALUE           the encoded field is VALUE
+#   in FIELD N VALUE...      the encoded field is one of N values
+#   num OP FIELD NUMBER D    the field compares (by OP) with NUMBER; a
+#                            field that isn't numeric gives D ('1'/'0')
+#   id VALUE                 the item's id is VALUE
+#   const B                  B ('1' or '0')
+#   and N, or N              combine the top N results
+#   not                      negate the top result
+#
+# The program is read from ARGV, starting at i.
+_MATCH_LUA = """
+local function compare(op, x, y)
+    if op == 'eq' then return x == y
+    elseif op == 'lt' then return x < y
+    elseif op == 'le' then return x <= y
+    elseif op == 'gt' then return x > y
+    else return x >= y end
+end
+
+local function matches(key, id, i)
+    local stack = {}
+    while i <= #ARGV do
+        local op = ARGV[i]
+        if op == 'eq' then
+            stack[#stack + 1] = redis.call('HGET', key, ARGV[i + 1]) == ARGV[i + 2]
+            i = i + 3
+        elseif op == 'in' then
+            local value = redis.call('HGET', key, ARGV[i + 1])
+            local n = tonumber(ARGV[i + 2])
+            local found = false
+            for j = i + 3, i + 2 + n do
+                if value == ARGV[j] then
+                    found = true
+                    break
+                end
+            end
+            stack[#stack + 1] = found
+            i = i + 3 + n
+        elseif op == 'num' then
+            local value = redis.call('HGET', key, ARGV[i + 2])
+            local result = false
+            if value then
+                local x = number(value)
+                if x == nil then
+                    result = ARGV[i + 4] == '1'
+                else
+                    result = compare(ARGV[i + 1], x, tonumber(ARGV[i + 3]))
+                end
+            end
+            stack[#stack + 1] = result
+            i = i + 5
+        elseif op == 'id' then
+            stack[#stack + 1] = id == ARGV[i + 1]
+            i = i + 2
+        elseif op == 'const' then
+            stack[#stack + 1] = ARGV[i + 1] == '1'
+            i = i + 2
+        elseif op == 'not' then
+            stack[#stack] = not stack[#stack]
+            i = i + 1
+        else
+            local result = op == 'and'
+            for _ = 1, tonumber(ARGV[i + 1]) do
+                local top = table.remove(stack)
+                if op == 'and' then
+                    result = result and top
+                else
+                    result = result or top
+                end
+            end
+            stack[#stack + 1] = result
+            i = i + 2
+        end
+    end
+    return stack[1] ~= false
+end
+"""
+
+# Scans a window of the collection and returns the items that match the
+# filter, along with their data, so that non-matching items never leave
+# the server.
+#
+# KEYS[1]: the collection key
+# ARGV[1]: the prefix for item keys
+# ARGV[2], ARGV[3]: the start and stop ranks of the window
+# ARGV[4...]: the filter program
+_FILTER_SCRIPT = Script(None, (_NUMBER_LUA + _MATCH_LUA + """
+local ids = redis.call('ZRANGE', KEYS[1], ARGV[2], ARGV[3])
+local result = {#ids}
+for _, id in ipairs(ids) do
+    local key = ARGV[1] .. id
+    if matches(key, id, 4) then
+        local data = redis.call('HGETALL', key)
+        if #data > 0 then
+            result[#result + 1] = {id, data}
+        end
+    end
+end
+return result
+""").encode('utf8'))
+
+# Lua numbers are doubles, so larger integers can't be compared exactly
+# on the server.
+_MAX_EXACT_INT = 2**53
+
+# The write scripts share these functions, which keep an item's index
+# entries up to date on the server.
+#
+# An item's index specification is read from ARGV, starting at i: the
+# item's id, the prefix and suffix that encode an id like a field
+# value, the number of candidate keys, and for each, its number of
+# fields followed by their (sorted) names; then the name of the field
+# for each numeric index in KEYS[4...].
+#
+# KEYS[2]: the collection key
+# KEYS[3]: the index key
+# KEYS[4...]: the numeric index keys
+_INDEX_LUA = """
+local function read_spec(i)
+    local spec = {id = ARGV[i], prefix = ARGV[i + 1], suffix = ARGV[i + 2],
+                  keys = {}, numeric = {}}
+    local n = tonumber(ARGV[i + 3])
+    i = i + 4
+    for k = 1, n do
+        local count = tonumber(ARGV[i])
+        local fields = {}
+        for j = 1, count do
+            fields[j] = ARGV[i + j]
+        end
+        spec.keys[k] = fields
+        i = i + count + 1
+    end
+    for k = 4, #KEYS do
+        spec.numeric[k - 3] = ARGV[i]
+        i = i + 1
+    end
+    return spec, i
+end
+
+-- Add ('ZADD') or remove ('ZREM') an item's index entries; lookup
+-- returns the encoded value of one of its fields.
+local function update_index(command, spec, lookup)
+    local idvalue = spec.prefix .. spec.id .. spec.suffix
+    for _, fields in ipairs(spec.keys) do
+        local parts = {}
+        for j, field in ipairs(fields) do
+            local value = idvalue
+            if field ~= 'id' then
+                value = lookup(field)
+            end
+            if not value then
+                parts = nil
+                break
+            end
+            parts[j] = field .. '=' .. value
+        end
+        if parts then
+            local entry = table.concat(parts, '\\31') .. '\\0' .. spec.id
+            if command == 'ZADD' then
+                redis.call('ZADD', KEYS[3], 0, entry)
+            else
+                redis.call('ZREM', KEYS[3], entry)
+            end
+        end
+    end
+    for k, field in ipairs(spec.numeric) do
+        if command == 'ZADD' then
+            local score = number(lookup(field) or '')
+            if score and score == score then
+                redis.call('ZADD', KEYS[3 + k], score, spec.id)
+            end
+        else
+            redis.call('ZREM', KEYS[3 + k], spec.id)
+        end
+    end
+end
+"""
+
+# Adds an item to a collection, and returns its id.
+#
+# KEYS[1]: the id counter
+# ARGV: the index specification (with an empty id if one should be
+#       generated); the number N of indexed fields and N pairs of
+#       field names and encoded values; the prefix for item keys; the
+#       item's score in the collection; then 'hash' followed by pairs of
+#       field names and values, or 'string' followed by a value
+_ADD_SCRIPT = Script(None, (_NUMBER_LUA + _INDEX_LUA + """
+local spec, i = read_spec(1)
+if spec.id == '' then
+    spec.id = tostring(redis.call('INCR', KEYS[1]))
+end
+
+local values = {}
+local n = tonumber(ARGV[i])
+for j = i + 1, i + 2 * n, 2 do
+    values[ARGV[j]] = ARGV[j + 1]
+end
+i = i + 2 * n + 1
+
+local key = ARGV[i] .. spec.id
+update_index('ZADD', spec, function(field) return values[field] end)
+redis.call('ZADD', KEYS[2], ARGV[i + 1], spec.id)
+if ARGV[i + 2] == 'string' then
+    redis.call('SET', key, ARGV[i + 3])
+else
+    for j = i + 3, #ARGV, 2 do
+        redis.call('HSET', key, ARGV[j], ARGV[j + 1])
+    end
+end
+return spec.id
+""").encode('utf8'))
+
+# Patches an item stored in a hash, and returns its new contents.
+#
+# KEYS[1]: the item key (followed by the collection's keys, if it has
+#          one)
+# ARGV: the index specification; '1' if the item's data should be
+#       replaced; the number N of fields to remove and their names; then
+#       pairs of field names and values to set
+_PATCH_SCRIPT = Script(None, (_NUMBER_LUA + _INDEX_LUA + """
+local spec, i = read_spec(1)
+local key = KEYS[1]
+local function lookup(field)
+    return redis.call('HGET', key, field)
+end
+
+update_index('ZREM', spec, lookup)
+if ARGV[i] == '1' then
+    redis.call('DEL', key)
+end
+local n = tonumber(ARGV[i + 1])
+for j = i + 2, i + 1 + n do
+    redis.call('HDEL', key, ARGV[j])
+end
+for j = i + 2 + n, #ARGV, 2 do
+    redis.call('HSET', key, ARGV[j], ARGV[j + 1])
+end
+update_index('ZADD', spec, lookup)
+return redis.call('HGETALL', key)
+""").encode('utf8'))
+
+# Deletes an item stored in a hash.
+#
+# KEYS[1]: the item key (followed by the collection's keys, if it has
+#          one)
+# ARGV: the index specification
+_DELETE_SCRIPT = Script(None, (_NUMBER_LUA + _INDEX_LUA + """
+local spec = read_spec(1)
+local key = KEYS[1]
+update_index('ZREM', spec, function(field)
+    return redis.call('HGET', key, field)
+end)
+if #KEYS > 1 then
+    redis.call('ZREM', KEYS[2], spec.id)
+end
+return redis.call('DEL', key)
+""").encode('utf8'))
+
+# Deletes the items of a collection that match a filter (checked as by
+# _FILTER_SCRIPT), and returns the number of items checked and deleted.
+#
+# KEYS[1]: the collection key (again, so that the rest of KEYS are laid
+#          out as they are for the other write scripts)
+# ARGV[1]: the prefix for item keys
+# ARGV[2...]: 'range', followed by the start and stop ranks of a window
+#             of the collection; or 'ids', followed by a number N and N
+#             item ids
+# Then: the index specification (with an empty id) and the filter
+# program.
+_DELETE_MATCHING_SCRIPT = Script(None, (
+    _NUMBER_LUA + _INDEX_LUA + _MATCH_LUA + """
+local ids, i
+if ARGV[2] == 'range' then
+    ids = redis.call('ZRANGE', KEYS[2], ARGV[3], ARGV[4])
+    i = 5
+else
+    local n = tonumber(ARGV[3])
+    ids = {}
+    for j = 1, n do
+        ids[j] = ARGV[3 + j]
+    end
+    i = 4 + n
+end
+
+local spec, start = read_spec(i)
+local deleted = 0
+for _, id in ipairs(ids) do
+    local key = ARGV[1] .. id
+    if redis.call('EXISTS', key) == 1 and matches(key, id, start) then
+        spec.id = id
+        update_index('ZREM', spec, function(field)
+            return redis.call('HGET', key, field)
+        end)
+        redis.call('ZREM', KEYS[2], id)
+        redis.call('DEL', key)
+        deleted = deleted + 1
+    end
+end
+return {#ids, deleted}
+""").encode('utf8'))
+
+# Removes a batch of items from a collection, and once it's empty,
+# entries from its indexes, so that clearing a large collection never
+# blocks the server for long. Returns the number of entries left.
+#
+# KEYS[1]: the collection key
+# KEYS[2...]: the keys of its indexes
+# ARGV[1]: the prefix for item keys
+# ARGV[2]: the batch size
+_CLEAR_SCRIPT = Script(None, b"""
+local left = tonumber(ARGV[2])
+local ids = redis.call('ZRANGE', KEYS[1], 0, left - 1)
+for _, id in ipairs(ids) do
+    redis.call('DEL', ARGV[1] .. id)
+end
+
+local remaining = 0
+for _, key in ipairs(KEYS) do
+    if left > 0 then
+        left = left - redis.call('ZREMRANGEBYRANK', key, 0, left - 1)
+    end
+    remaining = remaining + redis.call('ZCARD', key)
+end
+return remaining
+""")
 
 
 class IndexToken(Mapping):
-    __slots__ = 'sz', 'fields'
-
-    def __init__(self, fields, bytesize=4):
+    # An index entry is the token's value, followed by a NUL byte and the
+    # item's id. The value is made up of the encoded field values
+    # themselves (rather than a digest of them), so it is the same in
+    # every process and can't collide with another token's. Ids are
+    # encoded as strings (since that's how they're stored in keys), so
+    # that the write scripts can build the same entries.
+    __slots__ = 'fields', 'encode'
+
+    def __init__(self, fields, encode=None):
         self.fields = fields
-        self.sz = bytesize
+        self.encode = _CODECS['repr'].encode_value if encode is None \
+                      else encode
 
     def __str__(self):
         return ",".join("{}={!r}".format(k, self.fields[k])
                         for k in sorted(self.fields))
 
     def __hash__(self):
-        return hash(str(self)) & (2**(8*self.sz - 1) - 1)
+        return hash(self.value)
 
     def __iter__(self):
         yield from self.fields
@@ -35,17 +400,238 @@ class IndexToken(Mapping):
 
     @property
     def value(self):
-        return hash(self).to_bytes(self.sz, 'big')
+        # Encoded values never contain control characters, so the unit
+        # separator can't be mistaken for part of one.
+        return b'\x1f'.join(
+            k.encode('utf8') + b'=' + self.encode(
+                str(self.fields[k]) if k == 'id' else self.fields[k])
+            for k in sorted(self.fields)
+        )
+
+    def entry(self, id):
+        """Return the index entry for the item with the given id."""
+        return self.value + b'\x00' + id.encode('ascii')
+
+    @property
+    def range(self):
+        """Return the lexicographical range of the token's entries."""
+        return b'[' + self.value + b'\x00', b'[' + self.value + b'\x00\xff'
+
+
+class RedisPool:
+    """
+    RedisPool(url=None, app=None, max_connections=50, pool_timeout=20, socket_timeout=5, socket_connect_timeout=5, health_check_interval=30, client=None, **connection_args)
+
+    A Redis client with a connection pool that is shared by every
+    request to an application.
+
+    :param url: A ``redis://`` URL for the server. If not given, the
+        client connects to a local server, using *connection_args*.
+    :param app: An application to attach the pool to.
+    :param max_connections: The most connections that the pool opens.
+        Once they are all in use, commands wait for a free connection.
+    :param pool_timeout: The number of seconds that a command waits for
+        a free connection before raising an error.
+    :param socket_timeout: The number of seconds that a command waits
+        for a reply from the server.
+    :param socket_connect_timeout: The number of seconds that opening a
+        connection may take.
+    :param health_check_interval: The number of seconds between health
+        checks. At the start of a request, if it's been at least this
+        long since the last check, the server is pinged; if that fails,
+        the pool's connections are dropped so that fresh ones are opened.
+        If ``None``, the health isn't checked.
+    :param client: A :class:`redis.StrictRedis` instance to use instead
+        of creating one.
+
+    Once the pool is attached to an application, :class:`RedisSet` (and
+    standalone :class:`RedisObj` instances) use its client by default::
+
+        app = App()
+        RedisPool("redis://localhost:6379/0", app=app, max_connections=20)
+
+    Outside of a request (or if no pool was attached), they use a client
+    that is shared by the whole process.
+    """
+
+    def __init__(self, url=None, app=None, max_connections=50,
+                 pool_timeout=20, socket_timeout=5, socket_connect_timeout=5,
+                 health_check_interval=30, client=None, **connection_args):
+        if client is None:
+            connection_args.update(
+                max_connections=max_connections,
+                timeout=pool_timeout,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_connect_timeout,
+            )
+            if url is None:
+                pool = redis.BlockingConnectionPool(**connection_args)
+            else:
+                pool = redis.BlockingConnectionPool.from_url(
+                    url, **connection_args)
+            client = redis.StrictRedis(connection_pool=pool)
+
+        self.client = client
+        self.health_check_interval = health_check_interval
+        self._last_check = monotonic()
+        self._lock = Lock()
+
+        if app is not None:
+            self.attach_to(app)
+
+    def attach_to(self, app):
+        @app.context
+        def redis_client():
+            self.check_health()
+            yield self.client
+
+    def check_health(self, force=False):
+        """
+        Ping the server if a health check is due (or *force* is true),
+        and drop the pool's connections if that fails. Returns ``False``
+        if the server couldn't be reached.
+        """
+        interval = self.health_check_interval
+        with self._lock:
+            if not force and (interval is None 
+                              or monotonic() - self._last_check < interval):
+                return True
+            self._last_check = monotonic()
+
+        try:
+            self.client.ping()
+        except redis.RedisError:
+            # The connections may have been broken by a server restart
+            # or a network failure; new ones are made as they're needed.
+            self.client.connection_pool.disconnect()
+            return False
+        else:
+            return True
+
+
+_shared_client = None
+_shared_client_lock = Lock()
+
+
+def _default_client():
+    # The client for the current request's application if it has a
+    # RedisPool, otherwise a client that is shared by the process.
+    global _shared_client
+    client = getattr(ctx, 'redis_client', None)
+    if client is not None:
+        return client
+
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = redis.StrictRedis()
+        return _shared_client
+
+
+class ReprCodec:
+    """
+    The codec that converts records to and from what's stored in Redis.
+
+    This codec (the default) stores each field in a hash, encoded with
+    :func:`repr`, and decodes it with :func:`ast.literal_eval`. It can
+    store any value whose representation is a Python literal, but is
+    the slowest of the codecs to decode.
+
+    Codecs whose :attr:`fielded` attribute is true store records in
+    hashes, with each field encoded by :meth:`encode_value`; other
+    codecs store each record as a single string.
+    """
+    #: Whether records are stored as hashes of separately encoded fields
+    fielded = True
+
+    def encode_value(self, value):
+        """
+        Encode a field value. This encoding is also used for index
+        entries, and for checking filters on the server.
+        """
+        return repr(value).encode('utf8')
+
+    def encode(self, data):
+        """
+        Encode a record's data into a mapping of field names to encoded
+        values (for fielded codecs), or a single bytestring.
+        """
+        return {k: self.encode_value(v) for k, v in data.items()}
+
+    def decode(self, raw):
+        """
+        Decode what was stored for a record into a dictionary. *raw* is
+        the contents of the record's hash (for fielded codecs) or its
+        string value.
+        """
+        # The values are decoded all at once, as a list literal.
+        if not raw:
+            return {}
+        values = literal_eval(
+            (b'[' + b','.join(raw.values()) + b']').decode('utf8'))
+        return dict(zip((k.decode('utf8') for k in raw), values))
+
+
+class JSONCodec(ReprCodec):
+    """
+    A codec that stores each field in a hash, encoded as JSON.
+
+    Only values that can be represented in JSON can be stored, and
+    tuples are read back as lists.
+    """
+
+    def encode_value(self, value):
+        return json.dumps(value, sort_keys=True).encode('utf8')
+
+    def decode(self, raw):
+        if not raw:
+            return {}
+        values = json.loads(
+            (b'[' + b','.join(raw.values()) + b']').decode('utf8'))
+        return dict(zip((k.decode('utf8') for k in raw), values))
+
+
+class PickleCodec(ReprCodec):
+    """
+    A codec that stores each record as a single string, packed with
+    :mod:`pickle`.
+
+    This is the fastest codec, but since the server can't see individual
+    fields, filters are always checked by the client.
+
+    .. warning:: Never use this codec with a Redis server that untrusted
+        clients can write to.
+    """
+    fielded = False
+
+    def encode(self, data):
+        return pickle.dumps(dict(data), pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, raw):
+        return pickle.loads(raw) if raw else {}
+
+
+_CODECS = {
+    'repr': ReprCodec(),
+    'json': JSONCodec(),
+    'pickle': PickleCodec(),
+}
+
+
+def _getcodec(codec):
+    return _CODECS[codec] if isinstance(codec, str) else codec
 
 
 class RedisObj(MutableRecord):
-    def __init__(self, key, collection=None, include_id=True):
+    def __init__(self, key, collection=None, include_id=True, codec=None):
         self.itemkey = key
         self.collection = collection
         self.include_id = include_id
         self.r = (collection.r 
                   if collection is not None
-                  else redis.StrictRedis())
+                  else _default_client())
+        if codec is None:
+            codec = collection.codec if collection is not None else 'repr'
+        self.codec = _getcodec(codec)
         self.inblock = False
 
     def __repr__(self):
@@ -57,78 +643,144 @@ class RedisObj(MutableRecord):
         )
 
     def start_edit_block(self):
-        client = self.r
-        self.r = self.r.pipeline()
+        # The block's patches are collected, and applied together in a
+        # single write when it's closed.
+        self.blockops = []
         self.inblock = True
-        return (client, dict(self))
 
     def close_edit_block(self, token):
-        client, old_data = token
-
-        ret = self.r.execute()
-        self.r = client
-        
-        data = dict(self)
-
-        if self.collection is not None:
-            self.collection.reindex(
-                self.id,
-                data,
-                old_data
-            )
-
-        self.invalidate(new_data=data)
         self.inblock = False
-        
+        if self.blockops:
+            self.__apply(self.blockops)
 
     def patch(self, add_data, remove_fields, replace=False):
-        p = self.r.pipeline()
-
-        if not self.inblock:
-            old_data = dict(self)
-
-        if replace:
-            p.delete(self.itemkey)
-
-        elif remove_fields:
-            p.hdel(self.itemkey, *remove_fields)
-
-        self.store(add_data, self.itemkey, p)
-        p.execute()
-
+        ops = [(add_data, list(remove_fields), replace)]
         if self.inblock:
-            data = {k: old_data[k] for k in old_data 
-                    if k not in remove_fields}
-            data.update(add_data)
-
-            self.invalidate(new_data=data)
-
-            if self.collection is not None:
-                self.collection.reindex(self.id, data, old_data)
-
-        else:
+            self.blockops.extend(ops)
             self.invalidate()
+        else:
+            self.__apply(ops)
 
     def read(self):
-        data = self.r.hgetall(self.itemkey)
-        if self.include_id:
-            data[b'id'] = self.id.encode("utf8")
-        return {k.decode('utf8'):literal_eval(v.decode('utf8')) 
-                for k,v in data.items()}
+        return self.decode(self.fetchraw(self.r, self.itemkey, self.codec),
+                           self.id if self.include_id else None,
+                           self.codec)
+
+    def stored(self):
+        """Return the record's data as it is stored (without an id)."""
+        return self.codec.decode(
+            self.fetchraw(self.r, self.itemkey, self.codec))
 
     def delete(self):
-        if self.collection is not None:
-            self.collection.remove_from_index(self.id, self)
-            self.collection.untrack_id(self.id)
+        if self.codec.fielded:
+            self.__runscript(_DELETE_SCRIPT)
+            return
+
+        collection = self.collection
+
+        def delete(pipe):
+            old_data = self.codec.decode(pipe.get(self.itemkey))
+            pipe.multi()
+            if collection is not None:
+                collection.remove_from_index(self.id, old_data, pipe)
+                collection.untrack_id(self.id, pipe)
+            pipe.delete(self.itemkey)
+
+        self.r.transaction(delete, self.itemkey)
+
+    def __runscript(self, script, args=()):
+        # Run one of the write scripts on the item
+        if self.collection is None:
+            keys, spec = [], [self.id, b'', b'', 0]
+        else:
+            keys, spec = self.collection._scriptspec(self.id)
+        return script([self.itemkey] + keys, spec + list(args), self.r)
+
+    def __apply(self, ops):
+        if not self.codec.fielded:
+            self.__rewrite(ops)
+            return
+
+        # The patches are merged into one, which the server applies.
+        replace, remove, add = False, set(), {}
+        for add_data, remove_fields, replace_data in ops:
+            if replace_data:
+                replace, remove, add = True, set(), {}
+            for field in remove_fields:
+                add.pop(field, None)
+                remove.add(field)
+            add.update(add_data)
+
+        args = ['1' if replace else '0', len(remove)]
+        args.extend(remove)
+        for field, value in self.codec.encode(add).items():
+            args.extend((field, value))
+
+        result = self.__runscript(_PATCH_SCRIPT, args)
+        self.__present(self.codec.decode(dict(zip(result[::2],
+                                                  result[1::2]))))
+
+    def __rewrite(self, ops):
+        # The server can't patch a record that is stored whole, so it is
+        # rewritten in a transaction that is retried if the record
+        # changes in the meantime.
+        collection = self.collection
+
+        def rewrite(pipe):
+            old_data = self.codec.decode(pipe.get(self.itemkey))
+            data = dict(old_data)
+            for add_data, remove_fields, replace in ops:
+                if replace:
+                    data.clear()
+                for field in remove_fields:
+                    data.pop(field, None)
+                data.update(add_data)
+
+            pipe.multi()
+            if collection is not None:
+                collection.remove_from_index(self.id, old_data, pipe)
+                collection.add_to_index(self.id, data, pipe)
+            self.store(data, self.itemkey, pipe, self.codec)
+            return data
+
+        self.__present(self.r.transaction(rewrite, self.itemkey,
+                                          value_from_callable=True))
+
+    def __present(self, data):
+        if self.include_id:
+            data['id'] = _parseid(self.id)
+        self.invalidate(new_data=data)
 
-        self.r.delete(self.itemkey)
+    @staticmethod
+    def decode(data, id=None, codec=None):
+        """
+        Decode what is stored for a record into a record mapping, using
+        *codec* (by default, the ``repr`` codec).
+
+        If *id* is given, it is inserted into the result as the ``id``
+        field.
+        """
+        data = _getcodec(codec or 'repr').decode(data)
+        if id is not None:
+            data['id'] = _parseid(id)
+        return data
 
     @staticmethod
-    def store(data, key, client):
-        data = {k: repr(v).encode('utf8')
-                for k,v in data.items()}
+    def store(data, key, client, codec=None):
+        codec = _getcodec(codec or 'repr')
+        encoded = codec.encode(data)
+        if not codec.fielded:
+            return client.set(key, encoded)
+        elif encoded:
+            return client.hmset(key, encoded)
 
-        return client.hmset(key, data)
+    @staticmethod
+    def fetchraw(client, key, codec=None):
+        # Send the command that reads what's stored for a record
+        if _getcodec(codec or 'repr').fielded:
+            return client.hgetall(key)
+        else:
+            return client.get(key)
 
     @property
     def id(self):
@@ -137,7 +789,7 @@ class RedisObj(MutableRecord):
             
 class RedisSet(MutableDataSet):
     """
-    RedisSet(key=None, client=None, index_size=4)
+    RedisSet(key=None, client=None, batch_size=100, compact=False, codec='repr', numeric_indexes=())
 
     A RedisSet is an :class:`AbstractDataSet` that stores its items in
     a Redis database (using a Sorted Set to represent the collection,
@@ -147,10 +799,28 @@ class RedisSet(MutableDataSet):
         not given, one is deterministically generated based on the current
         resource.
     :param client: A :class:`redis.StrictRedis` instance that should be
-        used to communicate with the redis server. If not given, a default
-        instance is used.
-    :param index_size: The number of bytes to use to index items in the
-        set (per item).
+        used to communicate with the redis server. If not given, the
+        client of the application's :class:`RedisPool` is used, or a
+        client shared by the process if there isn't one.
+    :param batch_size: The number of items whose data is fetched from
+        the server in a single round trip while iterating through the set.
+    :param compact: If true, iterating through the set produces read-only
+        :class:`~findig.tools.dataset.CompactRecord` instances that share
+        a schema (which may be given instead of ``True``). Items fetched
+        by id are unaffected.
+    :param codec: How items are stored; one of ``'repr'`` (the default),
+        ``'json'`` or ``'pickle'`` (see :class:`ReprCodec`,
+        :class:`JSONCodec` and :class:`PickleCodec`), or a codec
+        instance. Use :meth:`migrate_codec` to convert the items of an
+        existing set to a different codec.
+    :param numeric_indexes: The names of fields whose numeric values
+        are indexed by score. Filters that bound one of these fields
+        (e.g., ``F('age') >= 18``) only read the items in range, and
+        sorting by one of them is done by the server.
+
+    Indexes written by versions of Findig before 0.2 (which were keyed
+    by a per-process hash) can't be read; call :meth:`rebuild_indexes`
+    once to migrate an existing set.
     """
 
     def __init__(self, key=None, client=None, **args):
@@ -164,22 +834,31 @@ class RedisSet(MutableDataSet):
         self.itemkey = self.colkey + ':item:{id}'
         self.indkey = self.colkey + ':index'
         self.incrkey =  self.colkey + ':next-id'
-        self.genid = args.pop(
-            'generate_id', 
-            lambda d: self.r.incr(self.incrkey)
-        )
-        self.indsize = args.pop('index_size', 4)
+        # Ids are generated by the server (from a counter) unless a
+        # function that generates them is given.
+        self.genid = args.pop('generate_id', None)
+        # index_size is no longer used, since index entries are no longer
+        # hashes; it's still accepted for backward compatibility.
+        args.pop('index_size', None)
+        self.numindexes = tuple(args.pop('numeric_indexes', ()))
+        self.sortby = args.pop('sortby', None)
         self.filterby = args.pop('filterby', {})
+        self.filterexprs = args.pop('filterexprs', ())
         self.indexby = args.pop('candidate_keys', [('id',)])
         self.include_ids = args.pop('include_ids', True)
-        self.r = redis.StrictRedis() if client is None else client
+        self.batch_size = args.pop('batch_size', 100)
+        compact = args.pop('compact', False)
+        self.schema = RecordSchema() if compact is True else compact or None
+        self.codec = _getcodec(args.pop('codec', 'repr'))
+        self.r = _default_client() if client is None else client
 
     def __repr__(self):
-        if self.filterby:
+        if self.filterby or self.filterexprs:
             name = "filtered-redis-view"
             suffix = "|{}".format(
-                ",".join("{}={!r}".format(k,v) 
-                         for k,v in self.filterby.items())
+                ",".join(list(map(repr, self.filterexprs)) +
+                         ["{}={!r}".format(k,v) 
+                          for k,v in self.filterby.items()])
             )
         else:
             name = "redis-set"
@@ -194,37 +873,321 @@ class RedisSet(MutableDataSet):
         # If there is a filter, and it is completely encapsulated by
         # our index, we can use that to iter through the items
         
-        tokens = self.__buildindextokens(self.filterby, raise_err=False)
-        if tokens:
+        tokens = self.__buildindextokens(self.__equalities(), raise_err=False)
+        program = self.__filterprogram()
+        if self.sortby is not None:
+            # The server sorts the ids, and the filter is checked here.
+            records = self.__loadbatches(self.__sortedids())
+
+        elif tokens:
             # Pick an index to scan
             token = random.choice(tokens)
-            id_blobs = self.r.zrangebylex(self.indkey, token.value, token.value)
-            ids = [bs[self.indsize:] for bs in id_blobs]
+            id_blobs = self.r.zrangebylex(self.indkey, *token.range)
+            ids = [bs.rpartition(b'\x00')[2] for bs in id_blobs]
+            records = self.__loadbatches(ids)
+
+        elif self.__scorerange() is not None:
+            # The filter bounds a field with a numeric index, so only
+            # the items in range are read.
+            field, low, high = self.__scorerange()
+            ids = self.r.zrangebyscore(self.__numkey(field), low, high)
+            records = self.__loadbatches(ids)
+
+        elif program is not None:
+            # The index can't help us, but the filter can be checked
+            # by the server so that only matching items are sent back.
+            records = self.__loadfiltered(program)
 
         else:
             ids = self.r.zrange(self.colkey, 0, -1)
+            records = self.__loadbatches(ids)
 
-        for id in map(lambda bs: bs.decode('ascii'), ids):
-            itemkey = self.itemkey.format(id=id)
-            if self.filterby:
+        for record in records:
+            if self.filterby or self.filterexprs:
                 # Check the items against the filter if it was
                 # specified
-                data = RedisObj(itemkey, self, self.include_ids)
-                if FilteredDataSet.check_match(data, self.filterby):
-                    yield data
+                if FilteredDataSet.check_match(record, self.filterby,
+                                               self.filterexprs):
+                    yield record
             else:
-                yield RedisObj(itemkey, self, self.include_ids)
+                yield record
+
+    def __makeobj(self, id, data):
+        # Build an item whose data has already been read from the
+        # server, so that accessing it doesn't cost another round trip.
+        if self.schema is not None:
+            return self.schema.record(
+                RedisObj.decode(data, id if self.include_ids else None,
+                                self.codec))
+
+        obj = RedisObj(self.itemkey.format(id=id), self, self.include_ids)
+        obj.invalidate(
+            new_data=RedisObj.decode(data, id if self.include_ids else None,
+                                     self.codec)
+        )
+        return obj
+
+    def migrate_codec(self, old_codec):
+        """
+        Rewrite every item in the set, which was stored with
+        *old_codec*, with this set's codec, and rebuild the indexes
+        (whose entries depend on the codec). Returns the number of items
+        rewritten.
+
+        The set shouldn't be written to while it is being migrated.
+        """
+        old_codec = _getcodec(old_codec)
+        total = 0
+        ids = self.r.zrange(self.colkey, 0, -1)
+        for batch in self.__loaddata(ids, codec=old_codec):
+            pipe = self.r.pipeline()
+            for id, data in batch:
+                itemkey = self.itemkey.format(id=id)
+                pipe.delete(itemkey)
+                RedisObj.store(data, itemkey, pipe, self.codec)
+            pipe.execute()
+            total += len(batch)
+
+        self.rebuild_indexes()
+        return total
+
+    def __loadbatches(self, ids):
+        for batch in self.__loaddata(ids, raw=True):
+            for id, data in batch:
+                yield self.__makeobj(id, data)
+
+    def __loaddata(self, ids, raw=False, codec=None):
+        # Read the items in pipelined batches of batch_size, and yield
+        # lists of (id, data) pairs.
+        codec = self.codec if codec is None else codec
+        ids = [bs.decode('ascii') for bs in ids]
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start:start+self.batch_size]
+            pipe = self.r.pipeline(transaction=False)
+            for id in batch:
+                RedisObj.fetchraw(pipe, self.itemkey.format(id=id), codec)
+
+            # An empty hash means that the item was removed since we
+            # retrieved its id.
+            yield [(id, data if raw else codec.decode(data))
+                   for id, data in zip(batch, pipe.execute()) if data]
+
+    def __loadfiltered(self, program):
+        args = [self.itemkey.format(id=''), 0, 0] + program
+
+        start = 0
+        while True:
+            args[1:3] = start, start + self.batch_size - 1
+            scanned, *matches = _FILTER_SCRIPT([self.colkey], args, self.r)
+            for id, flat in matches:
+                data = dict(zip(flat[::2], flat[1::2]))
+                yield self.__makeobj(id.decode('ascii'), data)
+
+            if scanned < self.batch_size:
+                break
+            else:
+                start += self.batch_size
+
+    def __conjuncts(self):
+        # The parts of the filter that every item must match.
+        yield from (Comparison(k, 'eq', v) for k, v in self.filterby.items()
+                    if not isinstance(v, Callable))
+        yield from And(*self.filterexprs).terms
+
+    def __equalities(self):
+        # The fields that the filter requires to have exact values, which
+        # an index may be able to look up. None also matches items that
+        # lack the field, which aren't indexed, so it's left out (as are
+        # the predicates in filterby).
+        spec = {k: v for k, v in self.filterby.items()
+                if v is not None and not isinstance(v, Callable)}
+        for expr in self.__conjuncts():
+            if isinstance(expr, Comparison) and expr.op == 'eq' \
+               and expr.value is not None:
+                spec.setdefault(expr.field, expr.value)
+        return spec
+
+    def __scorebounds(self):
+        # Map each field with a numeric index that the filter bounds to
+        # a list of (op, value) bounds on it.
+        bounds = {}
+        for expr in self.__conjuncts():
+            if isinstance(expr, Comparison) \
+               and expr.field in self.numindexes \
+               and expr.op in ('eq', 'lt', 'le', 'gt', 'ge') \
+               and _isnumber(expr.value):
+                bounds.setdefault(expr.field, []).append(
+                    (expr.op, expr.value))
+        return bounds
+
+    def __scorerange(self, field=None):
+        # Return (field, min, max) for a score range (of a numeric index)
+        # that contains every item that matches the filter, or None. The
+        # range is inclusive, since scores are only as precise as a
+        # double; items are checked against the filter afterwards.
+        bounds = self.__scorebounds()
+        if field is None:
+            field = next(iter(bounds), None)
+        if field not in bounds:
+            return None
+
+        low, high = float('-inf'), float('inf')
+        for op, value in bounds[field]:
+            if op in ('eq', 'gt', 'ge'):
+                low = max(low, value)
+            if op in ('eq', 'lt', 'le'):
+                high = min(high, value)
+        return field, _score(low), _score(high)
+
+    def __sortedids(self):
+        field, descending = self.sortby
+        key = self.__numkey(field)
+        scored = self.__scorerange(field)
+        if scored is not None:
+            _, low, high = scored
+        else:
+            low, high = '-inf', '+inf'
 
-    def add(self, data):
-        id = str(data['id'] if 'id' in data else self.genid(data))
-        itemkey = self.itemkey.format(id=id)
+        if descending:
+            ids = self.r.zrevrangebyscore(key, high, low)
+        else:
+            ids = self.r.zrangebyscore(key, low, high)
+
+        if scored is None:
+            # Items without a numeric value for the field come last (or
+            # first, when descending), just as they do when records are
+            # sorted by OrderedDataSet. If the filter bounds the field,
+            # they can't match it anyway.
+            indexed = set(ids)
+            rest = [id for id in self.r.zrange(self.colkey, 0, -1)
+                    if id not in indexed]
+            ids = rest + ids if descending else ids + rest
+
+        return ids
+
+    def __numkey(self, field):
+        return "{}:{}".format(self.indkey, field)
+
+    def __filterprogram(self, strict=False):
+        # Compile the filter into a program for _FILTER_SCRIPT, or return
+        # None if no part of it can be checked by the server. Parts that
+        # can't be checked there are assumed to match (taking negation
+        # into account), since every item is checked again here anyway.
+        # A *strict* program is only returned if the server can check
+        # the whole filter, exactly as it would be checked here.
+        if not self.codec.fielded:
+            # The server can't see the fields of packed records
+            return None
+
+        terms = [Comparison(k, 'eq', v) for k, v in self.filterby.items()
+                 if not isinstance(v, Callable)]
+        terms.extend(self.filterexprs)
+        if strict and len(terms) < len(self.filterexprs) + len(self.filterby):
+            return None
+
+        program = []
+        if terms and self.__compilefilter(And(*terms), program, True, strict):
+            return program
+
+    def __compilefilter(self, expr, program, positive, strict=False):
+        # Append the instructions for expr to program, and return whether
+        # any of them (or if *strict*, all of them) are checked by the
+        # server. *positive* is False if the expression is negated.
+        if isinstance(expr, (And, Or)):
+            pushed = [self.__compilefilter(term, program, positive, strict)
+                      for term in expr.terms]
+            program.extend(('and' if isinstance(expr, And) else 'or',
+                            len(expr.terms)))
+            return all(pushed) if strict else any(pushed)
+
+        elif isinstance(expr, Not):
+            pushed = self.__compilefilter(expr.term, program, not positive,
+                                          strict)
+            program.append('not')
+            return pushed
+
+        elif isinstance(expr, Comparison) and expr.field == 'id':
+            # Ids are compared as they appear in item keys
+            value = expr.value
+            if expr.op == 'eq' and isinstance(value, (int, str)) \
+               and not isinstance(value, bool) \
+               and _parseid(str(value)) == value:
+                program.extend(('id', str(value)))
+                return True
+
+        elif isinstance(expr, Comparison):
+            op, value = expr.op, expr.value
+            if op == 'ne':
+                return self.__compilefilter(
+                    Not(Comparison(expr.field, 'eq', value)),
+                    program, positive, strict)
+
+            strings = value if op == 'in' else (value,)
+            encoded = None
+            if op in ('eq', 'in') and strings \
+               and all(isinstance(v, (str, bytes)) for v in strings):
+                try:
+                    encoded = [self.codec.encode_value(v) for v in strings]
+                except TypeError:
+                    # The codec can't store these values, so they can't
+                    # be compared with what it stored.
+                    pass
+
+            if encoded is not None and op == 'eq':
+                program.extend(('eq', expr.field, encoded[0]))
+                return True
+            elif encoded is not None:
+                program.extend(('in', expr.field, len(encoded)))
+                program.extend(encoded)
+                return True
+            elif op in ('eq', 'lt', 'le', 'gt', 'ge') \
+                 and isinstance(value, (int, float)) \
+                 and abs(value) < _MAX_EXACT_INT:
+                # Booleans are compared as numbers (as they are here).
+                # Fields that aren't numbers can't be compared with
+                # one, so in a strict program they don't match.
+                number = int(value) if isinstance(value, bool) else value
+                program.extend(('num', op, expr.field, repr(number),
+                                '1' if positive and not strict else '0'))
+                return True
+
+        # Predicates (and other comparisons of ids, which aren't
+        # necessarily stored in the item's hash) have to be checked here.
+        program.extend(('const', '1' if positive else '0'))
+        return False
 
-        with self.group_redis_commands():
-            tokens = self.add_to_index(id, data)
-            self.track_id(id)
-            RedisObj.store(data, itemkey, self.r)
+    def add(self, data):
+        if 'id' in data:
+            id = str(data['id'])
+        elif self.genid is not None:
+            id = str(self.genid(data))
+        else:
+            id = ''
+
+        # Make sure that the item can be indexed before it's written
+        self.__buildindextokens(data, id)
+
+        keys, args = self._scriptspec(id)
+        fields = {f for ind in self.indexby for f in ind}
+        fields.update(self.numindexes)
+        fields = [f for f in fields if f != 'id' and f in data]
+        args.append(len(fields))
+        for field in fields:
+            args.extend((field, self.codec.encode_value(data[field])))
+
+        args.extend((self.itemkey.format(id=''), time()))
+        encoded = self.codec.encode(data)
+        if self.codec.fielded:
+            args.append('hash')
+            for field, value in encoded.items():
+                args.extend((field, value))
+        else:
+            args.extend(('string', encoded))
 
-        return tokens[0]
+        # The id is generated, and the item indexed and stored, in one
+        # round trip.
+        id = _ADD_SCRIPT([self.incrkey] + keys, args, self.r)
+        return self.__buildindextokens(data, id.decode('utf8'))[0]
 
     def fetch_now(self, **spec):
         if list(spec) == ['id']:
@@ -239,59 +1202,198 @@ class RedisSet(MutableDataSet):
         else:
             return super(RedisSet, self).fetch_now(**spec)
 
-    def track_id(self, id):
-        self.r.zadd(self.colkey, time(), id)
+    def count(self):
+        if not self.filterby and not self.filterexprs:
+            return self.r.zcard(self.colkey)
+
+        token = self.__exacttoken()
+        scored = self.__exactscorerange()
+        if token is not None:
+            # The filter is exactly one of our indexes, so the index
+            # entries can be counted instead of the items.
+            return self.r.zlexcount(self.indkey, *token.range)
+        elif scored is not None:
+            # The filter is exactly a range of a numeric index
+            return self.r.zcount(*scored)
+        else:
+            return super(RedisSet, self).count()
+
+    def exists(self):
+        if not self.filterby and not self.filterexprs \
+           or self.__exacttoken() is not None \
+           or self.__exactscorerange() is not None:
+            return self.count() > 0
+        else:
+            return super(RedisSet, self).exists()
+
+    def track_id(self, id, client=None):
+        (client or self.r).zadd(self.colkey, time(), id)
 
-    def untrack_id(self, id):
-        self.r.zrem(self.colkey, id)
+    def untrack_id(self, id, client=None):
+        (client or self.r).zrem(self.colkey, id)
 
-    def remove_from_index(self, id, data):
+    def remove_from_index(self, id, data, client=None):
+        client = client or self.r
         tokens = self.__buildindextokens(data, id, False)
         for token in tokens:
-            self.r.zrem(
-                self.indkey, 
-                token.value + id.encode('ascii')
-            )
+            client.zrem(self.indkey, token.entry(id))
+
+        for field in self.numindexes:
+            client.zrem(self.__numkey(field), id)
 
-    def add_to_index(self, id, data):
+    def add_to_index(self, id, data, client=None):
+        client = client or self.r
         tokens = self.__buildindextokens(data, id)
         for token in tokens:
-            self.r.zadd(
-                self.indkey,
-                0,
-                token.value + id.encode('ascii')
-            )
+            client.zadd(self.indkey, 0, token.entry(id))
+
+        for field in self.numindexes:
+            if _isnumber(data.get(field)):
+                client.zadd(self.__numkey(field), float(data[field]), id)
+
         return tokens
 
+    def _scriptspec(self, id):
+        # Return the keys and arguments that describe the set's indexes
+        # to the write scripts.
+        prefix, _, suffix = self.codec.encode_value('0').partition(b'0')
+        args = [id, prefix, suffix, len(self.indexby)]
+        for ind in self.indexby:
+            args.append(len(ind))
+            args.extend(sorted(ind))
+        args.extend(self.numindexes)
+
+        keys = [self.colkey, self.indkey]
+        keys.extend(map(self.__numkey, self.numindexes))
+        return keys, args
+
     def reindex(self, id, data, old_data):
         with self.group_redis_commands():
-            self.remove_from_index(id, data)
+            self.remove_from_index(id, old_data)
             self.add_to_index(id, data)
 
+    def rebuild_indexes(self):
+        """
+        Discard the set's indexes and rebuild them from its items.
+
+        This migrates indexes written by older versions of Findig, and
+        must be called after changing the candidate keys or numeric
+        indexes of a set that already has items. It shouldn't be run
+        while the set is being written to. Returns the number of items
+        indexed.
+        """
+        self.r.delete(self.indkey, *map(self.__numkey, self.numindexes))
+
+        total = 0
+        ids = self.r.zrange(self.colkey, 0, -1)
+        for batch in self.__loaddata(ids):
+            with self.group_redis_commands():
+                for id, data in batch:
+                    self.add_to_index(id, data)
+            total += len(batch)
+        return total
+
     def clear(self):
-        # Remove all the child objects
-        for_removal = list(self)
+        """
+        Remove the items in the set (or in this filtered view of it).
+
+        The server removes the items in batches of *batch_size*, so
+        that clearing a large set doesn't block it for long. The items
+        of a filtered view are only read if part of the filter can't be
+        checked by the server.
+        """
+        if not self.filterby and not self.filterexprs:
+            keys = [self.colkey, self.indkey]
+            keys.extend(map(self.__numkey, self.numindexes))
+            args = [self.itemkey.format(id=''), self.batch_size]
+            while _CLEAR_SCRIPT(keys, args, self.r):
+                pass
+            self.r.delete(self.incrkey)
+            return
 
-        with self.group_redis_commands():
-            for obj in for_removal:
+        program = self.__filterprogram(strict=True)
+        if program is None and not self.codec.fielded:
+            # The index entries of packed records can only be worked
+            # out here, so each item is deleted on its own.
+            for obj in list(self.__copy(compact=False, sortby=None)):
                 obj.delete()
+            return
 
-            self.r.delete(self.incrkey)
-
-        # Delete all the redis structures
-        # Technically this step shouldn't be necessary;
-        # Redis should clean up the other data structures
+        elif program is None:
+            # The filter is checked here, and the matching items are
+            # deleted by id.
+            program = []
+            matching = self.__copy(compact=False, sortby=None)
+            ids = [obj.id.encode('ascii') for obj in matching]
 
-    def filtered(self, **spec):
+        else:
+            tokens = self.__buildindextokens(self.__equalities(),
+                                             raise_err=False)
+            scored = self.__scorerange()
+            if tokens:
+                ids = [bs.rpartition(b'\x00')[2] for bs in
+                       self.r.zrangebylex(self.indkey, *tokens[0].range)]
+            elif scored is not None:
+                field, low, high = scored
+                ids = self.r.zrangebyscore(self.__numkey(field), low, high)
+            else:
+                # Scan the whole collection on the server
+                self.__deletematching(program)
+                return
+
+        for start in range(0, len(ids), self.batch_size):
+            self.__deletematching(program, ids[start:start+self.batch_size])
+
+    def __deletematching(self, program, ids=None):
+        # Delete the items (with the given ids, or else in the whole
+        # collection) that match a strict filter program.
+        keys, spec = self._scriptspec('')
+        keys.insert(0, self.colkey)
+        if ids is not None:
+            args = [self.itemkey.format(id=''), 'ids', len(ids)]
+            args.extend(ids)
+            _DELETE_MATCHING_SCRIPT(keys, args + spec + program, self.r)
+            return
+
+        start = 0
+        while True:
+            args = [self.itemkey.format(id=''), 'range',
+                    start, start + self.batch_size - 1]
+            scanned, deleted = _DELETE_MATCHING_SCRIPT(
+                keys, args + spec + program, self.r)
+            if scanned < self.batch_size:
+                break
+            # The items left behind in the window are skipped next time
+            start += scanned - deleted
+
+    def filtered(self, *expressions, **spec):
         filter = dict(self.filterby)
         filter.update(spec)
+        return self.__copy(filterby=filter,
+                           filterexprs=self.filterexprs + expressions)
+
+    def sorted(self, *sort_spec, descending=False):
+        if len(sort_spec) == 1 and sort_spec[0] in self.numindexes:
+            return self.__copy(sortby=(sort_spec[0], descending))
+        else:
+            return super(RedisSet, self).sorted(*sort_spec,
+                                                descending=descending)
+
+    def __copy(self, **changes):
         args = {
             'key': self.colkey,
             'candidate_keys': self.indexby,
-            'index_size': self.indsize,
-            'filterby': filter,
+            'numeric_indexes': self.numindexes,
+            'filterby': self.filterby,
+            'filterexprs': self.filterexprs,
+            'sortby': self.sortby,
+            'include_ids': self.include_ids,
+            'batch_size': self.batch_size,
+            'compact': self.schema or False,
             'client': self.r,
+            'codec': self.codec,
         }
+        args.update(changes)
         return RedisSet(**args)
 
     @contextmanager
@@ -304,6 +1406,45 @@ class RedisSet(MutableDataSet):
         self.r.execute()
         self.r = client
 
+    def __exactscorerange(self):
+        # Return (key, min, max) for a score range of a numeric index
+        # that contains exactly the items matching the filter, if any.
+        bounds = self.__scorebounds()
+        conjuncts = list(self.__conjuncts())
+        if len(bounds) != 1 or self.filterby \
+           or len(conjuncts) != sum(map(len, bounds.values())):
+            return None
+
+        (field, field_bounds), = bounds.items()
+        low = high = None
+        for op, value in field_bounds:
+            if abs(value) >= _MAX_EXACT_INT:
+                return None
+            # Bounds are (value, flag) pairs, where the flag is chosen
+            # so that the tighter of two bounds on the same value wins.
+            if op in ('eq', 'gt', 'ge'):
+                bound = value, op == 'gt'
+                low = bound if low is None else max(low, bound)
+            if op in ('eq', 'lt', 'le'):
+                bound = value, op != 'lt'
+                high = bound if high is None else min(high, bound)
+
+        low = '-inf' if low is None else \
+              ('(' if low[1] else '') + repr(float(low[0]))
+        high = '+inf' if high is None else \
+               ('' if high[1] else '(') + repr(float(high[0]))
+        return self.__numkey(field), low, high
+
+    def __exacttoken(self):
+        # Return an index token that matches the filter exactly, if any
+        if self.filterexprs:
+            return None
+
+        for token in self.__buildindextokens(self.filterby, raise_err=False):
+            if set(token) == set(self.filterby) \
+               and not any(isinstance(v, Callable) for v in token.values()):
+                return token
+
     def __buildindextokens(self, data, generated_id=None, raise_err=True):
         index = []
        
@@ -318,7 +1459,15 @@ class RedisSet(MutableDataSet):
                     # Can't use this index
                     break
             else:
-                index.append(IndexToken(mapping, self.indsize))
+                token = IndexToken(mapping, self.codec.encode_value)
+                if not raise_err:
+                    try:
+                        token.value
+                    except TypeError:
+                        # The filter has values that the codec can't
+                        # encode, so they can't be looked up.
+                        continue
+                index.append(token)
 
         if not index:
             if raise_err:
@@ -331,4 +1480,269 @@ class RedisSet(MutableDataSet):
         else:
             return index
 
-__all__ = ["RedisSet"]
\ No newline at end of file
+def _parseid(id):
+    # Ids that look like literals (generated ones, for instance) are
+    # presented as those values.
+    try:
+        return literal_eval(id)
+    except (ValueError, SyntaxError):
+        return id
+
+
+def _isnumber(value):
+    # Whether a value can be stored in a numeric index (NaN can't).
+    return isinstance(value, (int, float)) and value == value
+
+
+def _score(value):
+    # Format a score bound for a sorted set command.
+    if value == float('inf'):
+        return '+inf'
+    elif value == float('-inf'):
+        return '-inf'
+    else:
+        return repr(float(value))
+
+
+class AsyncRedisSet(AsyncMutableDataSetAdapter):
+    """
+    AsyncRedisSet(key=None, client=None, executor=None, **args)
+
+    An asynchronous counterpart to :class:`RedisSet`.
+
+    Redis commands are run in *executor* (an 
+    :class:`concurrent.futures.Executor`), or the event loop's default
+    executor if none is given. The remaining arguments are the same as
+    for :class:`RedisSet`.
+    """
+    def __init__(self, key=None, client=None, executor=None, **args):
+        dataset = RedisSet(key, client, **args)
+        super().__init__(dataset, executor, dataset.batch_size)
+
+
+class RedisHitLog(AbstractLog):
+    """
+    RedisHitLog(duration, resource)
+
+    A storage class for :class:`~findig.tools.counter.Counter` that
+    keeps hits in Redis, so that every process (on every host) that
+    serves the application counts the same hits::
+
+        counter = Counter(app, duration=3600, storage=RedisHitLog)
+
+    Hits are counted in time buckets (one hash per bucket, with a
+    counter for each combination of partition groups) that expire once
+    they fall outside of the counter's duration. Recording a hit is a
+    single pipelined round trip, and so is counting hits, no matter how
+    many there are. Counts are only as precise as the buckets are
+    long; hits are let go of a bucket at a time. Each bucket also keeps
+    a Redis HyperLogLog of the groups of each partition, which
+    :meth:`distinct` counts with ``PFCOUNT``.
+
+    It accepts these options (see
+    :meth:`~findig.tools.counter.AbstractLog.configure`)::
+
+        storage = RedisHitLog.configure(key='myapp:hits', resolution=5)
+        counter = Counter(app, duration=3600, storage=storage)
+
+    :param client: A :class:`redis.StrictRedis` instance to use. If not
+        given, the client of the application's :class:`RedisPool` is
+        used, or a client shared by the process if there isn't one.
+    :param key: The prefix for the keys that hits are stored under.
+        Counters that store their hits in the same Redis database must
+        use different prefixes. The default is ``findig:hits``.
+    :param resolution: The length of the time buckets that hits are
+        counted in, as a :class:`~datetime.timedelta` or a number of
+        seconds. By default, a counter's duration is split into 60
+        buckets.
+    """
+    def __init__(self, duration, resource):
+        options = dict(self.options)
+        self.client = options.pop('client', None)
+        prefix = options.pop('key', 'findig:hits')
+        resolution = options.pop('resolution', None)
+        if options:
+            raise TypeError("Unknown option: {}".format(next(iter(options))))
+
+        self.duration = _seconds(duration)
+        if self.duration < 0:
+            self.resolution = None
+        elif resolution is None:
+            self.resolution = max(1, math.ceil(self.duration / 60))
+        else:
+            self.resolution = _seconds(resolution)
+
+        # The log for the whole application has a key of its own.
+        self.key = "{}:{}".format(
+            prefix, '*' if resource is None else resource.name)
+
+    @property
+    def r(self):
+        return _default_client() if self.client is None else self.client
+
+    def track(self, partitions):
+        fields = ['', '=' + repr(tuple(sorted(partitions.items())))]
+        fields.extend(map(repr, _counter_keys(partitions)))
+
+        key = self.__bucketkey(self.key, self.__bucket(time()))
+        pipe = self.r.pipeline(transaction=False)
+        for field in fields:
+            pipe.hincrby(key, field, 1)
+        for name, group in partitions.items():
+            pipe.pfadd(self.__distinctkey(key, name), repr(group))
+        if self.resolution is not None:
+            ttl = math.ceil(self.duration + self.resolution)
+            pipe.expire(key, ttl)
+            for name in partitions:
+                pipe.expire(self.__distinctkey(key, name), ttl)
+        pipe.execute()
+
+    def count(self, **partitions):
+        field = repr(tuple(sorted(partitions.items()))) if partitions \
+                else ''
+        pipe = self.r.pipeline(transaction=False)
+        for bucket in self.__buckets():
+            pipe.hget(self.__bucketkey(self.key, bucket), field)
+        return sum(int(n) for n in pipe.execute() if n is not None)
+
+    def distinct(self, partition):
+        # Each bucket keeps a Redis HyperLogLog of the groups that its
+        # hits fell into, for each partition; PFCOUNT merges them.
+        keys = [self.__distinctkey(self.__bucketkey(self.key, bucket),
+                                   partition)
+                for bucket in self.__buckets()]
+        return self.r.pfcount(*keys)
+
+    def distinct_sketch(self, partition):
+        # Redis's sketches can't be merged with ours, so the sketch is
+        # built from the bucket counters of the partition's groups.
+        sketch = HyperLogLog()
+        for group in self.__groupcounts(partition):
+            sketch.add(group)
+        return sketch
+
+    def top(self, partition, k):
+        return self.__groupcounts(partition).most_common(k)
+
+    def __iter__(self):
+        buckets = list(self.__buckets())
+        pipe = self.r.pipeline(transaction=False)
+        for bucket in buckets:
+            pipe.hgetall(self.__bucketkey(self.key, bucket))
+
+        for bucket, counts in zip(buckets, pipe.execute()):
+            # Hits are only known to have occurred in their bucket, so
+            # they are given its start time (or no time at all, if
+            # there aren't any buckets).
+            when = None if bucket is None else \
+                   datetime.fromtimestamp(bucket * self.resolution)
+            for field, n in sorted(counts.items()):
+                if field.startswith(b'='):
+                    partitions = dict(literal_eval(field[1:].decode('utf8')))
+                    for _ in range(int(n)):
+                        yield Hit(when, partitions)
+
+    def __len__(self):
+        return self.count()
+
+    def __repr__(self):
+        return "<redis-hit-log({!r})>".format(self.key)
+
+    def __bucket(self, timestamp):
+        if self.resolution is not None:
+            return int(timestamp // self.resolution)
+
+    def __buckets(self):
+        # The buckets that hold the hits within the duration
+        if self.resolution is None:
+            yield None
+        else:
+            last = self.__bucket(time())
+            count = math.ceil(self.duration / self.resolution)
+            yield from range(last - count + 1, last + 1)
+
+    def __bucketkey(self, key, bucket):
+        return key if bucket is None else "{}:{}".format(key, bucket)
+
+    def __distinctkey(self, key, partition):
+        return "{}:distinct:{}".format(key, partition)
+
+    def __groupcounts(self, partition):
+        # Add up the buckets' counts for each group of the partition
+        pipe = self.r.pipeline(transaction=False)
+        for bucket in self.__buckets():
+            pipe.hgetall(self.__bucketkey(self.key, bucket))
+
+        counts = PyCounter()
+        for fields in pipe.execute():
+            for field, n in fields.items():
+                if field and not field.startswith(b'='):
+                    key = literal_eval(field.decode('utf8'))
+                    if len(key) == 1 and key[0][0] == partition:
+                        counts[key[0][1]] += int(n)
+        return counts
+
+
+# Applies the generic cell rate algorithm (see findig.tools.ratelimit.gcra)
+# to a limit. Returns the number of seconds to wait (as a string, since
+# Lua numbers are truncated to integers in replies), or '0' if the
+# request is allowed.
+#
+# KEYS[1]: the key of the limit's theoretical arrival time
+# ARGV[1]: the current time
+# ARGV[2]: the number of requests allowed in a period
+# ARGV[3]: the length of the period
+_RATE_LIMIT_SCRIPT = Script(None, b"""
+local now = tonumber(ARGV[1])
+local period = tonumber(ARGV[3])
+local tat = tonumber(redis.call('GET', KEYS[1]) or ARGV[1])
+if tat < now then
+    tat = now
+end
+tat = tat + period / tonumber(ARGV[2])
+if tat - now > period then
+    return tostring(tat - now - period)
+end
+redis.call('SET', KEYS[1], string.format('%.6f', tat),
+           'PX', math.ceil((tat - now) * 1000))
+return '0'
+""")
+
+
+class RedisRateStore(AbstractRateStore):
+    """
+    A storage class for :class:`~findig.tools.ratelimit.RateLimiter`
+    that keeps its state in Redis, so that every process (on every host)
+    that serves the application enforces the same limits::
+
+        limiter = RateLimiter(app, storage=RedisRateStore())
+
+    Each request is checked with a single script call, and the state of
+    a limit expires as soon as it allows a full burst again.
+
+    :param client: A :class:`redis.StrictRedis` instance to use. If not
+        given, the client of the application's :class:`RedisPool` is
+        used, or a client shared by the process if there isn't one.
+    :param key: The prefix for the keys that limits are stored under.
+        The default is ``findig:ratelimit``.
+    """
+
+    def __init__(self, client=None, key='findig:ratelimit'):
+        self.client = client
+        self.key = key
+
+    @property
+    def r(self):
+        return _default_client() if self.client is None else self.client
+
+    def acquire(self, key, n, period):
+        wait = _RATE_LIMIT_SCRIPT(["{}:{}".format(self.key, key)],
+                                  [repr(time()), n, period], self.r)
+        return float(wait)
+
+    def __repr__(self):
+        return "<redis-rate-store({!r})>".format(self.key)
+
+
+__all__ = ["RedisPool", "RedisSet", "AsyncRedisSet", "ReprCodec", "JSONCodec",
+           "PickleCodec", "RedisHitLog", "RedisRateStore"]
\ No newline at end of file
@@ -1,17 +1,27 @@
 """
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from itertools import cycle
+from threading import Lock
+from time import monotonic
+import operator
+import weakref
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql.expression import desc
+from sqlalchemy.sql.expression import and_, desc, not_, or_
 from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import BadRequest
+from werkzeug.local import LocalProxy
 
 from findig.context import ctx
-from findig.tools.dataset import MutableDataSet, MutableRecord, FilteredDataSet
+from findig.tools.asyncdataset import AsyncMutableDataSetAdapter
+from findig.tools.dataset import (MutableDataSet, MutableRecord,
+                                  FilteredDataSet, RecordSchema, CompactRecord,
+                                  FilterExpression, Comparison, And, Or, Not)
 from findig.utils import to_snake_case
 
 
@@ -30,11 +40,35 @@ class _MappedObjMixin:
             return "<{}>".join(clsname)
 
 class SQLA:
+    """
+    SQLA(engine, autocommit=False, autoflush=True, auto_create=True, app=None, replicas=(), replica_policy='round-robin', sticky_for=5)
+
+    Manage the SQLAlchemy sessions used by an application.
+
+    :param engine: The engine (or database URL) for the primary database.
+    :param replicas: A sequence of engines (or database URLs) for read
+        replicas of the primary database. ``GET`` and ``HEAD`` requests
+        read from a replica, unless they are sticky (see below); every
+        other request uses the primary.
+    :param replica_policy: How a replica is chosen for a request; either
+        ``'round-robin'``, ``'least-busy'`` (the replica with the fewest
+        sessions open by this object), or a function that takes the list
+        of replica engines and returns one of them.
+    :param sticky_for: The number of seconds that a client reads from the
+        primary after it writes to it, so that it sees its own writes
+        while they replicate. Clients are told apart by their remote
+        address. A request that writes to the primary always reads from
+        it for the rest of the request.
+
+    Data sets and records always write through the primary session,
+    which is available as :attr:`primary_session`.
+    """
     # NOTE ABOUT AUTO-CREATE: it does *not* update a table schema that
     # changes in code to the database side; those changes will have to be
     # manually applied on the database server.
     def __init__(self, engine, autocommit=False, autoflush=True, 
-                 auto_create=True, app=None):
+                 auto_create=True, app=None, replicas=(),
+                 replica_policy='round-robin', sticky_for=5):
         # Create an SQLAlchemy engine for the database
         if isinstance(engine, str):
             engine = create_engine(engine)
@@ -46,17 +80,48 @@ class SQLA:
         self._auto_create = auto_create
         self.Base = declarative_base(bind=engine, cls=_MappedObjMixin)
 
+        self.replicas = [create_engine(r) if isinstance(r, str) else r
+                         for r in replicas]
+        self._replica_cls = sessionmaker(autocommit=autocommit,
+                                         autoflush=autoflush)
+        self._replica_policy = replica_policy
+        self._replica_cycle = cycle(self.replicas)
+        self._replica_load = {id(r): 0 for r in self.replicas}
+        self._sticky_for = sticky_for
+        self._sticky_until = {}
+        self._lock = Lock()
+
+        # Remember which sessions wrote to the primary, so that the
+        # client can be routed to the primary until the write has had
+        # time to reach the replicas.
+        event.listen(self._session_cls, 'after_flush', self._on_flush)
+        event.listen(self._session_cls, 'after_commit', self._on_commit)
+
         if app is not None:
             self.attach_to(app)
 
     def attach_to(self, app):
-        # This request context manager creates a session at the start
-        # of the request, and closes it at the end.
+        # This request context manager provides the sessions for the 
+        # request, and closes them at the end. Sessions aren't created
+        # until they're first used, so requests that never touch the
+        # database don't pay for one (or for a connection from the pool).
+        @app.context
+        def sqla_sessions():
+            sessions = _RequestSessions(self)
+            yield sessions
+            sessions.close()
+
+        # These proxies look up the session every time they're used, so
+        # a request that writes to the primary switches over to it.
         @app.context
         def sqla_session():
-            session = self._session_cls()
-            yield session
-            session.close()
+            sessions = ctx.sqla_sessions
+            yield LocalProxy(lambda: sessions.session)
+
+        @app.context
+        def sqla_primary_session():
+            sessions = ctx.sqla_sessions
+            yield LocalProxy(lambda: sessions.primary)
 
         if self._auto_create:
             app.startup_hook(self.create_all)
@@ -66,10 +131,12 @@ class SQLA:
 
     def configure_session_factory(self, **kwargs):
         self._session_cls.configure(**kwargs)
+        self._replica_cls.configure(**kwargs)
 
     @contextmanager
     def transaction(self, new_session=False, auto_rollback=True):
-        session = self._session_cls() if new_session else self.session
+        session = self._session_cls() if new_session \
+                  else self.primary_session
 
         try:
             yield session
@@ -83,11 +150,148 @@ class SQLA:
 
     @property
     def session(self):
-        """Return the SQL Alchemy session for the current request."""
+        """
+        Return the SQL Alchemy session for the current request.
+
+        The session is created the first time that it is used during the
+        request. It reads from a replica if the request is routed to one.
+        """
         return ctx.sqla_session
 
+    @property
+    def primary_session(self):
+        """
+        Return the SQL Alchemy session for the current request that is
+        bound to the primary database.
+        """
+        return ctx.sqla_primary_session
+
+    def _choose_replica(self):
+        if callable(self._replica_policy):
+            return self._replica_policy(self.replicas)
+        with self._lock:
+            if self._replica_policy == 'least-busy':
+                return min(self.replicas,
+                           key=lambda r: self._replica_load[id(r)])
+            else:
+                return next(self._replica_cycle)
+
+    def _track_replica(self, replica, delta):
+        with self._lock:
+            if id(replica) in self._replica_load:
+                self._replica_load[id(replica)] += delta
+
+    def _is_sticky(self, client):
+        with self._lock:
+            until = self._sticky_until.get(client)
+            if until is not None and until <= monotonic():
+                del self._sticky_until[client]
+                until = None
+            return until is not None
+
+    def _on_flush(self, session, flush_context):
+        session.info['sqla_wrote'] = True
+
+    def _on_commit(self, session):
+        if not session.info.pop('sqla_wrote', False):
+            return
+
+        sessions = session.info.get('sqla_request')
+        if sessions is None:
+            return
+
+        sessions.wrote = True
+        if self._sticky_for > 0 and sessions.client is not None:
+            now = monotonic()
+            with self._lock:
+                if len(self._sticky_until) >= 1024:
+                    # Forget about clients whose windows have passed.
+                    self._sticky_until = {
+                        client: until for client, until
+                        in self._sticky_until.items() if until > now
+                    }
+                self._sticky_until[sessions.client] = now + self._sticky_for
+
+
+class _RequestSessions:
+    # The sessions used during a single request.
+    def __init__(self, sqla):
+        self.sqla = sqla
+        self._primary = None
+        self._replica = None
+        self._replica_engine = None
+
+        request = getattr(ctx, 'request', None)
+        self.client = None if request is None else request.remote_addr
+        self.wrote = False
+        self.read_only = request is not None \
+                         and request.method in ('GET', 'HEAD')
+        self._executor = None
+
+    @property
+    def primary(self):
+        if self._primary is None:
+            self._primary = self.sqla._session_cls(
+                info={'sqla_request': self})
+        return self._primary
+
+    @property
+    def session(self):
+        if not self.sqla.replicas or not self.read_only or self.wrote \
+           or self.client is not None and self.sqla._is_sticky(self.client):
+            return self.primary
+
+        if self._replica is None:
+            self._replica_engine = self.sqla._choose_replica()
+            self.sqla._track_replica(self._replica_engine, 1)
+            self._replica = self.sqla._replica_cls(bind=self._replica_engine)
+        return self._replica
+
+    @property
+    def executor(self):
+        # The thread that asynchronous data sets use the sessions from;
+        # sessions can't be used by more than one thread at a time.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1)
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            # Let queued database calls finish before the sessions close
+            self._executor.shutdown()
+        if self._primary is not None:
+            self._primary.close()
+        if self._replica is not None:
+            self._replica.close()
+            self.sqla._track_replica(self._replica_engine, -1)
+
 
 class SQLASet(MutableDataSet):
+    """
+    SQLASet(orm_cls, session=None, compact=False, batch_size=None, primary_session=None)
+
+    A data set whose items are the rows of a mapped class.
+
+    :param orm_cls: The mapped class whose rows make up the data set.
+    :param session: The session used to query the database. If not
+        given, the session for the current request is used.
+    :param compact: If true, iterating through the data set produces
+        read-only :class:`~findig.tools.dataset.CompactRecord` instances
+        that share a schema (which may be given instead of ``True``),
+        and hold no references to ORM objects.
+    :param batch_size: If given, the number of rows fetched from the
+        database at a time while the data set is iterated. Rows are then
+        streamed (with a server-side cursor, where the database driver
+        supports one), so records are produced before the whole result
+        has been read, and the objects for rows that have been consumed
+        can be released. Since the cursor stays open on the session,
+        records must not be edited or deleted while a streamed data set
+        is being iterated. By default, all of the rows are loaded before
+        the first record is produced.
+    :param primary_session: The session used to write to the database.
+        If not given, it's the same as *session*, or the primary session
+        for the current request (see :class:`SQLA`) if neither is given.
+    """
     class InvalidField(BadRequest):
         pass
 
@@ -96,27 +300,44 @@ class SQLASet(MutableDataSet):
             self.inner = e
             super().__init__()
 
-    def __init__(self, orm_cls):
+    def __init__(self, orm_cls, session=None, compact=False, batch_size=None,
+                 primary_session=None):
         self._cls = orm_cls
+        self._session = session
+        self._primary_session = session if primary_session is None \
+                                else primary_session
         self._modifiers = []
+        self._batch_size = batch_size
+
+        if compact is True:
+            compact = RecordSchema(c.name for c in orm_cls.__table__.columns)
+        self._schema = compact or None
 
     def __iter__(self):
-        query = ctx.sqla_session.query(self._cls)
-        for modifier in self._modifiers:
-            mod_name, *args = modifier
-            if mod_name == "filter":
-                filters, filter_by = args
-                query = self._filter_query(query, filters, filter_by)
-            if mod_name == "sort":
-                for field in args:
-                    query = query.order_by(field)
-            if mod_name == "limit":
-                count, offset = args
-                if offset:
-                    query = query.offset(offset)
-                query = query.limit(count)
-        
-        yield from map(_SQLRecord, query.all())
+        query = self._build_query()
+        if self._batch_size is None:
+            query = query.all()
+        else:
+            query = query.yield_per(self._batch_size)
+
+        if self._schema is None:
+            yield from map(self._make_record, query)
+        else:
+            fields = self._schema.fields
+            for obj in query:
+                yield CompactRecord(
+                    self._schema,
+                    tuple(getattr(obj, field) for field in fields)
+                )
+
+    def count(self):
+        # Ordering doesn't change the count, so it's left out of the
+        # query sent to the database.
+        return self._build_query(sort=False).count()
+
+    def exists(self):
+        query = self._build_query(sort=False)
+        return self.session.query(query.exists()).scalar()
 
     def add(self, data):
         data = data.to_dict() if isinstance(data, MultiDict) else data
@@ -125,10 +346,11 @@ class SQLASet(MutableDataSet):
         except TypeError:
             raise self.InvalidField
 
-        ctx.sqla_session.add(obj)
+        session = self.primary_session
+        session.add(obj)
 
         try:
-            ctx.sqla_session.commit()
+            session.commit()
         except Exception as e:
             raise self.CommitError(e)
         
@@ -136,7 +358,8 @@ class SQLASet(MutableDataSet):
         return {c.name:getattr(obj, c.name) for c in key}
 
     def copy(self):
-        copy = SQLSet(self._cls)
+        copy = SQLASet(self._cls, self._session, self._schema or False,
+                       self._batch_size, self._primary_session)
         copy._modifiers = self._modifiers[:]
         return copy
 
@@ -157,24 +380,163 @@ class SQLASet(MutableDataSet):
         return copy
 
     def fetch_now(self, *args, **kwargs):
-        query = ctx.sqla_session.query(self._cls)
+        query = self.session.query(self._cls)
         query = self._filter_query(query, *args, **kwargs)
         obj = query.first()
         if obj is None:
             raise LookupError("No matching records.")
         else:
-            return _SQLRecord(obj)
+            return self._make_record(obj)
+
+    @property
+    def session(self):
+        """
+        The session used by the data set; unless one was given to the
+        constructor, this is the session for the current request.
+        """
+        return ctx.sqla_session if self._session is None else self._session
+
+    @property
+    def primary_session(self):
+        """
+        The session that the data set writes through; unless one was
+        given to the constructor, this is the session for the current
+        request that is bound to the primary database.
+        """
+        if self._primary_session is None:
+            return ctx.sqla_primary_session
+        else:
+            return self._primary_session
+
+    def _make_record(self, obj):
+        return _SQLRecord(obj, self._primary_session)
         
+    def _build_query(self, sort=True):
+        query = self.session.query(self._cls)
+        for modifier in self._modifiers:
+            mod_name, *args = modifier
+            if mod_name == "filter":
+                filters, filter_by = args
+                query = self._filter_query(query, *filters, **filter_by)
+            if mod_name == "sort" and sort:
+                for field in args[0]:
+                    query = query.order_by(field)
+            if mod_name == "limit":
+                count, offset = args
+                if offset:
+                    query = query.offset(offset)
+                query = query.limit(count)
+        return query
+
     def _filter_query(self, query, *filter_args, **filter_by):
         query = query.filter_by(**filter_by)
         for arg in filter_args:
+            if isinstance(arg, FilterExpression):
+                arg = self._compile_filter(arg)
             query = query.filter(arg)
         return query
 
+    def _compile_filter(self, expr):
+        # Translate a filter expression into an SQL clause.
+        if isinstance(expr, And):
+            return and_(*map(self._compile_filter, expr.terms))
+        elif isinstance(expr, Or):
+            return or_(*map(self._compile_filter, expr.terms))
+        elif isinstance(expr, Not):
+            return not_(self._compile_filter(expr.term))
+        elif not isinstance(expr, Comparison):
+            raise TypeError("Unsupported filter expression: {!r}".format(expr))
+
+        columns = self._cls.__table__.columns
+        if expr.field not in columns:
+            raise self.InvalidField
+        column, op, value = columns[expr.field], expr.op, expr.value
+
+        if value is None and op in ('eq', 'ne'):
+            return column.is_(None) if op == 'eq' else column.isnot(None)
+        elif op == 'ne':
+            # A missing value counts as "not equal", as it does for
+            # other data sets.
+            return or_(column.is_(None), column != value)
+        elif op == 'in':
+            clause = column.in_(value)
+        elif op == 'startswith':
+            clause = column.startswith(value, autoescape=True)
+        else:
+            clause = _SQL_OPS[op](column, value)
+
+        # Comparisons with NULL are NULL rather than false, which would
+        # make a negated comparison drop rows that it should match.
+        if column.nullable:
+            clause = and_(column.isnot(None), clause)
+        return clause
+
+
+_SQL_OPS = {
+    'eq': operator.eq,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+}
+
+
+class AsyncSQLASet(AsyncMutableDataSetAdapter):
+    """
+    An asynchronous counterpart to :class:`SQLASet`.
+
+    :param orm_cls: The mapped class whose rows make up the data set.
+    :param session: The session used to query the database. If not
+        given, the session for the current request is used.
+    :param executor: An :class:`concurrent.futures.Executor` that
+        database calls are run in. SQLAlchemy sessions can't be used by
+        more than one thread at a time, so by default the data sets that
+        share a session share a single worker thread too (which is shut
+        down at the end of the request, for the request's sessions).
+    :param batch_size: The number of records read at a time while the
+        data set is iterated.
+    """
+    def __init__(self, orm_cls, session=None, executor=None, batch_size=100):
+        # The request's sessions are looked up here, since the executor's
+        # threads can't see the request context.
+        if session is None:
+            session, primary = ctx.sqla_session, ctx.sqla_primary_session
+            if executor is None:
+                executor = ctx.sqla_sessions.executor
+        else:
+            primary = session
+            if executor is None:
+                executor = _session_executor(session)
+        super().__init__(SQLASet(orm_cls, session, primary_session=primary),
+                         executor, batch_size)
+
+
+_session_executors = weakref.WeakKeyDictionary()
+_session_executors_lock = Lock()
+
+
+def _session_executor(session):
+    # The thread that asynchronous data sets use a session from, which
+    # is shut down once the session is garbage collected.
+    with _session_executors_lock:
+        if session not in _session_executors:
+            executor = ThreadPoolExecutor(1)
+            _session_executors[session] = executor
+            weakref.finalize(session, executor.shutdown, wait=False)
+        return _session_executors[session]
+
 
 class _SQLRecord(MutableRecord):
-    def __init__(self, obj):
+    def __init__(self, obj, session=None):
         self._obj = obj
+        self._session = session
+
+    @property
+    def primary_session(self):
+        if self._session is None:
+            return ctx.sqla_primary_session
+        else:
+            return self._session
 
     def read(self):
         d  = {}
@@ -183,20 +545,37 @@ class _SQLRecord(MutableRecord):
         return d
 
     def patch(self, add_data, remove_fields):
+        session = self.primary_session
+        obj = self._primary_obj(session)
         try:
             for field in remove_fields:
-                setattr(self._obj, field, None)
+                setattr(obj, field, None)
         
             for k, v in add_data.items():
-                setattr(self._obj, k, v)
+                setattr(obj, k, v)
 
-            ctx.sqla_session.commit()
+            session.commit()
         except AttributeError:
             raise SQLASet.InvalidField
+        else:
+            self.invalidate()
 
     def delete(self):
-        ctx.sqla_session.delete(self._obj)
-        ctx.sqla_session.commit()
-
-
-__all__ = ["SQLA", "SQLASet"]
\ No newline at end of file
+        session = self.primary_session
+        session.delete(self._primary_obj(session))
+        session.commit()
+
+    def _primary_obj(self, session):
+        # The object may have been loaded from a replica, in which case
+        # the primary's copy is loaded to be changed instead. It isn't
+        # merged, since the replica's copy might be stale.
+        if self._obj not in session:
+            obj = session.query(type(self._obj)).get(
+                inspect(self._obj).identity)
+            if obj is None:
+                raise LookupError("No matching records.")
+            self._obj = obj
+        return self._obj
+
+
+__all__ = ["SQLA", "SQLASet", "AsyncSQLASet"]
\ No newline at end of file
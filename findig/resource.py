@@ -4,7 +4,7 @@ import functools
 import inspect
 import itertools
 import uuid
-from collections.abc import Mapping
+from collections.abc import Mapping, Sized
 from functools import partial
 
 from werkzeug.exceptions import MethodNotAllowed, NotFound
@@ -14,6 +14,7 @@ from werkzeug.utils import cached_property, validate_arguments
 from findig.content import ErrorHandler, Formatter, Parser
 from findig.context import url_adapter, request, ctx
 from findig.data_model import DataModel, DataSetDataModel, DictDataModel
+from findig.tools.dataset import AbstractDataSet
 
 
 class AbstractResource(metaclass=abc.ABCMeta):
@@ -313,7 +314,7 @@ class Resource(AbstractResource):
 
 class Collection(Resource):
     """
-    Collection(of, include_urls=False, bindargs=None, **keywords)
+    Collection(of, include_urls=False, include_count=False, bindargs=None, **keywords)
 
     A :class:`Resource` that acts as a collection of other resources.
 
@@ -325,15 +326,27 @@ class Collection(Resource):
         in its fields to build a url (i.e., if the URL for the child
         contains an ``:id`` fragment, then the child must have an id
         field, which is then used to build its URL.
+    :param include_count: If ``True``, responses to GET requests will
+        include a header (named by :attr:`count_header`) with the total
+        number of items in the collection. If the collection is an
+        :class:`~findig.tools.dataset.AbstractDataSet`, the total is
+        retrieved with its
+        :meth:`~findig.tools.dataset.AbstractDataSet.count` method.
     :param bindargs: A dictionary mapping field names to URL variables.
         For example: a child resource may have the URL variable ``:id``,
         but have a corresponding field named ``user_id``; the appropriate
         value for *bindargs* in this case would be ``{'user_id': 'id'}``.
 
     """
+
+    #: The name of the response header that carries the total number of
+    #: items in the collection, if *include_count* is set.
+    count_header = 'X-Total-Count'
+
     def __init__(self, of, **args):
         super(Collection, self).__init__(**args)
         self.include_urls = args.pop('include_urls', False)
+        self.include_count = args.pop('include_count', False)
         bindargs = args.pop('bindargs', {})
         self.collects = collections.namedtuple(
             "collected_resource", "resource binding")(of, bindargs)
@@ -368,11 +381,24 @@ class Collection(Resource):
             if url is not None:
                 ctx.response['headers'].setdefault('Location', url)
 
-        elif method == 'GET' and self.include_urls:
-            ret = map(self._include_url_in_item, ret)
+        elif method == 'GET':
+            if self.include_count:
+                total = self._count_items(ret)
+                if total is not None:
+                    ctx.response['headers'].setdefault(self.count_header,
+                                                       str(total))
+
+            if self.include_urls:
+                ret = map(self._include_url_in_item, ret)
 
         return ret
 
+    def _count_items(self, items):
+        if isinstance(items, AbstractDataSet):
+            return items.count()
+        elif isinstance(items, Sized):
+            return len(items)
+
     def _include_url_in_item(self, item):
         url = self._try_build_item_url(item)
         if url is not None:
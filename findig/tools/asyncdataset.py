@@ -0,0 +1,429 @@
+"""
+The :mod:`findig.tools.asyncdataset` module defines an asynchronous
+counterpart to the data set protocol in :mod:`findig.tools.dataset`,
+for use with :mod:`asyncio`.
+
+Asynchronous data sets are iterated with ``async for``, and their
+methods that talk to the backend are coroutines. Any synchronous data
+set can be used asynchronously by wrapping it with
+:class:`AsyncDataSetAdapter` (which runs backend calls in an executor),
+and any asynchronous data set can be used wherever Findig expects a
+synchronous one by wrapping it with :class:`SyncDataSetAdapter`.
+
+This makes it possible to overlap the latency of several backends from
+inside an ordinary resource function::
+
+    @app.route("/dashboard")
+    def dashboard():
+        async def counts():
+            return await asyncio.gather(
+                AsyncRedisSet('tasks').count(),
+                AsyncSQLASet(User).count(),
+            )
+
+        tasks, users = run_sync(counts())
+        return {'tasks': tasks, 'users': users}
+
+Since :func:`run_sync` runs the coroutine on an event loop of its own,
+the calls are gathered inside a coroutine (rather than passing the
+future that :func:`asyncio.gather` returns), so that they're scheduled
+on that loop.
+
+.. note:: This module requires Python 3.5 or later.
+
+"""
+
+from abc import ABCMeta, abstractmethod
+from collections.abc import Mapping
+from contextlib import contextmanager
+from itertools import islice
+import asyncio
+
+from findig.tools.dataset import (FilteredDataSet, MutableDataSet,
+                                  MutableRecord, OrderedDataSet,
+                                  AbstractDataSet, AbstractRecord)
+
+
+class AsyncDataSet(metaclass=ABCMeta):
+    """
+    An asynchronous representation of a collection of items.
+
+    Concrete implementations must provide *at least* an implementation
+    for ``__aiter__``, which should return an asynchronous iterator of
+    :class:`AsyncRecord` instances.
+    """
+
+    @abstractmethod
+    def __aiter__(self):
+        """Return an asynchronous iterator of the set's records."""
+
+    async def fetch_now(self, **search_spec):
+        """
+        Fetch an :class:`AsyncRecord` matching the search specification.
+        """
+        async for record in self:
+            if FilteredDataSet.check_match(record, search_spec):
+                return record
+        else:
+            raise LookupError("No matching item found.")
+
+    async def count(self):
+        """Return the number of items in the data set."""
+        total = 0
+        async for _ in self:
+            total += 1
+        return total
+
+    async def exists(self):
+        """Return ``True`` if the data set contains at least one item."""
+        async for _ in self:
+            return True
+        else:
+            return False
+
+    def filtered(self, *expressions, **search_spec):
+        """
+        Return a filtered view of this data set. See
+        :meth:`findig.tools.dataset.AbstractDataSet.filtered`.
+        """
+        async def view():
+            async for record in self:
+                if FilteredDataSet.check_match(record, search_spec,
+                                               expressions):
+                    yield record
+        return _AsyncView(view)
+
+    def limit(self, count, offset=0):
+        """
+        Return a limited version of this data set. See
+        :meth:`findig.tools.dataset.AbstractDataSet.limit`.
+        """
+        async def view():
+            index = 0
+            async for record in self:
+                if index >= offset + count:
+                    break
+                elif index >= offset:
+                    yield record
+                index += 1
+        return _AsyncView(view)
+
+    def sorted(self, *sort_spec, descending=False):
+        """
+        Return a sorted view of this data set. See
+        :meth:`findig.tools.dataset.AbstractDataSet.sorted`.
+        """
+        async def view():
+            records = [record async for record in self]
+            records.sort(key=OrderedDataSet.make_key(*sort_spec),
+                         reverse=descending)
+            for record in records:
+                yield record
+        return _AsyncView(view)
+
+
+class AsyncMutableDataSet(AsyncDataSet):
+    """
+    An asynchronous data set that can add new child elements.
+    """
+
+    @abstractmethod
+    async def add(self, data):
+        """Add a new child item to the data set."""
+
+
+class AsyncRecord(Mapping):
+    """
+    An asynchronous representation of an item belonging to a collection.
+
+    Since the mapping interface can't wait on the backend, the record's
+    data must have been read by the time that the record is produced
+    by its data set.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+    def __iter__(self):
+        yield from self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class AsyncMutableRecord(AsyncRecord, metaclass=ABCMeta):
+    """
+    An asynchronous record that can update or delete itself.
+    """
+
+    @abstractmethod
+    async def patch(self, add_data, remove_fields, **kwargs):
+        """Update the record's data with the new data."""
+
+    @abstractmethod
+    async def delete(self):
+        """Delete the record's data."""
+
+
+class _AsyncView(AsyncDataSet):
+    def __init__(self, func):
+        self.func = func
+
+    def __aiter__(self):
+        return self.func()
+
+
+class AsyncDataSetAdapter(AsyncDataSet):
+    """
+    An asynchronous data set that wraps a synchronous one.
+
+    :param dataset: The data set that is wrapped.
+    :type dataset: :class:`~findig.tools.dataset.AbstractDataSet`
+    :param executor: An :class:`concurrent.futures.Executor` that
+        backend calls are run in. If not given, the event loop's default
+        executor is used.
+    :param batch_size: The number of records read from the wrapped data
+        set at a time while it is iterated.
+
+    If *dataset* is a :class:`~findig.tools.dataset.MutableDataSet`,
+    then the adapter is an :class:`AsyncMutableDataSet` as well.
+    """
+
+    def __new__(cls, dataset, *args, **kwargs):
+        if cls is AsyncDataSetAdapter and isinstance(dataset, MutableDataSet):
+            cls = AsyncMutableDataSetAdapter
+        return super().__new__(cls)
+
+    def __init__(self, dataset, executor=None, batch_size=100):
+        self.ds = dataset
+        self.executor = executor
+        self.batch_size = batch_size
+
+    def __repr__(self):
+        return "<async({!r})>".format(self.ds)
+
+    async def __aiter__(self):
+        records = iter(self.ds)
+        while True:
+            batch = await self._run(self._read_batch, records)
+            for record in batch:
+                yield record
+            if len(batch) < self.batch_size:
+                break
+
+    async def fetch_now(self, **search_spec):
+        return await self._run(
+            lambda: self._wrap(self.ds.fetch_now(**search_spec)))
+
+    async def count(self):
+        return await self._run(self.ds.count)
+
+    async def exists(self):
+        return await self._run(self.ds.exists)
+
+    def filtered(self, *args, **search_spec):
+        return self._view(self.ds.filtered(*args, **search_spec))
+
+    def limit(self, count, offset=0):
+        return self._view(self.ds.limit(count, offset=offset))
+
+    def sorted(self, *sort_spec, descending=False):
+        return self._view(self.ds.sorted(*sort_spec, descending=descending))
+
+    def _view(self, dataset):
+        return AsyncDataSetAdapter(dataset, self.executor, self.batch_size)
+
+    def _read_batch(self, records):
+        # Reading the records' data here keeps the backend I/O inside
+        # the executor.
+        return [self._wrap(r) for r in islice(records, self.batch_size)]
+
+    def _wrap(self, record):
+        if isinstance(record, MutableRecord):
+            return _AsyncRecordAdapter(record, self._run)
+        else:
+            return AsyncRecord(dict(record))
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+
+class AsyncMutableDataSetAdapter(AsyncDataSetAdapter, AsyncMutableDataSet):
+    """
+    An :class:`AsyncDataSetAdapter` that wraps a
+    :class:`~findig.tools.dataset.MutableDataSet`.
+
+    This class doesn't need to be used directly;
+    :class:`AsyncDataSetAdapter` picks it automatically when it wraps a
+    mutable data set.
+    """
+
+    async def add(self, data):
+        return await self._run(self.ds.add, data)
+
+
+class _AsyncRecordAdapter(AsyncMutableRecord):
+    def __init__(self, record, run):
+        super().__init__(dict(record))
+        self.record = record
+        self.run = run
+
+    async def patch(self, add_data, remove_fields, **kwargs):
+        def patch():
+            self.record.patch(add_data, remove_fields, **kwargs)
+            return dict(self.record)
+        self.data = await self.run(patch)
+
+    async def delete(self):
+        await self.run(self.record.delete)
+
+
+class SyncDataSetAdapter(AbstractDataSet):
+    """
+    A synchronous data set that wraps an asynchronous one.
+
+    :param dataset: The data set that is wrapped.
+    :type dataset: :class:`AsyncDataSet`
+    :param loop: An event loop running in another thread, that the
+        wrapped data set's coroutines should be run on. If not given,
+        the adapter runs them on a private event loop.
+
+    If *dataset* is an :class:`AsyncMutableDataSet`, then the adapter
+    is a :class:`~findig.tools.dataset.MutableDataSet` as well.
+    """
+
+    def __new__(cls, dataset, *args, **kwargs):
+        if cls is SyncDataSetAdapter \
+           and isinstance(dataset, AsyncMutableDataSet):
+            cls = SyncMutableDataSetAdapter
+        return super().__new__(cls)
+
+    def __init__(self, dataset, loop=None):
+        self.ds = dataset
+        self.loop = loop
+
+    def __repr__(self):
+        return "<sync({!r})>".format(self.ds)
+
+    def __iter__(self):
+        # The whole iteration is run on one event loop, so that the 
+        # wrapped data set's asynchronous iterator can be stepped
+        # through lazily.
+        with _event_loop(self.loop) as run:
+            records = self.ds.__aiter__()
+            while True:
+                try:
+                    record = run(records.__anext__())
+                except StopAsyncIteration:
+                    break
+                else:
+                    yield self._wrap(record)
+
+    def fetch_now(self, **search_spec):
+        return self._wrap(self._run(self.ds.fetch_now(**search_spec)))
+
+    def count(self):
+        return self._run(self.ds.count())
+
+    def exists(self):
+        return self._run(self.ds.exists())
+
+    def filtered(self, *args, **search_spec):
+        return self._view(self.ds.filtered(*args, **search_spec))
+
+    def limit(self, count, offset=0):
+        return self._view(self.ds.limit(count, offset=offset))
+
+    def sorted(self, *sort_spec, descending=False):
+        return self._view(self.ds.sorted(*sort_spec, descending=descending))
+
+    def _view(self, dataset):
+        return SyncDataSetAdapter(dataset, self.loop)
+
+    def _wrap(self, record):
+        if isinstance(record, AsyncMutableRecord):
+            return _SyncRecordAdapter(record, self._run)
+        else:
+            return _SyncRecord(record)
+
+    def _run(self, coro):
+        return run_sync(coro, self.loop)
+
+
+class SyncMutableDataSetAdapter(SyncDataSetAdapter, MutableDataSet):
+    """
+    A :class:`SyncDataSetAdapter` that wraps an
+    :class:`AsyncMutableDataSet`.
+
+    This class doesn't need to be used directly;
+    :class:`SyncDataSetAdapter` picks it automatically when it wraps a
+    mutable data set.
+    """
+
+    def add(self, data):
+        return self._run(self.ds.add(data))
+
+
+class _SyncRecord(AbstractRecord):
+    def __init__(self, record):
+        self.record = record
+
+    def read(self):
+        return dict(self.record)
+
+
+class _SyncRecordAdapter(MutableRecord, _SyncRecord):
+    def __init__(self, record, run):
+        self.record = record
+        self.run = run
+
+    def patch(self, add_data, remove_fields, **kwargs):
+        self.run(self.record.patch(add_data, remove_fields, **kwargs))
+        self.invalidate()
+
+    def delete(self):
+        self.run(self.record.delete())
+
+
+def run_sync(coro, loop=None):
+    """
+    Run a coroutine to completion from synchronous code, and return its
+    result. Futures (like the one returned by :func:`asyncio.gather`)
+    belong to the loop that they were created on, so they should be
+    awaited inside the coroutine instead of being passed in.
+
+    :param loop: An event loop running in another thread, that the
+        coroutine should be run on. If not given, the coroutine is run
+        on a new event loop.
+    """
+    with _event_loop(loop) as run:
+        return run(coro)
+
+
+@contextmanager
+def _event_loop(loop=None):
+    # Yield a function that runs a coroutine to completion, either on
+    # a loop running in another thread, or on a temporary loop.
+    if loop is not None:
+        yield lambda coro: \
+            asyncio.run_coroutine_threadsafe(coro, loop).result()
+        return
+
+    loop = asyncio.new_event_loop()
+    try:
+        yield loop.run_until_complete
+    finally:
+        try:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+        finally:
+            loop.close()
+
+
+__all__ = ['AsyncDataSet', 'AsyncMutableDataSet', 'AsyncRecord',
+           'AsyncMutableRecord', 'AsyncDataSetAdapter',
+           'AsyncMutableDataSetAdapter', 'SyncDataSetAdapter',
+           'SyncMutableDataSetAdapter', 'run_sync']
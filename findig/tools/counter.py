@@ -6,19 +6,41 @@ count hits to a particular resource, or globally within the application.
 """
 
 from abc import ABCMeta, abstractmethod
+from array import array
+from ast import literal_eval
 from collections import Counter as PyCounter, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from itertools import chain, combinations
-from functools import partial, reduce, total_ordering
+from itertools import chain, combinations, count
+from functools import partial, total_ordering
+from hashlib import blake2b
 from numbers import Integral
-from threading import Lock
+from threading import Lock, local
+from time import time
+from urllib.parse import quote
 import heapq
+import math
+import mmap
+import os
 import pickle
+import stat
+import struct
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
 
 from werkzeug.utils import validate_arguments
 
 from findig.context import ctx
 
+
+#: A hit recorded by a log: the time it occurred, and a mapping of
+#: partition names to the groups it fell into.
+Hit = namedtuple('Hit', 'time partitions')
+
+
 class Counter:
     """
     A :class:`Counter` counter keeps track of hits (requests) made on an
@@ -32,7 +54,14 @@ class Counter:
     :type duration: :class:`datetime.timedelta` or int representing seconds.
     :param storage: A subclass of :class:`AbstractLog` that should be used
         to store hits. By default, the counter will use a thread-safe,
-        in-memory storage class.
+        in-memory storage class that records every hit;
+        :class:`BucketedHitLog` uses a fixed amount of memory instead, and
+        :class:`SketchHitLog` does too when there are many distinct
+        partition groups, and :class:`StripedHitLog` lets threads record
+        their hits without waiting on each other. To
+        count the hits served by several processes together, use
+        :class:`SharedMemoryHitLog` (on one host) or
+        :class:`findig.extras.redis.RedisHitLog`.
 
     """
 
@@ -40,13 +69,19 @@ class Counter:
 
     def __init__(self, app=None, duration=-1, storage=None):
         self.logs = {}
+        # Callbacks are indexed by when they're called, then by resource
+        # name (or None), then by the names of the partitions that they
+        # count hits by.
         self.callbacks = {
-            'before': {None:[]},
-            'after': {None:[]},
+            'before': {},
+            'after': {},
         }
         self.duration = duration
         self.partitioners = {}
         self.log_cls = _HitLog if storage is None else storage
+        # Every hit is also tracked in a log for the whole application,
+        # so that global counts don't have to be added up.
+        self.global_log = self.log_cls(duration, None)
 
         if app is not None:
             self.attach_to(app)
@@ -130,6 +165,28 @@ class Counter:
         else:
             return add_partitioner
 
+    def top(self, k):
+        """
+        Return a partition spec that matches the *k* most frequent groups
+        of a partition, for registering callbacks (see :meth:`every`).
+
+        Like :attr:`any`, it matches hits to any group, but only while
+        the group is one of the *k* groups with the most hits (see
+        :meth:`AbstractLog.top`)::
+
+            @counter.every(100, ip=counter.top(10))
+            def on_busy_client(ip):
+                pass
+
+        The ranking is checked for every hit that the callback counts,
+        so with a storage class whose :meth:`~AbstractLog.top` scans
+        every group (like the default), it's best kept to partitions
+        with few groups; :class:`SketchHitLog` keeps its ranking up to
+        date as hits are recorded, in a bounded amount of memory.
+
+        """
+        return _Top(k)
+
     def _register_cb(self, when, n, callback, args):
         allowed_args = ['until', 'after', 'resource']
         allowed_args.extend(self.partitioners)
@@ -138,8 +195,12 @@ class Counter:
                 raise TypeError("Unknown argument: {}".format(a))
 
         key = args.pop('resource').name if 'resource' in args else None
-        self.callbacks[when].setdefault(key, [])
-        self.callbacks[when][key].append((callback, n, args))
+        partby = {a: args[a] for a in args if a in self.partitioners}
+        cb = _Callback(callback, n, args.get('after', 0), args.get('until'),
+                       partby)
+
+        groups = self.callbacks[when].setdefault(key, {})
+        groups.setdefault(tuple(sorted(partby)), []).append(cb)
 
     def every(self, n, callback=None, **args):
         """
@@ -179,6 +240,10 @@ class Counter:
         of every 100th request of a particular method (every 100th GET,
         every 100th PUT, every 100th POST etc). 
         
+        Similarly, ``method=counter.top(3)`` would only count the
+        requests of the three most frequent methods (see :meth:`top`),
+        so that callbacks can react to heavy hitters as they emerge.
+
         Whenever partition specs are used to register callbacks,
         then the callback must take a named argument matching the
         partition name, which will contain the partition group for the
@@ -257,16 +322,15 @@ class Counter:
         *partition_mapping*) objects.
 
         :param resource: If given, only hits for this resource will be
-            retrieved.
+            retrieved. Otherwise, a read-only view of the hits to the
+            whole application is returned.
         """
         if resource is None:
-            return reduce(
-                lambda x,y: x + y, 
-                self.logs.values(), 
-                self.log_cls(self.duration, None)
-            )
+            return _CompositeLog(self.global_log)
         else:
-            self.logs.setdefault(resource.name, self.log_cls(self.duration, resource))
+            if resource.name not in self.logs:
+                self.logs[resource.name] = self.log_cls(self.duration,
+                                                        resource)
             return self.logs[resource.name]
 
     def __call__(self):
@@ -274,10 +338,14 @@ class Counter:
         request = ctx.request
         resource = ctx.resource
 
-        self.logs.setdefault(resource.name, self.log_cls(self.duration, resource))
+        # Storage classes can be costly to create, so a log is only
+        # created for a resource's first hit.
+        if resource.name not in self.logs:
+            self.logs[resource.name] = self.log_cls(self.duration, resource)
         hit_log = self.logs[resource.name]
         partitions = {name: func(request) for name, func in self.partitioners.items()}
         hit_log.track(partitions)
+        self.global_log.track(partitions)
 
         fire_callbacks = partial(self._fire_cb_funcs, hit_log, resource,
                                  partitions)
@@ -289,35 +357,84 @@ class Counter:
         fire_callbacks('after')
 
     def _fire_cb_funcs(self, hit_log, resource, partitions, group):
+        # Callbacks that weren't registered for a resource count the
+        # hits to the whole application.
         callbacks = self.callbacks[group]
-        callbacks.setdefault(resource.name, [])
-        callbacks = chain(callbacks[resource.name], callbacks[None])
-
-        #@counter.every(1, after=1000, method=any)
-
-        for cb_func, n, args in callbacks:
-            # {'ip': counter.any, 'method': 'PUT'}
-            partby = {a:args[a] for a in args if a in self.partitioners}
-            # {'ip': '255.215.213.32', 'method': 'GET'}
-            request_vals = {k:partitions[k] for k in partby}
-            count = hit_log.count(**request_vals)
-
-            if partby:
-                # Actually verify that the callback restrictions apply to
-                # this request
-                unmatched = [p for p,v in partby.items() 
-                             if not (v == self.any or v == partitions[p])]
-                if unmatched:
-                    continue
+        indexes = ((callbacks.get(resource.name), hit_log),
+                   (callbacks.get(None), self.global_log))
 
-            if 'until' in args and args['until'] < count:
+        for groups, log in indexes:
+            if not groups:
                 continue
 
-            if 'after' in args and count <= args['after']:
-                continue
+            for names, cbs in list(groups.items()):
+                matching = [cb for cb in cbs if cb.matches(partitions)]
+                if not matching:
+                    continue
+
+                # The hits are counted once for all of the callbacks
+                # that count by the same partitions.
+                request_vals = {name: partitions[name] for name in names}
+                count = log.count(**request_vals)
+
+                for cb in matching:
+                    if cb.fires(count) and cb.ranks(log, request_vals):
+                        cb.func(**request_vals)
 
-            if (count - args.get('after', 0) - 1) % n == 0:
-                cb_func(**request_vals)
+                if _seconds(self.duration) < 0:
+                    # Counts never go down, so callbacks that have
+                    # reached their limit can be dropped.
+                    spent = [cb for cb in matching if cb.spent(count)]
+                    if spent:
+                        groups[names] = [cb for cb in cbs
+                                         if cb not in spent]
+
+
+class _Callback:
+    __slots__ = 'func', 'n', 'after', 'until', 'partby', 'specific'
+
+    def __init__(self, func, n, after, until, partby):
+        self.func = func
+        self.n = n
+        self.after = after
+        self.until = until
+        self.partby = partby
+        # Whether the callback counts the hits to specific groups only
+        self.specific = not any(map(_wildcard, partby.values()))
+
+    def matches(self, partitions):
+        return all(_wildcard(v) or v == partitions[p]
+                   for p, v in self.partby.items())
+
+    def ranks(self, log, partitions):
+        # Whether the hit's groups are among the most frequent groups
+        # that the callback asks for.
+        return all(partitions[p] in [g for g, _ in log.top(p, v.k)]
+                   for p, v in self.partby.items() if isinstance(v, _Top))
+
+    def fires(self, count):
+        return self.after < count \
+               and (self.until is None or count <= self.until) \
+               and (count - self.after - 1) % self.n == 0
+
+    def spent(self, count):
+        # Whether the callback can no longer fire, given the count of
+        # the hits that it matches.
+        return self.specific and self.until is not None \
+               and count >= self.until
+
+
+class _Top:
+    # A partition spec that matches the k most frequent groups
+    __slots__ = 'k',
+
+    def __init__(self, k):
+        self.k = k
+
+
+def _wildcard(spec):
+    # Whether a partition spec can match more than one group
+    return spec is Counter.any or isinstance(spec, _Top)
 
 
 class AbstractLog(metaclass=ABCMeta):
@@ -375,6 +492,81 @@ class AbstractLog(metaclass=ABCMeta):
         :meth:`Counter.partition`.
         """
 
+    def distinct(self, partition):
+        """
+        Return the number of distinct groups of a partition that the
+        stored hits fall into (for example, the number of distinct
+        clients, if hits are partitioned by client address).
+
+        Storage classes may return an estimate. By default, the
+        estimate of :meth:`distinct_sketch` is returned.
+        """
+        return self.distinct_sketch(partition).count()
+
+    def distinct_sketch(self, partition):
+        """
+        Return a :class:`HyperLogLog` sketch of the groups of a partition
+        that the stored hits fall into. Sketches of several logs can be
+        merged to estimate the number of groups that their hits fall
+        into altogether.
+
+        By default, the sketch is built by iterating through the hits.
+        """
+        sketch = HyperLogLog()
+        for hit in self:
+            if partition in hit.partitions:
+                sketch.add(hit.partitions[partition])
+        return sketch
+
+    def top(self, partition, k):
+        """
+        Return the *k* groups of a partition that the most stored hits
+        fall into (for example, the busiest clients, if hits are
+        partitioned by client address), as a list of ``(group, count)``
+        pairs with the most frequent first.
+
+        Storage classes may return estimates. By default, the hits are
+        iterated through and counted. The default storage class,
+        :class:`BucketedHitLog` and :class:`SharedMemoryHitLog` rank the
+        exact counts that they keep for every group, so the time this
+        takes grows with the number of groups; only
+        :class:`SketchHitLog` keeps a bounded summary of the heavy
+        hitters, which is updated as hits are recorded.
+        """
+        counts = PyCounter(hit.partitions[partition] for hit in self
+                           if partition in hit.partitions)
+        return counts.most_common(k)
+
+    #: The options that the storage class was configured with (see
+    #: :meth:`configure`).
+    options = {}
+
+    @classmethod
+    def configure(cls, **options):
+        """
+        Return a subclass of this storage class whose instances are
+        created with *options* (which they find in :attr:`options`).
+
+        Since counters create their logs themselves, this is how options
+        are given to a storage class::
+
+            counter = Counter(app, duration=3600,
+                              storage=BucketedHitLog.configure(resolution=5))
+        """
+        return type(cls.__name__, (cls,),
+                    {'options': dict(cls.options, **options)})
+
+    # The options that a storage class accepts, and their defaults
+    _defaults = {}
+
+    def _read_options(self):
+        options = dict(self._defaults)
+        for name, value in self.options.items():
+            if name not in options:
+                raise TypeError("Unknown option: {}".format(name))
+            options[name] = value
+        return options
+
     def __add__(self, other):
         if isinstance(other, AbstractLog):
             return _CompositeLog(self, other)
@@ -384,13 +576,18 @@ class AbstractLog(metaclass=ABCMeta):
 
 class _CompositeLog(AbstractLog):
     # This isn't really a storage class so much as it's a convenience
-    # class for stitching logs together
-    def __init__(self, first, second, *others):
-        self._logs = [first, second]
-        self._logs.extend(others)
+    # class for stitching logs together. It's a read-only view, that
+    # reads from the logs as it's used rather than copying them.
+    def __init__(self, *logs):
+        self._logs = logs
 
     def __iter__(self):
-        yield from chain.from_iterable(self._logs)
+        # Each log's hits are in order, so they're merged as they're
+        # read. Hits without a time come first.
+        yield from heapq.merge(
+            *self._logs,
+            key=lambda hit: datetime.min if hit.time is None else hit.time
+        )
 
     def track(self, partitions):
         raise NotImplementedError("Composite log is read only.")
@@ -398,6 +595,38 @@ class _CompositeLog(AbstractLog):
     def count(self, **partitions):
         return sum(map(lambda l: l.count(**partitions), self._logs))
 
+    def distinct(self, partition):
+        if len(self._logs) == 1:
+            return self._logs[0].distinct(partition)
+        else:
+            return self.distinct_sketch(partition).count()
+
+    def distinct_sketch(self, partition):
+        sketch = HyperLogLog()
+        for log in self._logs:
+            sketch.update(log.distinct_sketch(partition))
+        return sketch
+
+    def top(self, partition, k):
+        if len(self._logs) == 1:
+            return self._logs[0].top(partition, k)
+
+        # The groups that are the most frequent in any of the logs are
+        # counted in all of them.
+        groups = {g for log in self._logs for g, _ in log.top(partition, k)}
+        return heapq.nlargest(
+            k, ((g, self.count(**{partition: g})) for g in groups),
+            key=lambda item: item[1])
+
+    def __len__(self):
+        return self.count()
+
+    def __add__(self, other):
+        if isinstance(other, AbstractLog):
+            return _CompositeLog(*self._logs, other)
+        else:
+            return NotImplemented
+
                 
 class _HitLog(AbstractLog):
     # This is a storage class that keep track of the hits that have
@@ -448,29 +677,31 @@ class _HitLog(AbstractLog):
             counter_key = tuple(sorted(partitions.items()))
             return self._counter[counter_key]
 
-    def __add__(self, other):
-        if isinstance(other, _HitLog):
-            if self._delta != other._delta:
-                return NotImplemented
-            else:
-                new_log = _HitLog(self._delta, None)
+    def distinct(self, partition):
+        return len(self._groups(partition))
 
-                new_log._hits.extend(self._hits)
-                new_log._hits.extend(other._hits)
-                heapq.heapify(new_log._hits)
+    def distinct_sketch(self, partition):
+        sketch = HyperLogLog()
+        for group in self._groups(partition):
+            sketch.add(group)
+        return sketch
 
-                new_log._counter.update(self._counter)
-                new_log._counter.update(other._counter)
-                
-                return new_log
+    def top(self, partition, k):
+        self._prune()
+        with self._thread_lock:
+            return _top(self._counter, partition, k)
 
-        else:
-            return NotImplemented
+    def _groups(self, partition):
+        self._prune()
+        with self._thread_lock:
+            return _groups(self._counter, partition)
 
     def __iter__(self):
         ascending = heapq.nsmallest(self.count(), self._hits)
-        for time, partitions in ascending:
-            yield Hit(time, partitions)
+        for when, pickled_counter_keys in ascending:
+            # The longest key holds every partition that the hit matched
+            counter_keys = pickle.loads(pickled_counter_keys)
+            yield Hit(when, dict(max(counter_keys, key=len, default=())))
 
     def __len__(self):
         return self.count()
@@ -478,3 +709,769 @@ class _HitLog(AbstractLog):
     def __repr__(self):
         return "HitLog({})".format(self.count())
 
+
+class BucketedHitLog(AbstractLog):
+    """
+    A thread-safe, in-memory storage class that counts hits in time
+    buckets, rather than keeping a record of each one.
+
+    The buckets are kept in a ring that spans the counter's duration, so
+    the memory that the log uses doesn't grow with the number of hits
+    (only with the number of distinct partition groups that they fall
+    into). Counts are only as precise as the buckets are long; hits are
+    let go of a bucket at a time, and are iterated with the start time
+    of their bucket (or ``None`` if the counter keeps hits forever).
+
+    It accepts this option (see :meth:`AbstractLog.configure`):
+
+    :param resolution: The length of the buckets, as a
+        :class:`~datetime.timedelta` or a number of seconds. By default,
+        the counter's duration is split into 60 buckets.
+    """
+    _defaults = {'resolution': None}
+
+    def __init__(self, duration, resource):
+        resolution = self._read_options()['resolution']
+
+        duration = _seconds(duration)
+        if duration == 0:
+            raise ValueError("BucketedHitLog needs a non-zero duration.")
+        elif duration < 0:
+            # Everything is kept, in a single bucket.
+            self._resolution = None
+            size = 1
+        else:
+            self._resolution = max(1, math.ceil(duration / 60)) \
+                               if resolution is None else _seconds(resolution)
+            size = math.ceil(duration / self._resolution)
+
+        self._lock = Lock()
+        self._slots = [self._new_bucket(None) for _ in range(size)]
+        self._latest = None
+        # Running totals for the whole ring, so that counting is O(1)
+        self._total = 0
+        self._counter = PyCounter()
+
+    def track(self, partitions):
+        with self._lock:
+            bucket = self._advance()
+            self._record(bucket, partitions)
+            bucket.total += 1
+            self._total += 1
+
+    def count(self, **partitions):
+        with self._lock:
+            self._advance()
+            if not partitions:
+                return self._total
+            else:
+                return self._lookup(tuple(sorted(partitions.items())))
+
+    def __iter__(self):
+        with self._lock:
+            self._advance()
+            buckets = sorted(
+                ((b.index, list(self._hits(b)))
+                 for b in self._slots if b.total),
+                key=lambda b: -1 if b[0] is None else b[0])
+
+        for index, hits in buckets:
+            when = None if index is None else \
+                   datetime.fromtimestamp(index * self._resolution)
+            for partitions, n in hits:
+                for _ in range(n):
+                    yield Hit(when, partitions)
+
+    def distinct(self, partition):
+        with self._lock:
+            self._advance()
+            return len(_groups(self._counter, partition))
+
+    def distinct_sketch(self, partition):
+        with self._lock:
+            self._advance()
+            groups = _groups(self._counter, partition)
+        sketch = HyperLogLog()
+        for group in groups:
+            sketch.add(group)
+        return sketch
+
+    def top(self, partition, k):
+        with self._lock:
+            self._advance()
+            return _top(self._counter, partition, k)
+
+    def __len__(self):
+        return self.count()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.count())
+
+
+    def _advance(self):
+        # Move the ring up to the current bucket, letting go of the hits
+        # in the buckets that it passes; return the current bucket.
+        if self._resolution is None:
+            return self._slots[0]
+
+        current = int(time() // self._resolution)
+        if self._latest is not None:
+            # In case the clock goes back
+            current = max(current, self._latest)
+        size = len(self._slots)
+        if self._latest is None or current - self._latest >= size:
+            expired = range(size)
+        else:
+            expired = range(self._latest + 1, current + 1)
+
+        for index in expired:
+            slot = index % size
+            bucket = self._slots[slot]
+            if bucket.total:
+                self._total -= bucket.total
+                self._forget(bucket)
+                self._slots[slot] = self._new_bucket(None)
+
+        if self._latest is None or current > self._latest:
+            self._latest = current
+        bucket = self._slots[current % size]
+        bucket.index = current
+        return bucket
+
+    # The rest of these methods deal with what is counted in each
+    # bucket (and in the running totals), and are called with the lock
+    # held.
+
+    def _new_bucket(self, index):
+        return _Bucket(index)
+
+    def _record(self, bucket, partitions):
+        counter_keys = list(_counter_keys(partitions))
+        bucket.hits[tuple(sorted(partitions.items()))] += 1
+        bucket.counter.update(counter_keys)
+        self._counter.update(counter_keys)
+
+    def _forget(self, bucket):
+        self._counter.subtract(bucket.counter)
+        # Don't let the counter fill up with zeroes
+        for key in bucket.counter:
+            if self._counter[key] <= 0:
+                del self._counter[key]
+
+    def _lookup(self, counter_key):
+        return self._counter[counter_key]
+
+    def _hits(self, bucket):
+        # Yield (partitions, number of hits) pairs for the bucket
+        for key, n in bucket.hits.items():
+            yield dict(key), n
+
+
+class SketchHitLog(BucketedHitLog):
+    """
+    A thread-safe, in-memory storage class that counts the hits to
+    partition groups with `Count-Min sketches
+    <https://en.wikipedia.org/wiki/Count%E2%80%93min_sketch>`_, so that
+    it uses a fixed amount of memory no matter how many distinct groups
+    there are (for example, when hits are partitioned by client
+    address).
+
+    Total counts are exact, but the count for a partition group is an
+    estimate that can only be too high: with a probability of
+    *confidence*, it's over by no more than *error* times the total of
+    the counts in the sketch. Each hit is counted once for every
+    combination of the counter's partitions (three times, with two
+    partitions), within the counter's duration. Like
+    :class:`BucketedHitLog`, hits are counted in time buckets (each
+    with a sketch of its own); iterating the log yields each hit with
+    its bucket's start time, but without its partitions, since a
+    sketch doesn't keep them.
+
+    It accepts these options (see :meth:`AbstractLog.configure`):
+
+    :param error: The error bound of the estimates, as a fraction of the
+        total count. The default is ``0.01``.
+    :param confidence: The probability that an estimate is within the
+        error bound. The default is ``0.99``.
+    :param resolution: The length of the buckets, as for
+        :class:`BucketedHitLog`.
+    :param precision: The precision of the :class:`HyperLogLog`
+        sketches that estimate the number of :meth:`distinct` groups in
+        each partition. The default is 12.
+    :param heavy_hitters: The number of groups of each partition that
+        each bucket keeps as candidates for :meth:`top`, using the
+        `Space-Saving algorithm
+        <https://doi.org/10.1007/978-3-540-30570-5_27>`_. Any group with
+        more than ``1/heavy_hitters`` of a bucket's hits is sure to be
+        kept. The default is 100.
+
+    Each bucket's sketch takes about ``8 * e/error * ln(1/(1-confidence))``
+    bytes, plus ``2**precision`` bytes and up to *heavy_hitters* groups
+    for each partition.
+    """
+    _defaults = {'error': 0.01, 'confidence': 0.99, 'resolution': None,
+                 'precision': 12, 'heavy_hitters': 100}
+
+    def __init__(self, duration, resource):
+        options = self._read_options()
+        self._width = math.ceil(math.e / options['error'])
+        self._depth = math.ceil(math.log(1 / (1 - options['confidence'])))
+        self._precision = options['precision']
+        self._capacity = options['heavy_hitters']
+        super().__init__(duration, resource)
+        # The sum of every bucket's sketch
+        self._sketch = self._new_bucket(None).sketch
+        # The merged distinct sketches of the buckets, for each
+        # partition. They're kept up to date as hits are tracked, and
+        # dropped when a bucket expires.
+        self._merged = {}
+
+    def distinct(self, partition):
+        return self.distinct_sketch(partition).count()
+
+    def distinct_sketch(self, partition):
+        with self._lock:
+            self._advance()
+            if partition not in self._merged:
+                merged = HyperLogLog(self._precision)
+                for bucket in self._slots:
+                    if partition in bucket.distinct:
+                        merged.update(bucket.distinct[partition])
+                self._merged[partition] = merged
+            return self._merged[partition].copy()
+
+    def top(self, partition, k):
+        # The candidates kept by the buckets are counted with the sketch.
+        with self._lock:
+            self._advance()
+            groups = set()
+            for bucket in self._slots:
+                if partition in bucket.heavy:
+                    groups.update(bucket.heavy[partition].counts)
+            return heapq.nlargest(
+                k, ((g, self._lookup(((partition, g),))) for g in groups),
+                key=lambda item: item[1])
+
+    def _new_bucket(self, index):
+        return _SketchBucket(index, self._width * self._depth)
+
+    def _cells(self, counter_key):
+        # The cell of each row of a sketch that counts the key
+        for row in range(self._depth):
+            yield row * self._width + hash((row, counter_key)) % self._width
+
+    def _record(self, bucket, partitions):
+        for counter_key in _counter_keys(partitions):
+            for cell in self._cells(counter_key):
+                bucket.sketch[cell] += 1
+                self._sketch[cell] += 1
+
+        for name, group in partitions.items():
+            if name not in bucket.distinct:
+                bucket.distinct[name] = HyperLogLog(self._precision)
+            bucket.distinct[name].add(group)
+            if name in self._merged:
+                self._merged[name].add(group)
+
+            if name not in bucket.heavy:
+                bucket.heavy[name] = _SpaceSaving(self._capacity)
+            bucket.heavy[name].add(group)
+
+    def _forget(self, bucket):
+        sketch = self._sketch
+        for cell, n in enumerate(bucket.sketch):
+            if n:
+                sketch[cell] -= n
+        self._merged.clear()
+
+    def _lookup(self, counter_key):
+        return min(self._sketch[cell] for cell in self._cells(counter_key))
+
+    def _hits(self, bucket):
+        yield {}, bucket.total
+
+
+class StripedHitLog(AbstractLog):
+    """
+    A storage class that spreads the hits over several logs (*stripes*),
+    so that threads serving requests at the same time don't wait on
+    each other to record their hits. Each thread always records its hits
+    in the same stripe, and the stripes are read together::
+
+        storage = StripedHitLog.configure(stripes=8, storage=BucketedHitLog)
+        counter = Counter(app, duration=3600, storage=storage)
+
+    Counts are added up across the stripes, so reading the log costs
+    more than it does with a single log. The number of :meth:`distinct`
+    groups is estimated by merging the stripes' sketches, and the
+    :meth:`top` groups are found among the most frequent groups of each
+    stripe.
+
+    It accepts these options (see :meth:`AbstractLog.configure`):
+
+    :param stripes: The number of logs to spread the hits over. It should
+        be about the number of threads that serve requests. The default
+        is 8.
+    :param storage: The storage class of the stripes, which accepts any
+        :class:`AbstractLog` subclass. By default, the stripes store
+        hits like a counter does by default.
+    """
+
+    _defaults = {'stripes': 8, 'storage': None}
+
+    def __init__(self, duration, resource):
+        options = self._read_options()
+        storage = options['storage'] or _HitLog
+        self._stripes = tuple(storage(duration, resource)
+                              for _ in range(options['stripes']))
+        self._view = _CompositeLog(*self._stripes)
+        self._local = local()
+        self._assign = count()
+
+    def track(self, partitions):
+        try:
+            stripe = self._local.stripe
+        except AttributeError:
+            # Threads are handed out stripes in turn.
+            stripe = self._local.stripe = \
+                     self._stripes[next(self._assign) % len(self._stripes)]
+        stripe.track(partitions)
+
+    def count(self, **partitions):
+        return self._view.count(**partitions)
+
+    def distinct(self, partition):
+        return self._view.distinct(partition)
+
+    def distinct_sketch(self, partition):
+        return self._view.distinct_sketch(partition)
+
+    def top(self, partition, k):
+        return self._view.top(partition, k)
+
+    def __iter__(self):
+        return iter(self._view)
+
+    def __len__(self):
+        return self.count()
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, self.count())
+
+
+class SharedMemoryHitLog(AbstractLog):
+    """
+    A storage class that counts hits in a memory-mapped file, so that
+    every worker process of an application on the same host counts the
+    same hits, without a round trip to a server. Since the counts live
+    in the file, they survive workers being recycled (and the whole
+    application being restarted)::
+
+        storage = SharedMemoryHitLog.configure(path='/run/myapp/hits')
+        counter = Counter(app, duration=3600, storage=storage)
+
+    Like :class:`BucketedHitLog`, hits are counted in time buckets,
+    with a counter in each bucket for every combination of partition
+    groups. The counters are kept in a fixed-size hash table in the
+    file, and hits are recorded while holding a lock on the file (see
+    :func:`fcntl.lockf`). A counter whose hits have all fallen outside
+    of the duration is reused for the next new group; when there's no
+    such counter and the table is full, the hits to partition groups
+    that don't have a counter yet are only counted in the total.
+    Iterating the log yields each hit with its bucket's start time, but
+    without its partitions; :meth:`distinct` and :meth:`top` only know
+    about the groups whose :func:`repr` fits in 56 bytes (as UTF-8).
+
+    It accepts these options (see :meth:`AbstractLog.configure`):
+
+    :param path: The prefix of the files that hits are stored in; each
+        log has a file of its own, named after its resource. It must be
+        given, and counters that store their hits in the same directory
+        must use different prefixes. The files must be owned by the
+        user that the application runs as, and mustn't be writable by
+        anyone else; a directory that only that user can write to is
+        best.
+    :param slots: The number of counters in each file's table. The
+        default is 1024.
+    :param resolution: The length of the buckets, as for
+        :class:`BucketedHitLog`.
+
+    Each file takes about ``slots * (64 + 16 * buckets)`` bytes. The
+    log must be created with the same options by every process that
+    shares a file.
+
+    .. note:: This storage class is only available on Unix.
+    """
+    _defaults = {'path': None, 'slots': 1024, 'resolution': None}
+
+    def __init__(self, duration, resource):
+        if fcntl is None:
+            raise RuntimeError("SharedMemoryHitLog is only available on "
+                               "Unix.")
+
+        options = self._read_options()
+        path = options['path']
+        if path is None:
+            # A shared default would mix up the hits of unrelated
+            # applications on the host.
+            raise TypeError("SharedMemoryHitLog needs a path option.")
+        self.path = "{}-{}".format(
+            path, '*' if resource is None else quote(resource.name, safe=''))
+
+        duration = _seconds(duration)
+        if duration == 0:
+            raise ValueError("SharedMemoryHitLog needs a non-zero "
+                             "duration.")
+        elif duration < 0:
+            self._resolution = None
+            self._size = 1
+        else:
+            self._resolution = max(1, math.ceil(duration / 60)) \
+                               if options['resolution'] is None \
+                               else _seconds(options['resolution'])
+            self._size = math.ceil(duration / self._resolution)
+        self._slots = options['slots']
+        self._entry = _SHM_ENTRY.size + _SHM_CELL.size * self._size
+
+        resolution = -1 if self._resolution is None else self._resolution
+        header = _SHM_HEADER.pack(_SHM_MAGIC, resolution, self._size,
+                                  self._slots)
+        self._file = _open_shared_file(
+            self.path, header, _SHM_HEADER.size + self._entry * self._slots)
+        self._map = self._file.map
+        self._locked = self._file.locked
+
+    def track(self, partitions):
+        labels = [''] + [repr(k) for k in _counter_keys(partitions)]
+        with self._locked(fcntl.LOCK_EX):
+            bucket = self._bucket()
+            for label in labels:
+                offset = self._find(label, insert=bucket)
+                if offset is not None:
+                    self._increment(offset, bucket)
+
+    def count(self, **partitions):
+        label = repr(tuple(sorted(partitions.items()))) if partitions \
+                else ''
+        with self._locked(fcntl.LOCK_SH):
+            offset = self._find(label)
+            if offset is None:
+                return 0
+            return sum(self._cells(offset, self._bucket()).values())
+
+    def distinct(self, partition):
+        return len(self._groups(partition))
+
+    def distinct_sketch(self, partition):
+        sketch = HyperLogLog()
+        for group in self._groups(partition):
+            sketch.add(group)
+        return sketch
+
+    def top(self, partition, k):
+        return PyCounter(self._groups(partition)).most_common(k)
+
+    def __iter__(self):
+        with self._locked(fcntl.LOCK_SH):
+            offset = self._find('')
+            cells = {} if offset is None else \
+                    self._cells(offset, self._bucket())
+
+        for index, n in sorted(cells.items()):
+            when = None if self._resolution is None else \
+                   datetime.fromtimestamp(index * self._resolution)
+            for _ in range(n):
+                yield Hit(when, {})
+
+    def __len__(self):
+        return self.count()
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.path)
+
+    def _bucket(self):
+        # The index of the current bucket
+        if self._resolution is None:
+            return 0
+        return int(time() // self._resolution)
+
+    def _find(self, label, insert=None):
+        # Find the table entry for a label by linear probing, and return
+        # its offset (or None, if it isn't there and can't be added). To
+        # insert the label, pass the current bucket; the label takes the
+        # first entry on its probe sequence that's empty, or whose counts
+        # have all expired.
+        encoded = label.encode('utf8')
+        digest = blake2b(encoded, digest_size=8).digest()
+        # Zero marks an empty entry
+        key = int.from_bytes(digest, 'little') | 1
+        if len(encoded) > _SHM_LABEL:
+            encoded = b''
+
+        first = key % self._slots
+        free = None
+        for i in range(self._slots):
+            offset = _SHM_HEADER.size \
+                     + self._entry * ((first + i) % self._slots)
+            found, _ = _SHM_ENTRY.unpack_from(self._map, offset)
+            if found == key:
+                return offset
+            elif found == 0:
+                if free is None:
+                    free = offset
+                # Entries are never emptied again, so the label can't
+                # be any further along.
+                break
+            elif insert is not None and free is None \
+                 and not self._cells(offset, insert):
+                # An expired entry is reused in place, so it stays
+                # non-empty and the labels past it can still be found.
+                free = offset
+
+        if insert is None or free is None:
+            return None
+        _SHM_ENTRY.pack_into(self._map, free, key, encoded)
+        self._map[free + _SHM_ENTRY.size:free + self._entry] = \
+            bytes(self._entry - _SHM_ENTRY.size)
+        return free
+
+    def _increment(self, offset, bucket):
+        # The cells of an entry are a ring, like BucketedHitLog's
+        # buckets; a cell that belongs to an older bucket is reset.
+        cell = offset + _SHM_ENTRY.size \
+               + _SHM_CELL.size * (bucket % self._size)
+        epoch, n = _SHM_CELL.unpack_from(self._map, cell)
+        n = n + 1 if epoch == bucket + 1 else 1
+        _SHM_CELL.pack_into(self._map, cell, bucket + 1, n)
+
+    def _cells(self, offset, bucket):
+        # Map the indexes of the buckets within the duration to the
+        # entry's counts for them.
+        cells = {}
+        for i in range(self._size):
+            epoch, n = _SHM_CELL.unpack_from(
+                self._map, offset + _SHM_ENTRY.size + _SHM_CELL.size * i)
+            index = epoch - 1
+            if n and 0 <= bucket - index < self._size:
+                cells[None if self._resolution is None else index] = n
+        return cells
+
+    def _groups(self, partition):
+        # Map the groups of a partition that have a labelled entry to
+        # their counts
+        groups = {}
+        with self._locked(fcntl.LOCK_SH):
+            bucket = self._bucket()
+            for slot in range(self._slots):
+                offset = _SHM_HEADER.size + self._entry * slot
+                key, label = _SHM_ENTRY.unpack_from(self._map, offset)
+                label = label.rstrip(b'\0')
+                if not key or not label:
+                    continue
+                counter_key = literal_eval(label.decode('utf8'))
+                if len(counter_key) == 1 and counter_key[0][0] == partition:
+                    n = sum(self._cells(offset, bucket).values())
+                    if n:
+                        groups[counter_key[0][1]] = n
+        return groups
+
+
+# The layout of a SharedMemoryHitLog's file: a header with the options
+# that it was created with, followed by the table. Each entry of the
+# table has a hash of its counter key (and the key itself, if it's short
+# enough), then an (epoch, count) cell for each bucket.
+_SHM_MAGIC = b'FINDIGHL'
+_SHM_HEADER = struct.Struct('<8sdqq')
+_SHM_LABEL = 56
+_SHM_ENTRY = struct.Struct('<Q{}s'.format(_SHM_LABEL))
+_SHM_CELL = struct.Struct('<qq')
+
+# The files are opened once per process (and left open), since closing
+# any descriptor of a file lets go of the process's locks on it.
+_shared_files = {}
+_shared_files_lock = Lock()
+
+
+def _open_shared_file(path, header, length):
+    # The file itself mustn't be a symlink (see _SharedFile), so only
+    # its directory is resolved.
+    path = os.path.join(os.path.realpath(os.path.dirname(path)),
+                        os.path.basename(path))
+    with _shared_files_lock:
+        if path not in _shared_files:
+            _shared_files[path] = _SharedFile(path, header, length)
+        shared = _shared_files[path]
+
+    if shared.header != header:
+        raise ValueError("{} was created with different options."
+                         .format(path))
+    return shared
+
+
+class _SharedFile:
+    def __init__(self, path, header, length):
+        self.header = header
+        # fcntl locks don't keep out other threads of the same process.
+        self.lock = Lock()
+        # Symlinks aren't followed, and the file must belong to us, so
+        # that other users can't plant a file whose counts they control.
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+                          0o600)
+        try:
+            info = os.fstat(self.fd)
+            if not stat.S_ISREG(info.st_mode) \
+               or info.st_uid != os.geteuid() \
+               or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                raise PermissionError(
+                    "{} must be a regular file that only its owner (this "
+                    "process's user) can write to.".format(path))
+
+            with self.locked(fcntl.LOCK_EX):
+                # Lay out a new file, or check that an existing one was
+                # laid out with the same options.
+                if os.fstat(self.fd).st_size == 0:
+                    os.ftruncate(self.fd, length)
+                    os.pwrite(self.fd, header, 0)
+                elif os.pread(self.fd, len(header), 0) != header \
+                     or os.fstat(self.fd).st_size != length:
+                    raise ValueError("{} was created with different options."
+                                     .format(path))
+            self.map = mmap.mmap(self.fd, length)
+        except Exception:
+            os.close(self.fd)
+            raise
+
+    @contextmanager
+    def locked(self, operation):
+        with self.lock:
+            fcntl.lockf(self.fd, operation)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+
+class _Bucket:
+    __slots__ = 'index', 'total', 'counter', 'hits'
+
+    def __init__(self, index):
+        self.index = index
+        self.total = 0
+        # Counts for each combination of partition groups, and for each
+        # full set of partitions that hits have matched.
+        self.counter = PyCounter()
+        self.hits = PyCounter()
+
+
+class _SketchBucket:
+    __slots__ = 'index', 'total', 'sketch', 'distinct', 'heavy'
+
+    def __init__(self, index, size):
+        self.index = index
+        self.total = 0
+        self.sketch = array('q', bytes(8 * size))
+        self.distinct = {}
+        self.heavy = {}
+
+
+class _SpaceSaving:
+    # Keeps (over-)estimated counts for at most *capacity* items; an
+    # item that isn't kept takes the place of the least frequent one,
+    # inheriting its count.
+    __slots__ = 'capacity', 'counts'
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, item):
+        counts = self.counts
+        if item in counts:
+            counts[item] += 1
+        elif len(counts) < self.capacity:
+            counts[item] = 1
+        else:
+            least = min(counts, key=counts.__getitem__)
+            counts[item] = counts.pop(least) + 1
+
+
+class HyperLogLog:
+    """
+    A `HyperLogLog <https://en.wikipedia.org/wiki/HyperLogLog>`_ sketch,
+    which estimates the number of distinct values that are added to it.
+
+    :param precision: The sketch takes ``2**precision`` bytes, and its
+        estimates have a standard error of about
+        ``1.04 / sqrt(2**precision)`` (1.6% for the default of 12).
+
+    Values are told apart by their :func:`repr`.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """Add a value to the sketch."""
+        digest = blake2b(repr(value).encode('utf8'), digest_size=8).digest()
+        h = int.from_bytes(digest, 'big')
+        bits = 64 - self.precision
+        index = h >> bits
+        # The position of the first set bit in the rest of the hash
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """Merge another sketch (of the same precision) into this one."""
+        if other.precision != self.precision:
+            raise ValueError("Can't merge sketches of different precisions.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def copy(self):
+        """Return a copy of the sketch."""
+        sketch = HyperLogLog(self.precision)
+        sketch.registers = bytearray(self.registers)
+        return sketch
+
+    def count(self):
+        """Return the estimated number of distinct values."""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small counts are estimated better by linear counting
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+def _groups(counter, partition):
+    # The groups of a partition that hits in a counter fall into
+    return [key[0][1] for key, n in counter.items()
+            if n > 0 and len(key) == 1 and key[0][0] == partition]
+
+
+def _top(counter, partition, k):
+    # The k most frequent groups of a partition in a counter. This scans
+    # every counter key; the exact logs have no bounded summary.
+    return heapq.nlargest(
+        k, ((key[0][1], n) for key, n in counter.items()
+            if n > 0 and len(key) == 1 and key[0][0] == partition),
+        key=lambda item: item[1])
+
+
+def _counter_keys(partitions):
+    # Every combination of the partitions that a hit can be counted by
+    names = sorted(partitions)
+    for r in range(1, len(names) + 1):
+        for combination in combinations(names, r):
+            yield tuple((name, partitions[name]) for name in combination)
+
+
+def _seconds(duration):
+    if isinstance(duration, timedelta):
+        return duration.total_seconds()
+    else:
+        return duration
+
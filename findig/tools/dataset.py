@@ -1,7 +1,11 @@
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, namedtuple
 from collections.abc import Callable, Iterable, Mapping, MutableMapping
 from contextlib import contextmanager
 from itertools import islice
+from threading import Lock
+from time import monotonic
+import operator
 
 from werkzeug.utils import cached_property
 
@@ -58,7 +62,28 @@ class AbstractDataSet(Iterable, metaclass=ABCMeta):
         else:
             raise LookupError("No matching item found.")
 
-    def filtered(self, **search_spec):
+    def count(self):
+        """
+        Return the number of items in the data set.
+
+        The default implementation iterates through the whole data set;
+        subclasses should override this if the backend can count items
+        more cheaply.
+        """
+        return sum(1 for _ in self)
+
+    def exists(self):
+        """
+        Return ``True`` if the data set contains at least one item.
+
+        The default implementation stops iterating at the first item.
+        """
+        for _ in self:
+            return True
+        else:
+            return False
+
+    def filtered(self, *expressions, **search_spec):
         """
         Return a filtered view of this data set.
 
@@ -69,8 +94,13 @@ class AbstractDataSet(Iterable, metaclass=ABCMeta):
         that the predicate will passed be ``None`` if the field isn't 
         present on the record), otherwise it is compared against the field
         for equality.
+
+        Positional arguments are :class:`FilterExpression` instances
+        (built with :class:`F`) that records must also match. Unlike
+        predicates, these can be translated into a query by data sets
+        whose backends are able to evaluate them.
         """
-        return FilteredDataSet(self, **search_spec)
+        return FilteredDataSet(self, *expressions, **search_spec)
 
     def limit(self, count, offset=0):
         """
@@ -113,6 +143,10 @@ class AbstractRecord(Mapping, metaclass=ABCMeta):
     """
     An representation of an item belonging to a collection.
     """
+    # Subclasses that declare __slots__ of their own can do without
+    # a per-instance __dict__ (see CompactRecord).
+    __slots__ = ()
+
     def __iter__(self):
         yield from self.cached_data
 
@@ -144,7 +178,7 @@ class MutableRecord(MutableMapping, AbstractRecord, metaclass=ABCMeta):
     An abstract record that can update or delete itself.
     """
     def __setitem__(self, field, val):
-        self.patch({field: val})
+        self.patch({field: val}, ())
 
     def __delitem__(self, field):
         self.patch({}, (field,))
@@ -200,6 +234,110 @@ class MutableRecord(MutableMapping, AbstractRecord, metaclass=ABCMeta):
         Update the record's data with the new data.
         """
 
+class RecordSchema:
+    """
+    An ordered collection of field names that is shared by
+    :class:`CompactRecord` instances.
+
+    :param fields: The field names that the schema starts out with.
+
+    A data set that produces compact records keeps a single schema, and
+    builds each record with :meth:`record`. Fields that the schema
+    hasn't seen yet are added to it as records are built, so records
+    with differing fields can share a schema.
+    """
+
+    def __init__(self, fields=()):
+        self.fields = ()
+        self.positions = {}
+        self._lock = Lock()
+        self.extend(fields)
+
+    def __repr__(self):
+        return "RecordSchema({!r})".format(self.fields)
+
+    def extend(self, fields):
+        """Add new field names to the end of the schema."""
+        with self._lock:
+            positions = dict(self.positions)
+            for field in fields:
+                positions.setdefault(field, len(positions))
+            if len(positions) > len(self.positions):
+                self.fields = tuple(sorted(positions, key=positions.get))
+                self.positions = positions
+
+    def record(self, data):
+        """
+        Return a :class:`CompactRecord` holding the items of the mapping
+        *data*.
+        """
+        positions = self.positions
+        if not all(field in positions for field in data):
+            self.extend(data)
+            positions = self.positions
+
+        values = [_MISSING] * len(positions)
+        for field, value in data.items():
+            values[positions[field]] = value
+
+        # Fields missing from the end of the record needn't be stored.
+        while values and values[-1] is _MISSING:
+            values.pop()
+
+        return CompactRecord(self, tuple(values))
+
+
+class CompactRecord(AbstractRecord):
+    """
+    A read-only record that stores its values in a tuple, and shares
+    its field names with other records through a :class:`RecordSchema`.
+
+    :param schema: The schema for the record.
+    :type schema: :class:`RecordSchema`
+    :param values: The record's values, in the same order as the
+        schema's fields.
+
+    Compact records don't have a per-instance ``__dict__`` or a cached
+    copy of their data, which makes them much smaller than other records
+    when a large number of them are held in memory at once.
+    """
+    __slots__ = 'schema', 'values'
+
+    def __init__(self, schema, values):
+        self.schema = schema
+        self.values = values
+
+    def __getitem__(self, field):
+        try:
+            value = self.values[self.schema.positions[field]]
+        except (KeyError, IndexError):
+            raise KeyError(field)
+
+        if value is _MISSING:
+            raise KeyError(field)
+        else:
+            return value
+
+    def __iter__(self):
+        for field, value in zip(self.schema.fields, self.values):
+            if value is not _MISSING:
+                yield field
+
+    def __len__(self):
+        return sum(1 for value in self.values if value is not _MISSING)
+
+    @property
+    def cached_data(self):
+        return self.read()
+
+    def read(self):
+        return dict(self.items())
+
+
+# Marks a field that a compact record doesn't have
+_MISSING = object()
+
+
 class LazyRecord(AbstractRecord):
     def __init__(self, func):
         self.func = func
@@ -227,6 +365,234 @@ class LazyMutableRecord(MutableRecord, LazyRecord):
     def delete(self):
         self.record.delete()
 
+class F:
+    """
+    A reference to a field of a record, for building filter expressions
+    that can be passed to :meth:`AbstractDataSet.filtered`::
+
+        tasks.filtered(F('due') < now, F('status').in_(['open', 'held']))
+
+    Comparing a field reference with a value (using ``==``, ``!=``,
+    ``<``, ``<=``, ``>`` or ``>=``) produces a :class:`FilterExpression`,
+    as do :meth:`in_` and :meth:`startswith`. A comparison never matches
+    a record whose field is missing or can't be compared with the value,
+    except that ``F(name) == None`` matches a missing field.
+    """
+    __slots__ = 'name',
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return "F({!r})".format(self.name)
+
+    def __eq__(self, value):
+        return Comparison(self.name, 'eq', value)
+
+    def __ne__(self, value):
+        return Comparison(self.name, 'ne', value)
+
+    def __lt__(self, value):
+        return Comparison(self.name, 'lt', value)
+
+    def __le__(self, value):
+        return Comparison(self.name, 'le', value)
+
+    def __gt__(self, value):
+        return Comparison(self.name, 'gt', value)
+
+    def __ge__(self, value):
+        return Comparison(self.name, 'ge', value)
+
+    def in_(self, values):
+        """Match records where the field is one of *values*."""
+        return Comparison(self.name, 'in', tuple(values))
+
+    def startswith(self, prefix):
+        """
+        Match records where the field is a string that starts with
+        *prefix*.
+        """
+        return Comparison(self.name, 'startswith', prefix)
+
+
+class FilterExpression:
+    """
+    A condition on the fields of a record.
+
+    Expressions are combined with ``&`` (and), ``|`` (or) and ``~``
+    (not), and calling an expression with a record returns ``True`` if
+    the record matches it. Data sets whose backends can evaluate a
+    condition walk the expression tree (made up of :class:`Comparison`,
+    :class:`And`, :class:`Or` and :class:`Not` nodes) to translate it;
+    everything else uses the expression as a predicate.
+    """
+    __slots__ = '_predicate',
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __call__(self, record):
+        try:
+            predicate = self._predicate
+        except AttributeError:
+            predicate = self._predicate = self.compile()
+        return predicate(record)
+
+    def compile(self):
+        """
+        Return a function that takes a record and returns ``True`` if
+        it matches the expression.
+        """
+        raise NotImplementedError
+
+    @property
+    def key(self):
+        """A hashable value that identifies the expression."""
+        raise NotImplementedError
+
+
+class Comparison(FilterExpression):
+    """
+    An expression that compares a field with a value.
+
+    :param field: The name of the field.
+    :param op: One of ``'eq'``, ``'ne'``, ``'lt'``, ``'le'``, ``'gt'``,
+        ``'ge'``, ``'in'`` or ``'startswith'``.
+    :param value: The value that the field is compared with (a tuple of
+        values for ``'in'``).
+    """
+    __slots__ = 'field', 'op', 'value'
+
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return "<{} {} {!r}>".format(self.field, self.op, self.value)
+
+    def compile(self):
+        field, value, test = self.field, self.value, _TESTS[self.op]
+        if self.op == 'in':
+            try:
+                value = frozenset(value)
+            except TypeError:
+                pass
+
+        def predicate(record):
+            try:
+                return bool(test(record.get(field), value))
+            except TypeError:
+                return False
+        return predicate
+
+    @property
+    def key(self):
+        return ('cmp', self.field, self.op, _freeze(self.value))
+
+
+class And(FilterExpression):
+    """An expression that matches records that match all of *terms*."""
+    __slots__ = 'terms',
+
+    def __init__(self, *terms):
+        self.terms = _flatten(And, terms)
+
+    def __repr__(self):
+        return "({})".format(" & ".join(map(repr, self.terms)))
+
+    def compile(self):
+        predicates = [term.compile() for term in self.terms]
+        def predicate(record):
+            for matches in predicates:
+                if not matches(record):
+                    return False
+            return True
+        return predicate
+
+    @property
+    def key(self):
+        return ('and',) + tuple(term.key for term in self.terms)
+
+
+class Or(FilterExpression):
+    """An expression that matches records that match any of *terms*."""
+    __slots__ = 'terms',
+
+    def __init__(self, *terms):
+        self.terms = _flatten(Or, terms)
+
+    def __repr__(self):
+        return "({})".format(" | ".join(map(repr, self.terms)))
+
+    def compile(self):
+        predicates = [term.compile() for term in self.terms]
+        def predicate(record):
+            for matches in predicates:
+                if matches(record):
+                    return True
+            return False
+        return predicate
+
+    @property
+    def key(self):
+        return ('or',) + tuple(term.key for term in self.terms)
+
+
+class Not(FilterExpression):
+    """An expression that matches records that don't match *term*."""
+    __slots__ = 'term',
+
+    def __init__(self, term):
+        self.term = term
+
+    def __repr__(self):
+        return "~{!r}".format(self.term)
+
+    def compile(self):
+        matches = self.term.compile()
+        return lambda record: not matches(record)
+
+    @property
+    def key(self):
+        return ('not', self.term.key)
+
+
+def _flatten(cls, terms):
+    # Nested expressions of the same type are merged, so (a & b) & c
+    # has three terms.
+    flat = []
+    for term in terms:
+        if type(term) is cls:
+            flat.extend(term.terms)
+        else:
+            flat.append(term)
+    return tuple(flat)
+
+
+def _startswith(value, prefix):
+    return isinstance(value, str) and value.startswith(prefix)
+
+
+_TESTS = {
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'in': lambda value, values: value in values,
+    'startswith': _startswith,
+}
+
+
 class FilteredDataSet(AbstractDataSet):
     """
     A concrete implementation of a data set that wraps another data
@@ -235,7 +601,9 @@ class FilteredDataSet(AbstractDataSet):
     :param dataset: A dataset that is filtered
     :type dataset: :class:AbstractDataSet
     
-    The filter is specified through keyword arguments to the instance.
+    Positional arguments are :class:`FilterExpression` instances that
+    items must match. The rest of the filter is specified through
+    keyword arguments to the instance.
     Each keyword represents the name of a field that is checked, and
     the corresponding argument indicates what it is checked against. If
     the argument is :class:`~collections.abc.Callable`, then it should
@@ -246,23 +614,25 @@ class FilteredDataSet(AbstractDataSet):
     implements this checking procedure.
     """
 
-    def __init__(self, dataset, **filter_spec):
+    def __init__(self, dataset, *expressions, **filter_spec):
         self.ds = dataset
+        self.exprs = expressions
         self.fs = filter_spec
 
     def __iter__(self):
         for record in self.ds:
-            if self.check_match(record, self.fs):
+            if self.check_match(record, self.fs, self.exprs):
                 yield record
 
     def __repr__(self):
         return "<filtered-view({!r})|{}".format(
             self.ds,
-            ",".join("{}={!r}".format(k,v) for k,v in self.fs.items())
+            ",".join(list(map(repr, self.exprs)) + 
+                     ["{}={!r}".format(k,v) for k,v in self.fs.items()])
         )
 
     @staticmethod
-    def check_match(record, spec):
+    def check_match(record, spec, expressions=()):
         """
         Check that a record matches the search specification.
 
@@ -272,7 +642,12 @@ class FilteredDataSet(AbstractDataSet):
                      If an "expected value" is callable, it is treated as
                      a predicate that returns ``True`` if the field's
                      value is considered a match.
+        :param expressions: A sequence of :class:`FilterExpression`
+                     instances that the record must match.
         """
+        for expression in expressions:
+            if not expression(record):
+                return False
 
         for field, expected in spec.items():
             val = record.get(field)                
@@ -306,6 +681,14 @@ class DataSetSlice(AbstractDataSet):
     def __iter__(self):
         yield from islice(self.ds, self.start, self.stop, self.step)
 
+    def count(self):
+        total = self.ds.count()
+        stop = total if self.stop is None else min(self.stop, total)
+        return len(range(self.start, stop, self.step or 1))
+
+    def exists(self):
+        return self.count() > 0
+
     def __repr__(self):
         return "{!r}[{}:{}]".format(
             self.ds,
@@ -326,6 +709,12 @@ class OrderedDataSet(AbstractDataSet):
     def __iter__(self):
         yield from sorted(self.ds, key=self.make_key(*self.ss), reverse=self.rv)
 
+    def count(self):
+        return self.ds.count()
+
+    def exists(self):
+        return self.ds.exists()
+
     def __repr__(self):
         return "<sorted-view[{}] of {!r}>".format(
             ", ".join(self.ss),
@@ -344,6 +733,280 @@ class OrderedDataSet(AbstractDataSet):
                 return tuple(record.get(k, extremum()) for k in sort_spec)
             return keyfunc
 
+CacheInfo = namedtuple("CacheInfo", "hits misses maxsize currsize")
+
+
+class CachedDataSet(AbstractDataSet):
+    """
+    A concrete implementation of a data set that wraps another data set
+    and caches the results of the queries made against it.
+
+    :param dataset: A data set whose results are cached.
+    :type dataset: :class:`AbstractDataSet`
+    :param ttl: The number of seconds for which a cached result remains
+        valid. If ``None``, results stay cached until they are evicted or
+        invalidated.
+    :param maxsize: The maximum number of results that are cached; the
+        least recently used results are evicted first.
+
+    The results of :meth:`fetch_now` and of iterating through the data
+    set (or any filtered, sorted or limited view of it) are cached.
+    Cached records are snapshots of the wrapped records' data; editing
+    or deleting one of them (or adding an item to a mutable data set)
+    is passed on to the wrapped data set and invalidates the entire
+    cache. Any data set can be wrapped::
+
+        cached = CachedDataSet(tasks(), ttl=30, maxsize=1000)
+        task = cached.fetch_now(id=3) # hits the backend
+        task = cached.fetch_now(id=3) # served from the cache
+
+    If *dataset* is a :class:`MutableDataSet`, then the wrapper is a
+    :class:`MutableDataSet` as well.
+    """
+
+    def __new__(cls, dataset, *args, **kwargs):
+        if cls is CachedDataSet and isinstance(dataset, MutableDataSet):
+            cls = CachedMutableDataSet
+        return super().__new__(cls)
+
+    def __init__(self, dataset, ttl=60, maxsize=128, _cache=None, _key=(),
+                 _root=None):
+        self.ds = dataset
+        self.cache = _QueryCache(ttl, maxsize) if _cache is None else _cache
+        self.key = _key
+        # The cached data set that views were made from
+        self.root = self if _root is None else _root
+
+    def __iter__(self):
+        snapshots = self._cached(
+            ('iter',),
+            lambda: tuple(map(_snapshot, self.ds))
+        )
+        for snapshot in snapshots:
+            yield self._wrap(snapshot)
+
+    def __repr__(self):
+        return "<cached-view({!r})>".format(self.ds)
+
+    def count(self):
+        return self._cached(('count',), self.ds.count)
+
+    def exists(self):
+        return self._cached(('exists',), self.ds.exists)
+
+    def fetch_now(self, **search_spec):
+        snapshot = self._cached(
+            ('fetch', _freeze(search_spec)),
+            lambda: _snapshot(self.ds.fetch_now(**search_spec))
+        )
+        return self._wrap(snapshot, search_spec)
+
+    def filtered(self, *args, **search_spec):
+        return self._view(self.ds.filtered(*args, **search_spec),
+                          'filter', args, search_spec)
+
+    def limit(self, count, offset=0):
+        return self._view(self.ds.limit(count, offset=offset), 
+                          'limit', count, offset)
+
+    def sorted(self, *sort_spec, descending=False):
+        return self._view(self.ds.sorted(*sort_spec, descending=descending),
+                          'sort', sort_spec, descending)
+
+    def cache_info(self):
+        """
+        Return a named tuple of cache statistics in the form
+        ``(hits, misses, maxsize, currsize)``.
+
+        The statistics are shared by the data set and all of its views.
+        """
+        return self.cache.info()
+
+    def invalidate(self):
+        """Discard all of the cached results."""
+        self.cache.clear()
+
+    def _cached(self, key, func):
+        key = self.key + key
+        value = self.cache.get(key, _MISSING)
+        if value is _MISSING:
+            value = func()
+            self.cache.put(key, value)
+        return value
+
+    def _view(self, dataset, *key):
+        return CachedDataSet(dataset, _cache=self.cache,
+                             _key=self.key + (_freeze(key),), _root=self.root)
+
+    def _wrap(self, snapshot, search_spec=None):
+        # Only snapshots of the records' data are cached; each call gets
+        # records of its own, so that a backend record (which might
+        # belong to a request) is never shared by later ones.
+        data, mutable = snapshot
+        data = dict(data)
+        if not mutable or not isinstance(self.root.ds, MutableDataSet):
+            return _CachedRecord(data)
+
+        if search_spec is None:
+            # Cached records outlive the request that read them, so
+            # edits are made to a freshly fetched copy of the record.
+            # Views might not be able to find it (e.g., a limited view),
+            # so it's fetched from the data set that they were made from.
+            dataset = self.root.ds
+            search_spec = {'id': data['id']} if 'id' in data else data
+        else:
+            dataset = self.ds
+
+        return _CachedMutableRecord(
+            data,
+            lambda: dataset.fetch_now(**search_spec),
+            self.cache
+        )
+
+
+class CachedMutableDataSet(CachedDataSet, MutableDataSet):
+    """
+    A :class:`CachedDataSet` that wraps a :class:`MutableDataSet`.
+
+    This class doesn't need to be used directly; :class:`CachedDataSet`
+    picks it automatically when it wraps a mutable data set.
+    """
+
+    def add(self, data):
+        try:
+            return self.ds.add(data)
+        finally:
+            self.invalidate()
+
+
+def _snapshot(record):
+    # The data of a record, and whether it could be edited.
+    return dict(record), isinstance(record, MutableRecord)
+
+
+# Marks a cache miss, since any value can be cached
+_MISSING = object()
+
+
+class _CachedRecord(AbstractRecord):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class _CachedMutableRecord(LazyMutableRecord):
+    def __init__(self, data, func, cache):
+        super().__init__(func)
+        self.data = data
+        self.cache = cache
+
+    def read(self):
+        return self.data
+
+    def patch(self, *args, **kwargs):
+        try:
+            super().patch(*args, **kwargs)
+        finally:
+            self.cache.clear()
+
+        self.data = dict(self.record)
+        self.invalidate()
+
+    def close_edit_block(self, token):
+        try:
+            super().close_edit_block(token)
+        finally:
+            self.cache.clear()
+
+        self.data = dict(self.record)
+        self.invalidate()
+
+    def delete(self):
+        try:
+            super().delete()
+        finally:
+            self.cache.clear()
+
+
+class _QueryCache:
+    # A thread-safe LRU cache whose entries expire after a time-to-live.
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                else:
+                    del self._entries[key]
+
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        expires = None if self.ttl is None else monotonic() + self.ttl
+        with self._lock:
+            self._entries[key] = expires, value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        with self._lock:
+            return CacheInfo(self.hits, self.misses, self.maxsize,
+                             len(self._entries))
+
+
+class _Identity:
+    # Makes any object usable in a cache key, by identity. Holding a
+    # reference also stops the object's id from being reused while
+    # the key is cached.
+    __slots__ = 'obj',
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __hash__(self):
+        return id(self.obj)
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and other.obj is self.obj
+
+
+def _freeze(value):
+    # Convert a query argument into a hashable value for a cache key.
+    if isinstance(value, (str, bytes, int, float, bool, type(None))):
+        return value
+    elif isinstance(value, Mapping):
+        return tuple(sorted(
+            ((k, _freeze(v)) for k, v in value.items()),
+            key=lambda item: item[0]
+        ))
+    elif isinstance(value, (tuple, list)):
+        return tuple(map(_freeze, value))
+    elif isinstance(value, FilterExpression):
+        return value.key
+    else:
+        return _Identity(value)
+
+
 __all__ = ['AbstractDataSet', 'AbstractRecord', 'MutableDataSet',
            'MutableRecord', 'FilteredDataSet', 'DataSetSlice',
-           'OrderedDataSet']
\ No newline at end of file
+           'OrderedDataSet', 'CachedDataSet', 'CachedMutableDataSet',
+           'RecordSchema', 'CompactRecord', 'F', 'FilterExpression',
+           'Comparison', 'And', 'Or', 'Not']
\ No newline at end of file
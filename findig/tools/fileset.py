@@ -0,0 +1,380 @@
+"""
+The :mod:`findig.tools.fileset` module defines :class:`FileSet`, a
+data set that persists its items to a local, append-only log file.
+
+Every change to the data set (adding, editing or deleting an item) is
+appended to the log as a checksummed frame, and an in-memory index maps
+each item's id to the position of its latest version in the file. Items
+are read straight out of a memory map of the log, so no backend server
+is needed at all::
+
+    @app.route("/tasks/")
+    @task.collection(lazy=True)
+    def tasks():
+        return FileSet("/var/lib/myapp/tasks.log")
+
+Opening the same path more than once in a process shares one log, so
+it is safe (and cheap) to create a :class:`FileSet` inside a resource
+function. The log must not be written to by more than one process at a
+time.
+
+.. warning:: Items are serialized with :mod:`pickle`; never open a log
+    file that comes from an untrusted source.
+
+"""
+
+from threading import Lock
+from uuid import uuid4
+import atexit
+import mmap
+import os
+import pickle
+import struct
+import zlib
+
+from findig.tools.dataset import MutableDataSet, MutableRecord, RecordSchema
+
+
+class FileSet(MutableDataSet):
+    """
+    FileSet(path, sync=False, include_ids=True, compact=False)
+
+    A :class:`~findig.tools.dataset.MutableDataSet` that stores its items
+    in an append-only log file.
+
+    :param path: The path to the log file. It is created if it doesn't
+        exist. The index is saved alongside it, in a sidecar file with
+        the same name and an ``.idx`` extension.
+    :param sync: If ``True``, every write is flushed to disk with
+        :func:`os.fsync` before it returns. Otherwise, writes survive a
+        process crash but may be lost if the whole machine goes down.
+    :param include_ids: If ``True``, each item's id is included in its
+        data as the ``id`` field.
+    :param compact: If true, iterating through the set produces read-only
+        :class:`~findig.tools.dataset.CompactRecord` instances that share
+        a schema (which may be given instead of ``True``). Items fetched
+        by id are unaffected.
+
+    Items added without an ``id`` field are given an integer id that
+    is one greater than the largest integer id in the set.
+    """
+
+    def __init__(self, path, sync=False, include_ids=True, compact=False):
+        self.log = _open_log(path)
+        self.sync = sync
+        self.include_ids = include_ids
+        self.schema = RecordSchema() if compact is True else compact or None
+
+    def __repr__(self):
+        return "<file-set({!r})>".format(self.log.path)
+
+    def __iter__(self):
+        make_record = self._make_record if self.schema is None \
+                      else self._make_compact_record
+        for id in self.log.ids():
+            try:
+                yield make_record(id, self.log.read(id))
+            except KeyError:
+                # The item was deleted while we were iterating.
+                continue
+
+    def add(self, data):
+        id = data['id'] if 'id' in data else self.log.next_id()
+        self.log.put(id, dict(data), self.sync)
+        return {'id': id}
+
+    def fetch_now(self, **spec):
+        if list(spec) == ['id']:
+            # Fetching by ID only; just look the item up in the index.
+            try:
+                return self._make_record(spec['id'], self.log.read(spec['id']))
+            except KeyError:
+                raise LookupError("No matching item found.")
+        else:
+            return super(FileSet, self).fetch_now(**spec)
+
+    def count(self):
+        return len(self.log)
+
+    def exists(self):
+        return len(self.log) > 0
+
+    def clear(self):
+        """Remove every item from the data set."""
+        self.log.reset(self.sync)
+
+    def compact(self):
+        """
+        Rewrite the log so that it only contains the latest version of
+        each item, reclaiming the space used by old versions and deleted
+        items.
+        """
+        self.log.compact()
+
+    def save_index(self):
+        """
+        Write the index to its sidecar file, so that the log can be
+        reopened without replaying it from the start.
+
+        This is done automatically by :meth:`compact` and when the
+        interpreter exits.
+        """
+        self.log.save_index()
+
+    def _make_record(self, id, data):
+        record = _FileRecord(self, id)
+        record.invalidate(new_data=record.present(data))
+        return record
+
+    def _make_compact_record(self, id, data):
+        if self.include_ids:
+            data['id'] = id
+        return self.schema.record(data)
+
+
+class _FileRecord(MutableRecord):
+    def __init__(self, fileset, id):
+        self.fs = fileset
+        self.id = id
+
+    def __repr__(self):
+        return "<item({!r}) of {!r}>".format(self.id, self.fs)
+
+    def read(self):
+        try:
+            return self.present(self.fs.log.read(self.id))
+        except KeyError:
+            raise LookupError("No matching item found.")
+
+    def present(self, data):
+        if self.fs.include_ids:
+            data['id'] = self.id
+        return data
+
+    def patch(self, add_data, remove_fields, replace=False):
+        try:
+            data = {} if replace else dict(self.fs.log.read(self.id))
+        except KeyError:
+            raise LookupError("No matching item found.")
+        for field in remove_fields:
+            data.pop(field, None)
+        data.update(add_data)
+
+        self.fs.log.put(self.id, data, self.fs.sync)
+        self.invalidate(new_data=self.present(dict(data)))
+
+    def delete(self):
+        self.fs.log.delete(self.id, self.fs.sync)
+        self.invalidate()
+
+
+# Every log file starts with a header that holds a random generation
+# id; the sidecar index records the generation that it belongs to, so a
+# stale index (e.g., left behind by an interrupted compaction) is never
+# used with the wrong log.
+_MAGIC = b'FINDIGLOG\x01'
+_HEADER = struct.Struct('>10s16s')
+
+# Each frame is an operation code, the length of the payload and its
+# CRC-32, followed by the payload itself.
+_FRAME = struct.Struct('>BII')
+_PUT, _DELETE = 1, 2
+
+_logs = {}
+_logs_lock = Lock()
+
+
+def _open_log(path):
+    path = os.path.realpath(path)
+    with _logs_lock:
+        if path not in _logs:
+            _logs[path] = _Log(path)
+        return _logs[path]
+
+
+@atexit.register
+def _save_indexes():
+    with _logs_lock:
+        for log in _logs.values():
+            log.save_index()
+
+
+class _Log:
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.index = {}
+        self.lock = Lock()
+        self.map = None
+
+        self.fh = open(path, 'a+b')
+        self.fh.seek(0, os.SEEK_END)
+        if self.fh.tell() == 0:
+            self._write_header()
+
+        with self.lock:
+            self._load()
+
+    def __len__(self):
+        return len(self.index)
+
+    def ids(self):
+        with self.lock:
+            return list(self.index)
+
+    def next_id(self):
+        with self.lock:
+            self.last_id += 1
+            return self.last_id
+
+    def read(self, id):
+        with self.lock:
+            offset, length = self.index[id]
+            if self.map is None or offset + length > len(self.map):
+                self._remap()
+            with memoryview(self.map) as buf, \
+                 buf[offset:offset+length] as view:
+                return pickle.loads(view)[1]
+
+    def put(self, id, data, sync=False):
+        with self.lock:
+            offset, length = self._append(_PUT, id, data, sync)
+            self.index[id] = offset, length
+            if isinstance(id, int):
+                self.last_id = max(self.last_id, id)
+
+    def delete(self, id, sync=False):
+        with self.lock:
+            if id not in self.index:
+                raise LookupError("No matching item found.")
+            self._append(_DELETE, id, None, sync)
+            del self.index[id]
+
+    def reset(self, sync=False):
+        with self.lock:
+            self._close_map()
+            self.fh.truncate(0)
+            self._write_header()
+            self.index.clear()
+            self.last_id = 0
+            if sync:
+                os.fsync(self.fh.fileno())
+            self._save_index()
+
+    def compact(self):
+        with self.lock:
+            tmp_path = self.path + '.compact'
+            generation = uuid4().bytes
+            index = {}
+
+            with open(tmp_path, 'wb') as out:
+                out.write(_HEADER.pack(_MAGIC, generation))
+                self._remap()
+                for id, (offset, length) in self.index.items():
+                    out.write(self.map[offset-_FRAME.size:offset+length])
+                    index[id] = out.tell() - length, length
+                out.flush()
+                os.fsync(out.fileno())
+
+            self._close_map()
+            self.fh.close()
+            os.replace(tmp_path, self.path)
+
+            self.fh = open(self.path, 'a+b')
+            self.generation = generation
+            self.index = index
+            self._save_index()
+
+    def save_index(self):
+        with self.lock:
+            self._save_index()
+
+    def _append(self, op, id, data, sync):
+        payload = pickle.dumps((id, data), pickle.HIGHEST_PROTOCOL)
+        frame = _FRAME.pack(op, len(payload), zlib.crc32(payload))
+
+        self.fh.seek(0, os.SEEK_END)
+        offset = self.fh.tell() + _FRAME.size
+        self.fh.write(frame + payload)
+        self.fh.flush()
+        if sync:
+            os.fsync(self.fh.fileno())
+
+        return offset, len(payload)
+
+    def _write_header(self):
+        self.generation = uuid4().bytes
+        self.fh.write(_HEADER.pack(_MAGIC, self.generation))
+        self.fh.flush()
+
+    def _load(self):
+        self.fh.seek(0)
+        magic, self.generation = _HEADER.unpack(self.fh.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError("Not a data set log: {}".format(self.path))
+
+        start = _HEADER.size
+        try:
+            with open(self.index_path, 'rb') as fh:
+                saved = pickle.load(fh)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        else:
+            self.fh.seek(0, os.SEEK_END)
+            if saved['generation'] == self.generation \
+               and saved['end'] <= self.fh.tell():
+                self.index = saved['index']
+                start = saved['end']
+
+        self._replay(start)
+        ids = [id for id in self.index if isinstance(id, int)]
+        self.last_id = max(ids, default=0)
+
+    def _replay(self, offset):
+        # Apply the frames written after the index was saved. A frame
+        # that is incomplete or fails its checksum can only be the
+        # result of a crash in the middle of an append, so it (and
+        # anything after it) is cut off.
+        self.fh.seek(offset)
+        while True:
+            header = self.fh.read(_FRAME.size)
+            if len(header) < _FRAME.size:
+                break
+
+            op, length, checksum = _FRAME.unpack(header)
+            payload = self.fh.read(length)
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+
+            id, _ = pickle.loads(payload)
+            if op == _PUT:
+                self.index[id] = offset + _FRAME.size, length
+            else:
+                self.index.pop(id, None)
+            offset += _FRAME.size + length
+
+        self.fh.truncate(offset)
+
+    def _save_index(self):
+        self.fh.seek(0, os.SEEK_END)
+        saved = {
+            'generation': self.generation,
+            'end': self.fh.tell(),
+            'index': self.index,
+        }
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            pickle.dump(saved, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.index_path)
+
+    def _remap(self):
+        self._close_map()
+        self.map = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+__all__ = ['FileSet']
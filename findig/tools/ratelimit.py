@@ -0,0 +1,368 @@
+"""
+The :mod:`findig.tools.ratelimit` module defines the :class:`RateLimiter`
+tool, which turns away requests to an application (or to its resources)
+that come in faster than the limits that are set on it, with a
+*429 Too Many Requests* response::
+
+    limiter = RateLimiter(app)
+
+    @limiter.partition('ip')
+    def get_ip(request):
+        return request.remote_addr
+
+    # Each client can make 1000 requests an hour...
+    limiter.limit(1000, per=3600, ip=limiter.any)
+
+    # ... but only 10 requests a second to this resource.
+    limiter.limit(10, per=1, resource=search, ip=limiter.any)
+
+Requests are checked before they're handled, so rejecting one is cheap.
+Each limit is enforced with the `generic cell rate algorithm
+<https://en.wikipedia.org/wiki/Generic_cell_rate_algorithm>`_ (a token
+bucket that stores a single timestamp), so a check takes constant time
+and space no matter how many requests a client has made.
+
+"""
+
+from abc import ABCMeta, abstractmethod
+from hashlib import blake2b
+from threading import Lock
+from time import time
+import math
+import struct
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+from werkzeug.exceptions import TooManyRequests
+
+from findig.context import ctx
+from findig.tools.counter import _open_shared_file, _seconds
+
+
+class RateLimiter:
+    """
+    A :class:`RateLimiter` rejects requests that exceed the limits set on
+    an application and its resources.
+
+    :param app: The findig application whose requests the limiter will
+        check.
+    :type app: :class:`findig.App`, or a subclass like :class:`findig.json.App`.
+    :param storage: An :class:`AbstractRateStore` that keeps track of
+        the requests that have been allowed. By default, the limiter uses
+        a :class:`MemoryRateStore`, which only knows about the requests
+        served by the current process; :class:`SharedMemoryRateStore`
+        and :class:`findig.extras.redis.RedisRateStore` can be used to
+        apply limits across processes.
+
+    """
+
+    any = [] # just needed an unhashable object here
+
+    def __init__(self, app=None, storage=None):
+        self.storage = MemoryRateStore() if storage is None else storage
+        self.partitioners = {}
+        # Limits are indexed by resource name (or None)
+        self.limits = {}
+
+        if app is not None:
+            self.attach_to(app)
+
+    def attach_to(self, app):
+        """
+        Attach the limiter to a findig application.
+
+        .. note:: This is called automatically for any app that is passed
+            to the limiter's constructor.
+
+        :param app: The findig application whose requests the limiter will
+            check.
+        :type app: :class:`findig.App`, or a subclass like
+            :class:`findig.json.App`.
+
+        """
+        app.context(self)
+
+    def partition(self, name, fgroup=None):
+        """
+        Create a partition that limits can be applied by.
+
+        Partitions work just like they do for
+        :meth:`findig.tools.counter.Counter.partition`: the grouping
+        function takes a request and returns a hashable value that
+        identifies the group that the request falls into (for example,
+        the client's address).
+
+        This method can be used as a decorator factory::
+
+            @limiter.partition('ip')
+            def getip(request):
+                return request.remote_addr
+
+        """
+        def add_partitioner(keyfunc):
+            self.partitioners[name] = keyfunc
+            return keyfunc
+
+        if fgroup is not None:
+            return add_partitioner(fgroup)
+        else:
+            return add_partitioner
+
+    def limit(self, n, per, resource=None, **partition_spec):
+        """
+        Allow at most *n* requests in every period of *per*.
+
+        :param n: The number of requests that are allowed in a period.
+            Up to *n* requests can be made at once, after which requests
+            are allowed at an even rate of *n* per period.
+        :param per: The length of the period, as a
+            :class:`datetime.timedelta` or a number of seconds.
+        :param resource: If given, only the requests to this resource are
+            limited. Otherwise, the limit applies to all of the requests
+            to the application.
+
+        If partitions have been set up (see :meth:`partition`), additional
+        keyword arguments can be given as ``{partition_name}={group}``,
+        so that only the requests that fall into the group are limited.
+        Giving :attr:`any` as the group sets a separate limit for each
+        group; for example, to allow each client 100 requests a minute::
+
+            limiter.limit(100, per=60, ip=limiter.any)
+
+        Requests that exceed a limit are rejected with a
+        :class:`RateLimitExceeded` error.
+
+        """
+        for name in partition_spec:
+            if name not in self.partitioners:
+                raise TypeError("Unknown argument: {}".format(name))
+
+        key = None if resource is None else resource.name
+        limits = self.limits.setdefault(key, [])
+        # Limits are told apart in the store by where they were set, so
+        # processes that set up the same limits share their state.
+        name = "{}:{}".format('*' if key is None else key, len(limits))
+        limits.append(_Limit(name, n, _seconds(per), partition_spec))
+
+    def __call__(self):
+        # Calling the limiter checks the request against the limits.
+        request = ctx.request
+        resource = ctx.resource
+        limits = self.limits.get(resource.name, []) + \
+                 self.limits.get(None, [])
+
+        if limits:
+            partitions = {name: func(request)
+                          for name, func in self.partitioners.items()}
+            for limit in limits:
+                if limit.matches(partitions):
+                    wait = self.storage.acquire(
+                        limit.key(partitions), limit.n, limit.period)
+                    if wait > 0:
+                        raise RateLimitExceeded(retry_after=wait)
+
+        yield
+
+
+class RateLimitExceeded(TooManyRequests):
+    """
+    The error raised for a request that exceeds a limit. It's a
+    :class:`werkzeug.exceptions.TooManyRequests` error whose response
+    has a ``Retry-After`` header.
+
+    :param retry_after: The number of seconds until the request would
+        be allowed.
+    """
+
+    def __init__(self, description=None, response=None, retry_after=None):
+        super().__init__(description, response)
+        self.retry_after = retry_after
+
+    def get_headers(self, environ=None):
+        headers = super().get_headers(environ)
+        if self.retry_after is not None:
+            headers.append(('Retry-After',
+                            str(max(1, math.ceil(self.retry_after)))))
+        return headers
+
+
+class _Limit:
+    __slots__ = 'name', 'n', 'period', 'partby'
+
+    def __init__(self, name, n, period, partby):
+        self.name = name
+        self.n = n
+        self.period = period
+        self.partby = partby
+
+    def matches(self, partitions):
+        return all(v is RateLimiter.any or v == partitions[p]
+                   for p, v in self.partby.items())
+
+    def key(self, partitions):
+        # The limit is kept separately for each group that it matches.
+        groups = tuple(sorted((p, partitions[p]) for p in self.partby))
+        return repr((self.name, groups))
+
+
+class AbstractRateStore(metaclass=ABCMeta):
+    """
+    Abstract base for the storage of a :class:`RateLimiter`.
+    """
+
+    @abstractmethod
+    def acquire(self, key, n, period):
+        """
+        Record a request for a limit of *n* requests every *period*
+        seconds, if the limit allows it.
+
+        :param key: A string that identifies the limit (and the group
+            that it's applied to).
+        :return: ``0`` if the request is allowed, otherwise the number of
+            seconds until it would be. Requests that aren't allowed
+            aren't recorded.
+
+        The :func:`gcra` function can be used to apply the limit.
+        """
+
+
+def gcra(tat, now, n, period):
+    """
+    Apply the generic cell rate algorithm for a request at *now*.
+
+    :param tat: The *theoretical arrival time* stored for the limit, or
+        ``None`` if nothing has been stored.
+    :return: A ``(tat, wait)`` pair. If the request is allowed, *wait*
+        is ``0`` and *tat* is the value to store; otherwise *wait* is the
+        number of seconds until it would be allowed, and *tat* is
+        ``None``.
+
+    Each request moves the theoretical arrival time forward by
+    ``period / n``, starting from the present; a request is allowed as
+    long as that doesn't put the time more than *period* ahead.
+    """
+    new_tat = max(now if tat is None else tat, now) + period / n
+    if new_tat - now > period:
+        return None, new_tat - now - period
+    else:
+        return new_tat, 0
+
+
+class MemoryRateStore(AbstractRateStore):
+    """
+    A thread-safe, in-memory :class:`AbstractRateStore`. Only the
+    requests served by the current process are counted against a limit.
+    """
+
+    def __init__(self):
+        self._tats = {}
+        self._lock = Lock()
+        self._purge_at = 1024
+
+    def acquire(self, key, n, period):
+        now = time()
+        with self._lock:
+            tat, wait = gcra(self._tats.get(key), now, n, period)
+            if tat is not None:
+                self._tats[key] = tat
+                if len(self._tats) >= self._purge_at:
+                    self._purge(now)
+            return wait
+
+    def _purge(self, now):
+        # Drop the limits that have gone back to allowing a full burst,
+        # no more often than the number of limits doubles.
+        self._tats = {k: t for k, t in self._tats.items() if t > now}
+        self._purge_at = max(1024, 2 * len(self._tats))
+
+
+class SharedMemoryRateStore(AbstractRateStore):
+    """
+    SharedMemoryRateStore(path, slots=4096)
+
+    An :class:`AbstractRateStore` that keeps its state in a
+    memory-mapped file, so that every worker process of an application
+    on the same host enforces the same limits (see
+    :class:`findig.tools.counter.SharedMemoryHitLog`).
+
+    :param path: The path of the file. Limits are told apart by the
+        order in which they were set, so each application needs a file
+        of its own. The file must be owned by the user that the
+        application runs as, and mustn't be writable by anyone else; a
+        directory that only that user can write to is best.
+    :param slots: The number of limits (and groups) that the file has
+        room for at once. Each takes 16 bytes. Once a limit for a group
+        has gone back to allowing a full burst, its slot can be reused.
+        If there's no room for a group, its requests aren't limited.
+
+    .. note:: This storage class is only available on Unix.
+    """
+
+    def __init__(self, path, slots=4096):
+        if fcntl is None:
+            raise RuntimeError("SharedMemoryRateStore is only available "
+                               "on Unix.")
+        self.path = path
+        self._slots = slots
+        self._file = _open_shared_file(
+            path, _RL_HEADER.pack(_RL_MAGIC, slots),
+            _RL_HEADER.size + _RL_ENTRY.size * slots)
+
+    def __repr__(self):
+        return "<shared-memory-rate-store({!r})>".format(self.path)
+
+    def acquire(self, key, n, period):
+        # Zero marks an empty slot
+        hashed = _hash(key) | 1
+        first = hashed % self._slots
+        now = time()
+        buf = self._file.map
+
+        with self._file.locked(fcntl.LOCK_EX):
+            # Look for the key among a few slots, remembering the first
+            # one that could be (re)used for it.
+            found = free = None
+            for i in range(min(_RL_PROBES, self._slots)):
+                offset = _RL_HEADER.size \
+                         + _RL_ENTRY.size * ((first + i) % self._slots)
+                k, tat = _RL_ENTRY.unpack_from(buf, offset)
+                if k == hashed:
+                    found = offset
+                    break
+                elif free is None and (k == 0 or tat <= now):
+                    free = offset
+
+            if found is not None:
+                tat = _RL_ENTRY.unpack_from(buf, found)[1]
+            elif free is not None:
+                found, tat = free, None
+            else:
+                # No room; the request is let through.
+                return 0
+
+            tat, wait = gcra(tat, now, n, period)
+            if tat is not None:
+                _RL_ENTRY.pack_into(buf, found, hashed, tat)
+            return wait
+
+
+def _hash(key):
+    # A hash that's the same in every process
+    digest = blake2b(key.encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+# The layout of a SharedMemoryRateStore's file: a header with the number
+# of slots, followed by the slots, which each hold the hash of a key and
+# its theoretical arrival time.
+_RL_MAGIC = b'FINDIGRL'
+_RL_HEADER = struct.Struct('<8sq')
+_RL_ENTRY = struct.Struct('<Qd')
+_RL_PROBES = 16
+
+
+__all__ = ['RateLimiter', 'RateLimitExceeded', 'AbstractRateStore',
+           'MemoryRateStore', 'SharedMemoryRateStore', 'gcra']
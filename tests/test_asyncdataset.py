@@ -0,0 +1,104 @@
+import asyncio
+
+import pytest
+from findig.tools.asyncdataset import *
+from findig.tools.dataset import MutableDataSet, MutableRecord
+
+
+class MockDataSet(MutableDataSet):
+    def __init__(self):
+        self.data = []
+
+    def add(self, data):
+        self.data.append(data)
+
+    def __iter__(self):
+        yield from (MockRecord(d) for d in self.data)
+
+class MockRecord(MutableRecord):
+    def __init__(self, d):
+        self.d = d
+
+    def read(self):
+        return self.d
+
+    def patch(self, add_data, remove_fields):
+        for field in remove_fields:
+            del self.d[field]
+        self.d.update(add_data)
+        self.invalidate()
+
+    def delete(self):
+        self.d.clear()
+
+@pytest.fixture
+def people():
+    mds = MockDataSet()
+    mds.add(dict(id=1, name="Te-jé Rodgers", age=25))
+    mds.add(dict(id=2, name="John Smith", age=34))
+    mds.add(dict(id=3, name="Terrance Riverdarb", age=16))
+    mds.add(dict(id=4, name="Anna Harris", age=74))
+    mds.add(dict(id=5, name="Jen Brathwaithe", age=32))
+    return AsyncDataSetAdapter(mds, batch_size=2)
+
+def test_async_adapter(people):
+    async def query():
+        ids = [r['id'] async for r in people]
+        older = [r['id'] async for r in people.filtered(age=lambda a: a > 30)]
+        return ids, older, await people.count(), await people.exists()
+
+    assert isinstance(people, AsyncMutableDataSet)
+    assert run_sync(query()) == ([1, 2, 3, 4, 5], [2, 4, 5], 5, True)
+
+def test_async_adapter_edits(people):
+    async def edit():
+        await people.add(dict(id=6, name="Glen Posner", age=52))
+        record = await people.fetch_now(id=6)
+        await record.patch(dict(age=53), ())
+        return dict(record), dict(await people.fetch_now(id=6))
+
+    assert run_sync(edit()) == (dict(id=6, name="Glen Posner", age=53),) * 2
+
+def test_run_sync_gather():
+    from concurrent.futures import ThreadPoolExecutor
+    from threading import Barrier
+
+    # Neither count can finish until both are running
+    barrier = Barrier(2, timeout=5)
+    class Blocking(MockDataSet):
+        def count(self):
+            barrier.wait()
+            return len(self.data)
+
+    def adapter(n):
+        ds = Blocking()
+        for i in range(n):
+            ds.add(dict(id=i))
+        return AsyncDataSetAdapter(ds)
+
+    async def counts():
+        return await asyncio.gather(adapter(2).count(), adapter(3).count())
+
+    # Resource functions are run in worker threads
+    with ThreadPoolExecutor(1) as executor:
+        assert executor.submit(run_sync, counts()).result() == [2, 3]
+
+def test_sync_adapter(people):
+    people = SyncDataSetAdapter(people)
+    assert isinstance(people, MutableDataSet)
+    assert [r['id'] for r in people.sorted('age').limit(2)] == [3, 1]
+    assert people.fetch_now(id=4)['name'] == "Anna Harris"
+    people.fetch_now(id=4)['age'] = 75
+    assert people.fetch_now(id=4)['age'] == 75
+    assert people.count() == 5
+
+def test_generic_views(people):
+    class Numbers(AsyncDataSet):
+        async def __aiter__(self):
+            for i in (3, 1, 4, 1, 5, 9, 2, 6):
+                yield AsyncRecord({'n': i})
+
+    numbers = SyncDataSetAdapter(Numbers())
+    assert [r['n'] for r in numbers.sorted('n').limit(3, offset=1)] == [1, 2, 3]
+    assert [r['n'] for r in numbers.filtered(n=1)] == [1, 1]
+    assert numbers.count() == 8
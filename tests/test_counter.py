@@ -33,6 +33,7 @@ def test_totals(client, counter):
     assert counter.hits().count(method='get') == 100
     assert counter.hits().count(method='put') == 0
     assert counter.hits().count(foo='bar') == 0
+    assert [hit.partitions for hit in counter.hits()] == [{'method': 'get'}] * 100
 
 def test_callbacks(client, counter):
     args = []
@@ -85,4 +86,380 @@ def test_callbacks_with_partitions(client, counter):
         client.get("/{}".format(query))
 
     assert len(results['any_team']) == 2
-    assert results['any_team'] == [('code', 'John'), ('qa', 'Smithy')]
\ No newline at end of file
+    assert results['any_team'] == [('code', 'John'), ('qa', 'Smithy')]
+
+
+def test_bucketed_log(app, client, monkeypatch):
+    from datetime import timedelta
+    from findig.tools import counter as counter_module
+    from findig.tools.counter import BucketedHitLog
+
+    now = [1000.0]
+    monkeypatch.setattr(counter_module, 'time', lambda: now[0])
+
+    counter = Counter(app, duration=3,
+                      storage=BucketedHitLog.configure(resolution=1))
+    counter.partition('x', lambda request: request.args.get('x'))
+
+    for x in ['a', 'b', 'a']:
+        client.get("/?x={}".format(x))
+        now[0] += 1
+
+    # The first hit is now outside of the window
+    assert counter.hits().count() == 2
+    assert counter.hits().count(x='a') == 1
+    assert [hit.partitions for hit in counter.hits()] == [{'x': 'b'},
+                                                          {'x': 'a'}]
+
+    now[0] += 10
+    client.get("/?x=a")
+    assert counter.hits().count() == 1
+    assert counter.hits().count(x='b') == 0
+    log, = counter.logs.values()
+    assert len(log._counter) == 1
+
+    # There'd be no buckets to count hits in
+    with pytest.raises(ValueError):
+        Counter(duration=0, storage=BucketedHitLog)
+    with pytest.raises(ValueError):
+        BucketedHitLog(timedelta(0), None)
+
+def test_global_hits(app, client, counter):
+    @app.route("/other")
+    def other():
+        return {}
+
+    fired = []
+    counter.every(2, lambda: fired.append(ctx.request.path))
+
+    for path in ["/", "/other", "/", "/other"]:
+        client.get(path)
+
+    assert counter.hits().count() == 4
+    # Counted across resources: the first and third hits
+    assert fired == ["/", "/"]
+    with pytest.raises(NotImplementedError):
+        counter.hits().track({})
+
+    # Resource logs can be combined into a lazy, time-ordered view
+    logs = list(counter.logs.values())
+    combined = logs[0] + logs[1]
+    assert combined.count() == 4
+    times = [hit.time for hit in combined]
+    assert times == sorted(times)
+
+def test_callback_index(app, client, counter, monkeypatch):
+    @counter.partition('x')
+    def get_x(request):
+        return request.args.get('x')
+
+    fired = []
+    counter.at(2, lambda x: fired.append(('at', x)), x='a')
+    counter.every(2, lambda x: fired.append(('every', x)), x=counter.any)
+
+    counts = []
+    count = counter.global_log.count
+    def counting_count(**partitions):
+        counts.append(partitions)
+        return count(**partitions)
+    monkeypatch.setattr(counter.global_log, 'count', counting_count)
+
+    for x in ['a', 'b', 'a', 'a']:
+        client.get("/?x={}".format(x))
+
+    assert fired == [('every', 'a'), ('every', 'b'), ('at', 'a'),
+                     ('every', 'a')]
+    # Both callbacks count by the same partition, so the hits are only
+    # counted once per request.
+    assert len(counts) == 4
+    # The 'at' callback has fired for the last time, so it's dropped
+    remaining = counter.callbacks['before'][None][('x',)]
+    assert [cb.n for cb in remaining] == [2]
+
+def test_sketch_log(app, client, monkeypatch):
+    from findig.tools import counter as counter_module
+    from findig.tools.counter import SketchHitLog
+
+    now = [1000.0]
+    monkeypatch.setattr(counter_module, 'time', lambda: now[0])
+
+    storage = SketchHitLog.configure(error=0.05, resolution=1)
+    counter = Counter(app, duration=2, storage=storage)
+    counter.partition('ip', lambda request: request.args['ip'])
+    counter.partition('method', lambda request: request.method)
+
+    for i in range(100):
+        client.get("/?ip=10.0.0.{}".format(i % 20))
+
+    log = counter.global_log
+    assert len(log._sketch) == 55 * 5
+    assert counter.hits().count() == 100
+    # Estimates can only be too high, by at most 5% of the 300 counts
+    # (with 99% confidence)
+    for i in range(20):
+        assert 5 <= counter.hits().count(ip="10.0.0.{}".format(i)) <= 20
+    assert counter.hits().count(ip="10.0.0.1", method="GET") >= 5
+    assert counter.hits().count(method="GET") >= 100
+    assert len(list(counter.hits())) == 100
+
+    now[0] += 1
+    client.get("/?ip=10.0.0.1")
+    now[0] += 1
+    assert counter.hits().count() == 1
+    assert counter.hits().count(ip="10.0.0.1") == 1
+    assert counter.hits().count(ip="10.0.0.2") == 0
+
+
+def test_distinct(app, client, monkeypatch):
+    from findig.tools import counter as counter_module
+    from findig.tools.counter import BucketedHitLog, SketchHitLog
+
+    now = [1000.0]
+    monkeypatch.setattr(counter_module, 'time', lambda: now[0])
+
+    counters = [
+        Counter(app, duration=2, storage=storage)
+        for storage in (SketchHitLog.configure(resolution=1),
+                        BucketedHitLog.configure(resolution=1))
+    ]
+    for counter in counters:
+        counter.partition('ip', lambda request: request.args['ip'])
+
+    for i in range(100):
+        client.get("/?ip=10.0.0.{}".format(i % 20))
+
+    for counter in counters:
+        assert counter.hits().distinct('ip') == 20
+        assert counter.hits().distinct('method') == 0
+
+    now[0] += 1
+    client.get("/?ip=10.0.0.100")
+    now[0] += 1
+    for counter in counters:
+        assert counter.hits().distinct('ip') == 1
+
+
+def test_hyperloglog():
+    from findig.tools.counter import HyperLogLog
+
+    a, b = HyperLogLog(), HyperLogLog()
+    for i in range(10000):
+        a.add(i)
+        b.add(i + 5000)
+    assert HyperLogLog().count() == 0
+    assert 9500 <= a.count() <= 10500
+
+    merged = a.copy()
+    merged.update(b)
+    assert 14250 <= merged.count() <= 15750
+    assert 9500 <= a.count() <= 10500
+
+    with pytest.raises(ValueError):
+        a.update(HyperLogLog(10))
+
+
+@pytest.mark.parametrize('storage', [None, 'bucketed', 'sketch'])
+def test_top(app, client, storage):
+    from findig.tools.counter import BucketedHitLog, SketchHitLog
+
+    storage = {
+        'bucketed': BucketedHitLog,
+        'sketch': SketchHitLog.configure(heavy_hitters=4),
+    }.get(storage)
+    counter = Counter(app, storage=storage)
+    counter.partition('ip', lambda request: request.args['ip'])
+
+    fired = []
+    counter.every(5, lambda ip: fired.append(ip), after=2, ip=counter.top(1))
+
+    # A busy client among many others that make a request each
+    for i in range(60):
+        ip = "10.0.0.1" if i % 3 == 0 else "10.0.1.{}".format(i)
+        client.get("/?ip={}".format(ip))
+
+    top = counter.hits().top('ip', 1)
+    assert top[0][0] == "10.0.0.1"
+    assert 20 <= top[0][1] <= 25
+    assert len(counter.hits().top('ip', 3)) == 3
+    assert counter.hits().top('method', 3) == []
+    assert fired == ["10.0.0.1"] * 4
+
+
+def test_striped_log(app, client):
+    from threading import Thread
+    from findig.tools.counter import StripedHitLog
+
+    storage = StripedHitLog.configure(stripes=4)
+    counter = Counter(app, storage=storage)
+    counter.partition('ip', lambda request: request.args['ip'])
+
+    def make_requests(ip):
+        c = Client(app)
+        for _ in range(10):
+            c.get("/?ip={}".format(ip))
+
+    threads = [Thread(target=make_requests, args=("10.0.0.{}".format(i),))
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    log = counter.global_log
+    assert [len(stripe) for stripe in log._stripes] == [20, 20, 10, 10]
+    assert counter.hits().count() == 60
+    assert counter.hits().count(ip="10.0.0.3") == 10
+    assert counter.hits().distinct('ip') == 6
+    assert counter.hits().top('ip', 1)[0][1] == 10
+    assert len(list(counter.hits())) == 60
+
+    with pytest.raises(TypeError):
+        Counter(app, storage=StripedHitLog.configure(shards=4))
+
+
+def test_shared_memory_log(app, client, monkeypatch, tmpdir):
+    import os
+    from findig.tools import counter as counter_module
+    from findig.tools.counter import SharedMemoryHitLog
+
+    now = [1000.0]
+    monkeypatch.setattr(counter_module, 'time', lambda: now[0])
+
+    storage = SharedMemoryHitLog.configure(
+        path=str(tmpdir.join('hits')), resolution=1, slots=64)
+    counter = Counter(app, duration=2, storage=storage)
+    counter.partition('ip', lambda request: request.args['ip'])
+
+    # Hits recorded by a forked worker are counted by its parent
+    pid = os.fork()
+    if pid == 0:
+        try:
+            for i in range(10):
+                client.get("/?ip=10.0.0.{}".format(i % 3))
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    client.get("/?ip=10.0.0.9")
+
+    assert counter.hits().count() == 11
+    assert counter.hits().count(ip="10.0.0.0") == 4
+    assert counter.hits().count(ip="10.0.0.8") == 0
+    assert counter.hits().distinct('ip') == 4
+    assert counter.hits().top('ip', 1) == [("10.0.0.0", 4)]
+    assert len(list(counter.hits())) == 11
+
+    # A recycled worker picks up where the old one left off
+    recycled = Counter(duration=2, storage=storage)
+    assert recycled.hits().count(ip="10.0.0.1") == 3
+
+    now[0] += 1
+    client.get("/?ip=10.0.0.1")
+    now[0] += 1
+    assert counter.hits().count() == 1
+    assert counter.hits().count(ip="10.0.0.1") == 1
+    assert counter.hits().count(ip="10.0.0.0") == 0
+
+    with pytest.raises(ValueError):
+        Counter(app, duration=3600, storage=storage)
+
+
+def test_shared_memory_log_full(app, client, tmpdir):
+    from findig.tools.counter import SharedMemoryHitLog
+
+    storage = SharedMemoryHitLog.configure(path=str(tmpdir.join('hits')),
+                                           slots=4)
+    counter = Counter(app, storage=storage)
+    counter.partition('ip', lambda request: request.args['ip'])
+
+    for i in range(10):
+        client.get("/?ip=10.0.0.{}".format(i))
+
+    # Only the groups that fit in the table are counted by group
+    assert counter.hits().count() == 10
+    assert counter.hits().distinct('ip') == 3
+
+
+def test_shared_memory_log_composite(tmpdir):
+    from findig.tools.counter import SharedMemoryHitLog
+
+    a, b = (SharedMemoryHitLog.configure(path=str(tmpdir.join(name)))(-1, None)
+            for name in 'ab')
+    a.track({'ip': '10.0.0.1'})
+    b.track({'ip': '10.0.0.1'})
+    b.track({'ip': '10.0.0.2'})
+
+    assert a.distinct('ip') == 1
+    assert (a + b).distinct('ip') == 2
+    assert a.distinct_sketch('ip').count() == 1
+
+
+def test_shared_memory_log_expired(app, client, monkeypatch, tmpdir):
+    from findig.tools import counter as counter_module
+    from findig.tools.counter import SharedMemoryHitLog
+
+    now = [1000.0]
+    monkeypatch.setattr(counter_module, 'time', lambda: now[0])
+
+    storage = SharedMemoryHitLog.configure(path=str(tmpdir.join('hits')),
+                                           resolution=1, slots=16)
+    counter = Counter(app, duration=2, storage=storage)
+    counter.partition('ip', lambda request: request.args['ip'])
+
+    # Fill the table (the total takes an entry too)
+    for i in range(15):
+        client.get("/?ip=10.0.0.{}".format(i))
+    client.get("/?ip=10.0.0.3")
+    now[0] += 3
+    assert counter.hits().count() == 0
+
+    # The counters of the groups that have expired are reused
+    client.get("/?ip=fresh")
+    client.get("/?ip=fresh")
+    client.get("/?ip=10.0.0.3")
+    assert counter.hits().count() == 3
+    assert counter.hits().count(ip='fresh') == 2
+    assert counter.hits().count(ip='10.0.0.3') == 1
+    assert counter.hits().top('ip', 2) == [('fresh', 2), ('10.0.0.3', 1)]
+
+
+def test_log_created_once(app, client):
+    from findig.tools.counter import _HitLog
+
+    created = []
+    class Log(_HitLog):
+        def __init__(self, duration, resource):
+            created.append(resource)
+            super().__init__(duration, resource)
+
+    counter = Counter(app, storage=Log)
+    for _ in range(5):
+        client.get("/")
+    counter.hits(next(iter(app.iter_resources(app.url_map.bind('')))))
+    # One for the application, and one for the resource
+    assert len(created) == 2
+
+
+def test_shared_memory_log_files(app, tmpdir):
+    import os
+    from findig.tools.counter import SharedMemoryHitLog
+
+    # There's no default file for unrelated apps to share
+    with pytest.raises(TypeError):
+        Counter(app, storage=SharedMemoryHitLog)
+
+    # Files that others could have planted or can write to are refused
+    tmpdir.join('elsewhere').write('')
+    os.symlink(str(tmpdir.join('elsewhere')), str(tmpdir.join('linked-*')))
+    storage = SharedMemoryHitLog.configure(path=str(tmpdir.join('linked')))
+    with pytest.raises(OSError):
+        Counter(app, storage=storage)
+
+    tmpdir.join('open-*').write('')
+    tmpdir.join('open-*').chmod(0o666)
+    storage = SharedMemoryHitLog.configure(path=str(tmpdir.join('open')))
+    with pytest.raises(PermissionError):
+        Counter(app, storage=storage)
+
+    storage = SharedMemoryHitLog.configure(path=str(tmpdir.join('hits')))
+    with pytest.raises(ValueError):
+        Counter(duration=0, storage=storage)
@@ -106,4 +106,136 @@ def test_sort_multi(people):
     sorted_set = people.sorted('age', 'name')
     assert not people.iterated
     assert isinstance(sorted_set, AbstractDataSet)
-    assert [r['id'] for r in sorted_set] == [3,7,1,8,5,2,6,4]
\ No newline at end of file
+    assert [r['id'] for r in sorted_set] == [3,7,1,8,5,2,6,4]
+def test_cached_fetch(people):
+    cached = CachedDataSet(people)
+    assert isinstance(cached, MutableDataSet)
+    assert cached.fetch_now(id=3)['name'] == "Terrance Riverdarb"
+    people.iterated = False
+    assert cached.fetch_now(id=3)['name'] == "Terrance Riverdarb"
+    assert not people.iterated
+    assert cached.cache_info()[:2] == (1, 1)
+
+def test_cached_views(people):
+    cached = CachedDataSet(people)
+    view = cached.filtered(age=32).sorted('name')
+    assert [r['id'] for r in view] == [8, 5]
+    people.iterated = False
+    assert [r['id'] for r in cached.filtered(age=32).sorted('name')] == [8, 5]
+    assert not people.iterated
+    assert [r['id'] for r in cached.limit(2)] == [1, 2]
+    assert people.iterated
+
+def test_cached_invalidated_on_add(people):
+    cached = CachedDataSet(people)
+    assert len(list(cached.filtered(age=32))) == 2
+    cached.add(dict(id=9, name="Jo Lee", age=32))
+    assert len(list(cached.filtered(age=32))) == 3
+
+def test_cached_bounds(people):
+    cached = CachedDataSet(people, ttl=None, maxsize=2)
+    for id in (1, 2, 3):
+        cached.fetch_now(id=id)
+    assert cached.cache_info().currsize == 2
+
+    expiring = CachedDataSet(people, ttl=-1)
+    expiring.fetch_now(id=1)
+    expiring.fetch_now(id=1)
+    assert expiring.cache_info().hits == 0
+
+def test_cached_read_only():
+    class ReadOnlySet(AbstractDataSet):
+        def __iter__(self):
+            yield MockRecord(dict(id=1))
+    cached = CachedDataSet(ReadOnlySet())
+    assert not isinstance(cached, MutableDataSet)
+    assert [dict(r) for r in cached] == [{'id': 1}]
+
+def test_cached_records_not_shared(people):
+    class EditableRecord(MutableRecord):
+        def __init__(self, d):
+            self.d = d
+
+        def read(self):
+            return self.d
+
+        def patch(self, add_data, remove_fields):
+            self.d.update(add_data)
+            self.invalidate()
+
+        def delete(self):
+            self.d.clear()
+
+    class EditableSet(MockDataSet):
+        def __iter__(self):
+            yield from (EditableRecord(d) for d in self.data)
+
+    editable = EditableSet()
+    editable.data = people.data
+    cached = CachedDataSet(editable)
+
+    # Each fetch gets its own record, which edits a backend record of
+    # its own.
+    first, second = cached.fetch_now(id=2), cached.fetch_now(id=2)
+    assert first is not second
+    assert cached.cache_info().hits == 1
+    first.patch(dict(age=35), ())
+    second.patch(dict(age=36), ())
+    assert first.record is not second.record
+    assert [r['age'] for r in cached.filtered(id=2)] == [36]
+    assert next(iter(cached)) is not next(iter(cached))
+
+def test_count(people):
+    assert people.count() == 8
+    assert people.filtered(age=32).count() == 2
+    assert people.sorted('name').count() == 8
+    assert people.limit(3, offset=6).count() == 2
+    assert people.limit(3, offset=10).count() == 0
+    assert people.exists()
+    assert not people.filtered(age=40).exists()
+
+def test_cached_count(people):
+    cached = CachedDataSet(people)
+    assert cached.count() == 8
+    people.iterated = False
+    assert cached.count() == 8
+    assert not people.iterated
+
+def test_compact_record():
+    schema = RecordSchema(['id', 'name'])
+    record = schema.record(dict(id=1, age=25))
+    assert not hasattr(record, '__dict__')
+    assert dict(record) == dict(id=1, age=25)
+    assert len(record) == 2
+    assert 'name' not in record
+    assert schema.fields == ('id', 'name', 'age')
+    assert FilteredDataSet.check_match(record, dict(age=lambda a: a > 20))
+
+    other = schema.record(dict(name="Jen"))
+    assert dict(other) == dict(name="Jen")
+    assert len(other.values) == 2
+
+def test_filter_expressions(people):
+    def ids(*exprs, **spec):
+        return [r['id'] for r in people.filtered(*exprs, **spec)]
+
+    assert ids(F('age') < 21) == [3]
+    assert ids(F('age') >= 52) == [4, 6]
+    assert ids(F('age') != 32, F('age') <= 25) == [1, 3, 7]
+    assert ids(F('id').in_([2, 4, 9])) == [2, 4]
+    assert ids(F('name').startswith("T")) == [1, 3]
+    assert ids((F('age') < 20) | (F('age') > 70)) == [3, 4]
+    assert ids(~(F('age') > 30) & F('name').startswith("T")) == [1, 3]
+    assert ids(F('age') < 30, age=lambda a: a % 2) == [1, 7]
+
+    # Missing or incomparable fields don't match
+    assert ids(F('height') > 0) == []
+    assert ids(F('name') > 0) == []
+    assert ids(F('height') == None) == list(range(1, 9))
+
+def test_cached_filter_expressions(people):
+    cached = CachedDataSet(people)
+    assert len(list(cached.filtered(F('age') > 40))) == 2
+    people.iterated = False
+    assert len(list(cached.filtered(F('age') > 40))) == 2
+    assert not people.iterated
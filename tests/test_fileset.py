@@ -0,0 +1,93 @@
+#-*- coding: utf-8 -*-
+import pytest
+from findig.tools.fileset import FileSet, _logs
+
+
+@pytest.fixture
+def path(tmpdir):
+    path = str(tmpdir.join("people.log"))
+    yield path
+    _logs.clear()
+
+@pytest.fixture
+def people(path):
+    fs = FileSet(path)
+    fs.add(dict(id=1, name="Te-jé Rodgers", age=25))
+    fs.add(dict(id=2, name="John Smith", age=34))
+    fs.add(dict(id=3, name="Terrance Riverdarb", age=16))
+    fs.add(dict(id=4, name="Anna Harris", age=74))
+    fs.add(dict(name="Jen Brathwaithe", age=32))
+    return fs
+
+def reopen(path):
+    # Forget the open log, as if the process had been restarted.
+    _logs.clear()
+    return FileSet(path)
+
+def test_read(people):
+    assert [r['id'] for r in people] == [1, 2, 3, 4, 5]
+    assert people.fetch_now(id=5)['name'] == "Jen Brathwaithe"
+    assert people.fetch_now(name="John Smith")['id'] == 2
+    assert people.count() == 5
+    with pytest.raises(LookupError):
+        people.fetch_now(id=6)
+
+def test_edit(people):
+    people.fetch_now(id=2).patch(dict(state="CO"), ('age',))
+    people.fetch_now(id=3).delete()
+    assert dict(people.fetch_now(id=2)) == dict(id=2, name="John Smith", state="CO")
+    assert [r['id'] for r in people] == [1, 2, 4, 5]
+
+def test_patch_deleted(people):
+    record = people.fetch_now(id=3)
+    record.delete()
+    with pytest.raises(LookupError) as excinfo:
+        record.patch(dict(state="CO"), ())
+    assert not isinstance(excinfo.value, KeyError)
+
+def test_shared_log(path, people):
+    FileSet(path).add(dict(id=6, name="Glen Posner", age=52))
+    assert people.count() == 6
+
+def test_reopen(path, people):
+    people.fetch_now(id=1).update(age=26)
+    people.fetch_now(id=4).delete()
+    people.save_index()
+    people.add(dict(id=6, name="Glen Posner", age=52))
+
+    people = reopen(path)
+    assert [r['id'] for r in people] == [1, 2, 3, 5, 6]
+    assert people.fetch_now(id=1)['age'] == 26
+    assert people.add(dict(name="Harriet Peters")) == {'id': 7}
+
+def test_recover_torn_write(path, people):
+    with open(path, 'ab') as fh:
+        fh.write(b'\x01\x00\x00\x00\xff\x00\x00\x00\x00garbage')
+
+    people = reopen(path)
+    assert people.count() == 5
+    people.add(dict(id=6, name="Glen Posner", age=52))
+    assert reopen(path).fetch_now(id=6)['name'] == "Glen Posner"
+
+def test_compact(path, people):
+    import os
+    for age in range(100):
+        people.fetch_now(id=1).update(age=age)
+    people.fetch_now(id=2).delete()
+
+    size = os.path.getsize(path)
+    people.compact()
+    assert os.path.getsize(path) < size
+    assert people.fetch_now(id=1)['age'] == 99
+    assert [r['id'] for r in reopen(path)] == [1, 3, 4, 5]
+
+def test_clear(path, people):
+    people.clear()
+    assert list(people) == []
+    assert list(reopen(path)) == []
+
+def test_compact_records(path, people):
+    from findig.tools.dataset import CompactRecord
+    records = list(FileSet(path, compact=True))
+    assert all(isinstance(r, CompactRecord) for r in records)
+    assert [dict(r) for r in records] == [dict(r) for r in people]
@@ -0,0 +1,145 @@
+import pytest
+
+from findig.json import App
+from findig.tools import ratelimit as ratelimit_module
+from findig.tools.ratelimit import (RateLimiter, MemoryRateStore,
+                                    SharedMemoryRateStore, gcra)
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit_module, 'time', lambda: now[0])
+    return now
+
+@pytest.fixture
+def app():
+    app = App()
+
+    @app.route("/")
+    def index():
+        return {}
+
+    @app.route("/search")
+    def search():
+        return {}
+
+    app.search = search
+    return app
+
+@pytest.fixture
+def client(app):
+    return Client(app, BaseResponse)
+
+
+def test_gcra():
+    tat, wait = gcra(None, 100.0, 2, 10)
+    assert (tat, wait) == (105.0, 0)
+    tat, wait = gcra(tat, 100.0, 2, 10)
+    assert (tat, wait) == (110.0, 0)
+    assert gcra(tat, 100.0, 2, 10) == (None, 5.0)
+    assert gcra(tat, 105.0, 2, 10) == (115.0, 0)
+    # A limit that hasn't been used in a while allows a full burst
+    assert gcra(tat, 500.0, 2, 10) == (505.0, 0)
+
+
+def test_limit_app(app, client, now):
+    limiter = RateLimiter(app)
+    limiter.limit(3, per=60)
+
+    statuses = [client.get("/").status_code for _ in range(4)]
+    assert statuses == [200, 200, 200, 429]
+
+    response = client.get("/search")
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '20'
+
+    now[0] += 20
+    assert client.get("/").status_code == 200
+    assert client.get("/").status_code == 429
+
+
+def test_limit_partitions(app, client, now):
+    limiter = RateLimiter(app)
+    limiter.partition('ip', lambda request: request.args.get('ip'))
+    limiter.limit(2, per=10, ip=limiter.any)
+    limiter.limit(1, per=10, ip='10.0.0.9')
+
+    assert client.get("/?ip=10.0.0.1").status_code == 200
+    assert client.get("/?ip=10.0.0.1").status_code == 200
+    assert client.get("/?ip=10.0.0.1").status_code == 429
+    assert client.get("/?ip=10.0.0.2").status_code == 200
+    assert client.get("/?ip=10.0.0.9").status_code == 200
+    assert client.get("/?ip=10.0.0.9").status_code == 429
+
+    with pytest.raises(TypeError):
+        limiter.limit(1, per=10, method='GET')
+
+
+@pytest.mark.parametrize('storage', ['memory', 'shared'])
+def test_limit_resource(app, client, now, storage, tmpdir):
+    if storage == 'memory':
+        storage = MemoryRateStore()
+    else:
+        storage = SharedMemoryRateStore(str(tmpdir.join('limits')))
+    limiter = RateLimiter(app, storage=storage)
+    limiter.limit(2, per=1, resource=app.search)
+
+    assert [client.get("/search").status_code for _ in range(3)] == \
+           [200, 200, 429]
+    assert client.get("/").status_code == 200
+
+    now[0] += 0.5
+    assert client.get("/search").status_code == 200
+    assert client.get("/search").status_code == 429
+
+
+def test_shared_memory_store(now, tmpdir):
+    import os
+
+    path = str(tmpdir.join('limits'))
+    store = SharedMemoryRateStore(path, slots=4)
+
+    # Requests allowed by a forked worker count against the limit
+    pid = os.fork()
+    if pid == 0:
+        try:
+            SharedMemoryRateStore(path, slots=4).acquire('a', 3, 60)
+            SharedMemoryRateStore(path, slots=4).acquire('a', 3, 60)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    assert store.acquire('a', 3, 60) == 0
+    assert store.acquire('a', 3, 60) == 20
+
+    # Once the table is full, requests to new keys aren't limited
+    for key in 'bcd':
+        assert store.acquire(key, 1, 60) == 0
+    assert store.acquire('b', 1, 60) == 60
+    assert store.acquire('e', 1, 60) == 0
+    assert store.acquire('e', 1, 60) == 0
+
+    # Until the limits in the table allow full bursts again
+    now[0] += 60
+    assert store.acquire('e', 1, 60) == 0
+    assert store.acquire('e', 1, 60) == 60
+
+    with pytest.raises(ValueError):
+        SharedMemoryRateStore(path, slots=8)
+
+
+def test_shared_memory_store_file(tmpdir):
+    import os
+
+    # Files that others could have planted or can write to are refused
+    tmpdir.join('elsewhere').write('')
+    os.symlink(str(tmpdir.join('elsewhere')), str(tmpdir.join('linked')))
+    with pytest.raises(OSError):
+        SharedMemoryRateStore(str(tmpdir.join('linked')))
+
+    tmpdir.join('open').write('')
+    tmpdir.join('open').chmod(0o646)
+    with pytest.raises(PermissionError):
+        SharedMemoryRateStore(str(tmpdir.join('open')))
@@ -1,6 +1,7 @@
 #-*- coding: utf-8 -*-
 from findig.extras.redis import *
-from findig.extras.redis import IndexToken
+from findig.extras.redis import IndexToken, RedisObj
+from findig.tools.dataset import CachedDataSet, MutableRecord
 from fakeredis import FakeStrictRedis
 import pytest
 
@@ -29,6 +30,13 @@ def test_index_token_hash():
     tok1 = IndexToken(dict(id=1, name="Jen"))
     tok2 = IndexToken(dict(id=1, name="Jen"))
     assert tok1 == tok2
+    assert hash(tok1) == hash(tok2)
+
+def test_index_token_value_is_stable():
+    # Index entries mustn't depend on the process that wrote them
+    token = IndexToken(dict(name="Jen", id=1))
+    assert token.value == b"id='1'\x1fname='Jen'"
+    assert token.entry("1") == b"id='1'\x1fname='Jen'\x001"
 
 def test_type_preserved(rs):
     person = rs.fetch(id=4)
@@ -60,4 +68,440 @@ def test_clear(redis, rs):
     assert list(rs) == []
     assert redis.zcard(rs.colkey) == 0
     assert redis.zcard(rs.indkey) == 0
-    assert not redis.get(rs.incrkey)
\ No newline at end of file
+    assert not redis.get(rs.incrkey)
+
+def test_iter_preloads_data(rs):
+    rs.batch_size = 3
+    records = list(rs)
+    assert len(records) == 10
+    assert all('cached_data' in r.__dict__ for r in records)
+    assert dict(records[3]) == dict(id=4, name="Anna Harris", age=74)
+
+def test_filtered(rs):
+    assert {r['id'] for r in rs.filtered(age=32)} == {5, 8}
+    assert {r['id'] for r in rs.filtered(age=lambda a: a > 50)} == {4, 6}
+    assert {r['id'] for r in rs.filtered(id=3)} == {3}
+    assert list(rs.filtered(age=32, name="Nobody")) == []
+
+def test_filtered_batches(rs):
+    rs.batch_size = 2
+    assert {r['id'] for r in rs.filtered(age=32)} == {5, 8}
+
+def test_cached_record_edits(rs):
+    cached = CachedDataSet(rs)
+    cached.fetch_now(id=10).update(name="Cartman")
+    assert cached.fetch_now(id=10)['name'] == "Cartman"
+    assert rs.fetch_now(id=10)['name'] == "Cartman"
+    cached.fetch_now(id=10).delete()
+    with pytest.raises(LookupError):
+        cached.fetch_now(id=10)
+
+def test_cached_view_record_edits(rs):
+    cached = CachedDataSet(rs)
+    view = cached.sorted('age').limit(2)
+    assert [r['id'] for r in view] == [3, 10]
+
+    youngest = next(iter(view))
+    assert isinstance(youngest, MutableRecord)
+    youngest.update(age=99)
+    assert rs.fetch_now(id=3)['age'] == 99
+    # The edit invalidated the cache shared by all of the views
+    assert [r['id'] for r in cached.sorted('age').limit(2)] == [10, 7]
+
+    next(iter(cached.limit(1))).delete()
+    assert cached.count() == 9
+
+def test_count(rs):
+    assert rs.count() == 10
+    assert rs.filtered(id=3).count() == 1
+    assert rs.filtered(id=30).count() == 0
+    assert rs.filtered(age=32).count() == 2
+    assert rs.exists()
+    assert not rs.filtered(age=40).exists()
+
+def test_async_redis_set(rs):
+    from findig.tools.asyncdataset import run_sync
+    import asyncio
+
+    async_rs = AsyncRedisSet(rs.colkey, client=rs.r, batch_size=4)
+
+    async def query():
+        return await asyncio.gather(
+            async_rs.count(),
+            async_rs.filtered(age=32).count(),
+            async_rs.fetch_now(id=9),
+        )
+
+    total, aged_32, person = run_sync(query())
+    assert (total, aged_32) == (10, 2)
+    assert person['name'] == "שלום привет hello"
+
+def test_compact(rs):
+    from findig.tools.dataset import CompactRecord
+    compact = RedisSet(rs.colkey, client=rs.r, compact=True)
+    records = list(compact.filtered(age=32))
+    assert all(isinstance(r, CompactRecord) for r in records)
+    assert records[0].schema is records[1].schema
+    assert [dict(r) for r in records] == [dict(r) for r in rs.filtered(age=32)]
+
+def test_filter_expressions(rs, monkeypatch):
+    from findig.tools.dataset import F
+
+    decoded = []
+    decode = RedisObj.decode
+    def counting_decode(data, id=None, codec=None):
+        decoded.append(id)
+        return decode(data, id, codec)
+    monkeypatch.setattr(RedisObj, 'decode', staticmethod(counting_decode))
+
+    def ids(*exprs):
+        del decoded[:]
+        return {r['id'] for r in rs.filtered(*exprs)}
+
+    # Items that don't match never leave the server
+    assert ids(F('age') > 50) == {4, 6}
+    assert len(decoded) == 2
+    assert ids(F('name').in_(["John Smith", "Anna Harris"])) == {2, 4}
+    assert len(decoded) == 2
+
+    # Parts that can't be checked by the server are checked here, and
+    # the results are the same as for an in-memory set.
+    for expr in [F('name').startswith("T") & (F('age') < 20),
+                 ~(F('name').startswith("T") | (F('age') >= 32)),
+                 ~(F('id').in_([1, 2, 3]) & (F('age') != 25)),
+                 F('age').in_([16, 18]) | (F('name') == b"Jabba"),
+                 F('height') > 3]:
+        expected = {r['id'] for r in rs if expr(r)}
+        assert ids(expr) == expected
+
+    assert rs.filtered(F('age') >= 32).count() == 6
+    assert not rs.filtered(F('age') > 100).exists()
+
+@pytest.fixture
+def indexed(rs):
+    return RedisSet(rs.colkey, client=rs.r,
+                    candidate_keys=[('id',), ('name',)],
+                    numeric_indexes=['age'])
+
+def test_candidate_key_index(indexed):
+    indexed.rebuild_indexes()
+    lookups = indexed.r.zrangebylex(indexed.indkey, b"[name=", b"[name=\xff")
+    assert len(lookups) == 10
+
+    assert [r['id'] for r in indexed.filtered(name="John Smith")] == [2]
+    assert indexed.filtered(name="John Smith").count() == 1
+
+    # Edits move the item in the index
+    indexed.fetch_now(id=2).update(name="John Smyth")
+    assert list(indexed.filtered(name="John Smith")) == []
+    assert [r['id'] for r in indexed.filtered(name="John Smyth")] == [2]
+
+def test_rebuild_indexes(rs, indexed):
+    from findig.tools.dataset import F
+
+    # An index written by an older version (with hashed entries)
+    rs.r.delete(rs.indkey)
+    rs.r.zadd(rs.indkey, 0, b"\x12\x34\x56\x781")
+
+    assert indexed.rebuild_indexes() == 10
+    assert rs.r.zcard(rs.indkey) == 20
+    assert rs.r.zcard(rs.indkey + ":age") == 10
+    assert [r['id'] for r in indexed.filtered(id=3)] == [3]
+    assert {r['id'] for r in indexed.filtered(F('age') < 20)} == {3, 10}
+
+def test_numeric_index(indexed, monkeypatch):
+    from findig.tools.dataset import F
+
+    indexed.rebuild_indexes()
+    indexed.add(dict(id=11, name="Ageless"))
+    indexed.add(dict(id=12, name="Ancient", age=120.5))
+
+    loaded = []
+    pipeline = indexed.r.pipeline
+    def counting_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        hgetall = pipe.hgetall
+        def counting_hgetall(key):
+            loaded.append(key)
+            return hgetall(key)
+        pipe.hgetall = counting_hgetall
+        return pipe
+    monkeypatch.setattr(indexed.r, 'pipeline', counting_pipeline)
+
+    in_range = indexed.filtered(F('age') >= 30, F('age') < 50)
+    assert {r['id'] for r in in_range} == {2, 5, 8, 9}
+    assert len(loaded) == 4
+    assert in_range.count() == 4
+    assert indexed.filtered(F('age') > 74).count() == 1
+    assert indexed.filtered(F('age') == 32).count() == 2
+
+    ages = [r.get('age') for r in indexed.sorted('age')]
+    assert ages == [16, 18, 21, 25, 32, 32, 34, 49, 52, 74, 120.5, None]
+    ages = [r.get('age') for r in indexed.sorted('age', descending=True)]
+    assert ages == [None, 120.5, 74, 52, 49, 34, 32, 32, 25, 21, 18, 16]
+
+    young = indexed.filtered(F('age') < 25).sorted('age', descending=True)
+    assert [r['id'] for r in young] == [7, 10, 3]
+    assert [r['id'] for r in indexed.sorted('age').limit(2)] == [3, 10]
+
+def test_none_filter_with_index(redis):
+    from findig.tools.dataset import F
+
+    tasks = RedisSet('tasks', client=redis,
+                     candidate_keys=[('id',), ('assignee',)])
+    tasks.add(dict(id=1, assignee="jen"))
+    tasks.add(dict(id=2))
+
+    # Items that lack a field aren't indexed, but do match None
+    unassigned = tasks.filtered(F('assignee') == None)
+    assert [r['id'] for r in unassigned] == [2]
+    assert unassigned.count() == 1
+    unassigned.clear()
+    assert [r['id'] for r in tasks] == [1]
+    tasks.clear()
+
+def test_callable_filter_with_index(redis):
+    people = RedisSet('people', client=redis,
+                      candidate_keys=[('id',), ('name',)])
+    for i in range(1, 5):
+        people.add(dict(id=i, name="Person {}".format(i)))
+
+    # Predicates can't be looked up in an index
+    evens = people.filtered(id=lambda id: id % 2 == 0)
+    assert [r['id'] for r in evens] == [2, 4]
+    assert evens.count() == 2
+    assert people.fetch_now(name=lambda name: name.endswith("3"))['id'] == 3
+    people.clear()
+
+@pytest.mark.parametrize('codec', ['json', 'pickle'])
+def test_codecs(rs, codec):
+    from findig.tools.dataset import F
+
+    people = RedisSet(rs.colkey, client=rs.r, codec=codec,
+                      candidate_keys=[('id',), ('name',)])
+    people.r.delete(rs.indkey)
+    # bytes can't be stored as JSON
+    if codec == 'json':
+        rs.fetch_now(id=10).delete()
+    before = {r['id']: dict(r) for r in rs}
+
+    assert people.migrate_codec('repr') == len(before)
+    after = {r['id']: dict(r) for r in people}
+    assert after == before
+
+    if codec == 'pickle':
+        assert rs.r.type(people.itemkey.format(id=3)) == b'string'
+
+    assert {r['id'] for r in people.filtered(F('age') > 50)} == {4, 6}
+    assert [r['id'] for r in people.filtered(name="Anna Harris")] == [4]
+
+    people.fetch_now(id=4).patch(dict(age=75), ('name',))
+    assert people.fetch_now(id=4) == dict(id=4, age=75)
+    record = people.fetch_now(id=4)
+    with record.edit_block():
+        record['name'] = "Anna Harris"
+        del record['age']
+    assert people.fetch_now(id=4) == dict(id=4, name="Anna Harris")
+    people.add(dict(id=20, name="New", age=1, tags=["a", "b"]))
+    assert people.fetch_now(id=20)['tags'] == ["a", "b"]
+    assert [r['id'] for r in people.filtered(name="New")] == [20]
+    people.clear()
+
+@pytest.mark.parametrize('codec', ['repr', 'pickle'])
+def test_atomic_writes(redis, monkeypatch, codec):
+    from findig.tools.dataset import F
+
+    people = RedisSet('people', client=redis, codec=codec,
+                      candidate_keys=[('id',), ('name',)],
+                      numeric_indexes=['age'])
+    # Make sure that the server has loaded the scripts
+    warmup = people.fetch_now(id=people.add(dict(name="Warm-up"))['id'])
+    warmup.patch(dict(age=1), ())
+    warmup.delete()
+
+    commands = []
+    execute_command = redis.execute_command
+    def counting_execute_command(*args, **kwargs):
+        commands.append(args[0])
+        return execute_command(*args, **kwargs)
+    monkeypatch.setattr(redis, 'execute_command', counting_execute_command)
+
+    assert people.add(dict(name="Jen", age=30)) == {'id': '2'}
+    record = people.fetch_now(id=2)
+    record.patch(dict(name="Jenny", age=31), ())
+    assert record == dict(id=2, name="Jenny", age=31)
+    with record.edit_block():
+        record['age'] = 32
+        del record['name']
+        record['name'] = "Jen"
+    assert people.fetch_now(id=2) == dict(id=2, name="Jen", age=32)
+
+    if codec == 'repr':
+        # One round trip for each write (and one for each fetch)
+        assert commands == ['EVALSHA', 'EXISTS', 'EVALSHA', 'EVALSHA',
+                            'EXISTS', 'HGETALL']
+
+    assert [r['id'] for r in people.filtered(name="Jen")] == [2]
+    assert list(people.filtered(name="Jenny")) == []
+    assert people.filtered(F('age') > 31).count() == 1
+    assert people.filtered(id=2).count() == 1
+
+    people.fetch_now(id=2).delete()
+    assert redis.zcard(people.colkey) == 0
+    assert redis.zcard(people.indkey) == 0
+    assert redis.zcard(people.indkey + ":age") == 0
+
+def test_clear_uses_script(redis):
+    people = RedisSet('people', client=redis, batch_size=3,
+                      candidate_keys=[('id',), ('name',)],
+                      numeric_indexes=['age'])
+    for i in range(10):
+        people.add(dict(name="Person {}".format(i), age=i))
+
+    people.clear()
+    assert redis.keys('people*') == []
+
+@pytest.mark.parametrize('codec', ['repr', 'pickle'])
+def test_clear_filtered(redis, monkeypatch, codec):
+    from findig.tools.dataset import F
+
+    people = RedisSet('people', client=redis, batch_size=3, codec=codec,
+                      candidate_keys=[('id',), ('name',)],
+                      numeric_indexes=['age'])
+    for i in range(12):
+        people.add(dict(name="Person {}".format(i), age=i, even=i % 2 == 0))
+
+    decoded = []
+    decode = RedisObj.decode
+    def counting_decode(data, id=None, codec=None):
+        decoded.append(id)
+        return decode(data, id, codec)
+    monkeypatch.setattr(RedisObj, 'decode', staticmethod(counting_decode))
+
+    people.filtered(name="Person 1").clear()
+    people.filtered(F('age') >= 9).clear()
+    people.filtered(even=True).clear()
+    people.filtered(id=6).clear()
+    if codec == 'repr':
+        # The items were never read
+        assert decoded == []
+    people.filtered(F('name').startswith("Person 3")).clear()
+
+    assert [r['age'] for r in people] == [7]
+    assert people.filtered(name="Person 1").count() == 0
+    assert people.filtered(F('age') > 0).count() == 1
+    assert redis.zcard(people.indkey) == 2
+    assert redis.zcard(people.indkey + ":age") == 1
+
+def test_redis_pool(redis):
+    from findig import App
+
+    app = App()
+    pool = RedisPool(app=app, client=redis)
+
+    with app.test_context(create_route=True):
+        assert RedisSet('pooled').r is pool.client is redis
+        assert RedisObj('pooled:item').r is redis
+
+    # Outside of a request, a client is shared by the process
+    assert RedisSet('pooled').r is RedisSet('other').r
+    assert RedisSet('pooled').r is not redis
+
+def test_redis_pool_health_check(redis, monkeypatch):
+    from redis.exceptions import ConnectionError
+
+    pool = RedisPool(client=redis, health_check_interval=60)
+    disconnects = []
+    monkeypatch.setattr(redis.connection_pool, 'disconnect',
+                        lambda: disconnects.append(True))
+    assert pool.check_health(force=True)
+
+    def ping():
+        raise ConnectionError
+    monkeypatch.setattr(redis, 'ping', ping)
+
+    # Not due for another check yet
+    assert pool.check_health()
+    assert not pool.check_health(force=True)
+    assert disconnects == [True]
+
+def test_redis_hit_log(redis):
+    from datetime import timedelta
+    from findig.json import App
+    from findig.tools.counter import Counter
+    from werkzeug.test import Client
+
+    # Two apps stand in for two worker processes
+    counters = []
+    clients = []
+    for _ in range(2):
+        app = App()
+        @app.route("/a")
+        def a():
+            return {}
+        @app.route("/b")
+        def b():
+            return {}
+
+        storage = RedisHitLog.configure(client=redis, resolution=10)
+        counter = Counter(app, duration=timedelta(hours=1), storage=storage)
+        counter.partition('method', lambda request: request.method)
+        counter.partition('x', lambda request: request.args.get('x'))
+        counters.append(counter)
+        clients.append(Client(app))
+
+    fired = []
+    # The fifth hit is served by the first app
+    counters[0].at(5, lambda: fired.append(True))
+
+    for i in range(6):
+        clients[i % 2].get("/a?x={}".format(i % 3))
+    clients[0].get("/b")
+
+    for counter in counters:
+        assert counter.hits().count() == 7
+        assert counter.hits().count(x='0') == 2
+        assert counter.hits().count(method='GET', x='1') == 2
+        assert counter.hits().count(method='POST') == 0
+    assert fired == [True]
+
+    a = next(r for r in counters[1].logs if r.endswith('a'))
+    hits = list(counters[1].logs[a])
+    assert len(hits) == 6
+    assert sorted(h.partitions['x'] for h in hits) == \
+           ['0', '0', '1', '1', '2', '2']
+    assert all(h.partitions['method'] == 'GET' for h in hits)
+
+    assert counters[1].hits().distinct('x') == 4
+    assert counters[1].logs[a].distinct('x') == 3
+    assert counters[1].logs[a].distinct('method') == 1
+    assert counters[1].logs[a].distinct_sketch('x').count() == 3
+    assert counters[0].hits().top('method', 1) == [('GET', 7)]
+    assert [n for _, n in counters[0].hits().top('x', 5)] == [2, 2, 2, 1]
+
+    # Buckets expire once they're outside of the counter's duration
+    assert 3600 < max(redis.ttl(k) for k in redis.keys('findig:hits:*')) \
+           <= 3610
+
+
+def test_redis_rate_store(redis, monkeypatch):
+    from findig.extras import redis as redis_module
+
+    now = [1000.0]
+    monkeypatch.setattr(redis_module, 'time', lambda: now[0])
+
+    # Two stores stand in for two worker processes
+    stores = [RedisRateStore(client=redis) for _ in range(2)]
+    assert stores[0].acquire('a', 3, 60) == 0
+    assert stores[1].acquire('a', 3, 60) == 0
+    assert stores[0].acquire('a', 3, 60) == 0
+    assert stores[1].acquire('a', 3, 60) == 20
+    assert stores[1].acquire('b', 3, 60) == 0
+
+    # The limit's state expires once it allows a full burst again
+    assert 50000 < redis.pttl('findig:ratelimit:a') <= 60000
+
+    # A request is allowed every 20 seconds after the burst
+    now[0] += 30
+    assert stores[0].acquire('a', 3, 60) == 0
+    assert stores[1].acquire('a', 3, 60) == 10
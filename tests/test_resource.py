@@ -47,3 +47,30 @@ def test_name_bindings_error_on_different_resource(num:int, app):
     with app.test_context(path="/index/bar/{}".format(num)):
         with pytest.raises(AttributeError):
             assert item.num == num
+
+def test_collection_count_header():
+    from findig.json import App
+    from findig.tools.dataset import AbstractDataSet
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    class Numbers(AbstractDataSet):
+        def __iter__(self):
+            yield from ()
+
+        def count(self):
+            return 42
+
+    app = App()
+
+    @app.route("/numbers/<int:id>")
+    def number(id):
+        return {}
+
+    @app.route("/numbers")
+    @number.collection(lazy=True, include_count=True)
+    def numbers():
+        return Numbers()
+
+    response = Client(app, BaseResponse).get("/numbers")
+    assert response.headers['X-Total-Count'] == '42'
@@ -0,0 +1,280 @@
+from sqlalchemy import create_engine
+from sqlalchemy.schema import Column
+from sqlalchemy.types import Integer, String
+import pytest
+
+from findig import App
+from findig.json import App as JSONApp
+from findig.extras.sql import SQLA, SQLASet
+
+
+@pytest.fixture
+def app():
+    return App()
+
+@pytest.fixture
+def db(app, tmpdir):
+    # The async tests use the connection from a worker thread
+    engine = create_engine("sqlite:///{}".format(tmpdir.join("test.db")),
+                           connect_args={'check_same_thread': False})
+    return SQLA(engine, app=app)
+
+@pytest.fixture
+def Person(db):
+    class Person(db.Base):
+        id = Column(Integer, primary_key=True)
+        name = Column(String(150), nullable=False)
+        age = Column(Integer)
+
+    return Person
+
+@pytest.fixture
+def people(app, Person):
+    with app.test_context(create_route=True):
+        people = SQLASet(Person)
+        people.add(dict(id=1, name="Te-jé Rodgers", age=25))
+        people.add(dict(id=2, name="John Smith", age=34))
+        people.add(dict(id=3, name="Terrance Riverdarb", age=16))
+        people.add(dict(id=4, name="Anna Harris", age=74))
+        people.add(dict(id=5, name="Jen Brathwaithe", age=32))
+        people.add(dict(id=6, name="Glen Posner", age=52))
+        people.add(dict(id=7, name="Harriet Peters", age=21))
+        people.add(dict(id=8, name="Anthony Simm", age=32))
+    return people
+
+def test_iter(app, people):
+    with app.test_context():
+        assert [r['id'] for r in people] == list(range(1, 9))
+        assert [r['id'] for r in people.filtered(age=32)] == [5, 8]
+        assert [r['id'] for r in people.sorted('age').limit(3)] == [3, 7, 1]
+
+def test_count(app, people, Person):
+    with app.test_context():
+        assert people.count() == 8
+        assert people.filtered(age=32).count() == 2
+        assert people.filtered(Person.age > 40).count() == 2
+        assert people.limit(3, offset=6).count() == 2
+        assert people.exists()
+        assert not people.filtered(age=40).exists()
+
+def test_async(app, people, Person):
+    from findig.extras.sql import AsyncSQLASet
+    from findig.tools.asyncdataset import run_sync
+
+    async def query(people):
+        ids = [r['id'] async for r in people.filtered(Person.age > 40)]
+        record = await people.fetch_now(id=2)
+        await record.patch(dict(age=35), ())
+        return ids, await people.count(), dict(record)
+
+    with app.test_context():
+        ids, count, record = run_sync(query(AsyncSQLASet(Person)))
+        assert ids == [4, 6]
+        assert count == 8
+        assert record['age'] == 35
+
+def test_async_gather(app, people, Person):
+    from findig.extras.sql import AsyncSQLASet
+    from findig.tools.asyncdataset import run_sync
+    import asyncio
+
+    async def bump(people):
+        async for record in people:
+            await record.patch(dict(age=record['age'] + 1), ())
+        return await people.count()
+
+    async def bump_all(sets):
+        return await asyncio.gather(*map(bump, sets))
+
+    with app.test_context():
+        sets = [AsyncSQLASet(Person).filtered(Person.id % 4 == i)
+                for i in range(4)]
+        # The data sets share the request's session, so they share the
+        # thread that it's used from.
+        assert len({s.executor for s in sets}) == 1
+        executor = sets[0].executor
+        counts = run_sync(bump_all(sets))
+        assert counts == [2, 2, 2, 2]
+        assert [r['age'] for r in SQLASet(Person)] == \
+               [26, 35, 17, 75, 33, 53, 22, 33]
+
+    # The thread is let go of with the request's sessions
+    assert executor._shutdown
+
+def test_compact(app, people, Person):
+    from findig.tools.dataset import CompactRecord
+
+    with app.test_context():
+        compact = SQLASet(Person, compact=True).filtered(age=32)
+        records = list(compact)
+        assert all(isinstance(r, CompactRecord) for r in records)
+        assert [dict(r) for r in records] == \
+               [dict(r) for r in people.filtered(age=32)]
+
+@pytest.mark.parametrize('batch_size', [None, 1, 3, 100])
+def test_batch_size(app, people, Person, batch_size):
+    with app.test_context():
+        people = SQLASet(Person, batch_size=batch_size)
+        assert [r['id'] for r in people] == list(range(1, 9))
+        assert [r['id'] for r in people.sorted('age').limit(3)] == [3, 7, 1]
+
+def test_patch_while_iterating(app, people, Person):
+    with app.test_context():
+        for record in SQLASet(Person):
+            record.update(age=record['age'] + 100)
+        assert [r['age'] for r in SQLASet(Person).filtered(id=3)] == [116]
+
+        for record in SQLASet(Person).filtered(Person.age > 150):
+            record.delete()
+        assert SQLASet(Person).count() == 6
+
+def test_lazy_session(app, db, Person):
+    from werkzeug.test import Client
+
+    created = []
+    session_cls = db._session_cls
+    def make_session(**kwargs):
+        session = session_cls(**kwargs)
+        created.append(session)
+        return session
+    db._session_cls = make_session
+
+    @app.route("/static")
+    def static():
+        return {}
+
+    @app.route("/count")
+    def count():
+        return {'count': SQLASet(Person).count()}
+
+    client = Client(app)
+    client.get("/static")
+    assert created == []
+
+    client.get("/count")
+    assert len(created) == 1
+
+
+@pytest.fixture
+def replicated(tmpdir):
+    # Each "database" is a separate SQLite file, so it's easy to tell
+    # which one a query went to.
+    engines = [create_engine("sqlite:///{}".format(tmpdir.join(name)))
+               for name in ("primary.db", "replica1.db", "replica2.db")]
+    app = JSONApp()
+    db = SQLA(engines[0], replicas=engines[1:], app=app)
+
+    class Item(db.Base):
+        id = Column(Integer, primary_key=True)
+        source = Column(String(20))
+
+    for engine, name in zip(engines, ("primary", "replica1", "replica2")):
+        db.Base.metadata.create_all(bind=engine)
+        engine.execute(Item.__table__.insert(), id=1, source=name)
+
+    return app, db, Item
+
+def test_replica_reads(replicated):
+    app, db, Item = replicated
+
+    sources = []
+    for method in ("GET", "GET", "HEAD"):
+        with app.test_context(create_route=True, method=method):
+            sources.append(SQLASet(Item).fetch_now(id=1)['source'])
+
+    assert sources == ["replica1", "replica2", "replica1"]
+
+def test_replica_routing_by_method(replicated):
+    from werkzeug.test import Client
+    from werkzeug.wrappers import BaseResponse
+
+    app, db, Item = replicated
+
+    @app.route("/items/<int:id>")
+    def item(id):
+        return SQLASet(Item).fetch_now(id=id)
+
+    @app.route("/items")
+    @item.collection(lazy=True)
+    def items():
+        return SQLASet(Item)
+
+    client = Client(app, BaseResponse)
+    me = {'REMOTE_ADDR': '10.0.0.1'}
+    assert b'"replica1"' in client.get("/items", environ_base=me).data
+
+    response = client.post("/items", data='{"id": 2, "source": "new"}',
+                           content_type="application/json",
+                           environ_base=me)
+    assert response.status_code == 201
+    with db.transaction(new_session=True) as session:
+        assert session.query(Item).get(2).source == "new"
+
+    # The client that just wrote reads its own write from the primary,
+    # but other clients still read from the replicas.
+    assert b'"new"' in client.get("/items/2", environ_base=me).data
+    other = client.get("/items", environ_base={'REMOTE_ADDR': '10.0.0.2'})
+    assert b'"new"' not in other.data
+
+def test_replica_least_busy(replicated):
+    app, db, Item = replicated
+    db._replica_policy = 'least-busy'
+
+    with app.test_context(create_route=True, 
+                          environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        first = SQLASet(Item).fetch_now(id=1)['source']
+        with app.test_context(create_route=True,
+                              environ_base={'REMOTE_ADDR': '10.0.0.2'}):
+            second = SQLASet(Item).fetch_now(id=1)['source']
+
+    assert first == "replica1"
+    assert second == "replica2"
+
+def test_replica_writes_are_sticky(replicated):
+    app, db, Item = replicated
+
+    def get(addr):
+        with app.test_context(create_route=True,
+                              environ_base={'REMOTE_ADDR': addr}):
+            return dict(SQLASet(Item).fetch_now(id=1))
+
+    with app.test_context(create_route=True,
+                          environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+        items = SQLASet(Item)
+        record = items.fetch_now(id=1)
+        assert record['source'] == "replica1"
+
+        # The write goes to the primary, and the rest of the request
+        # reads from it.
+        record.patch({'source': "written"}, ())
+        assert items.fetch_now(id=1)['source'] == "written"
+        assert record['source'] == "written"
+
+    # The client that wrote sticks to the primary, but other clients
+    # still read from the replicas.
+    assert get('10.0.0.1')['source'] == "written"
+    assert get('10.0.0.2')['source'] == "replica2"
+
+    db._sticky_until['10.0.0.1'] = 0
+    assert get('10.0.0.1')['source'] == "replica1"
+
+def test_filter_expressions(app, people, Person):
+    from findig.tools.dataset import F
+
+    with app.test_context():
+        people.add(dict(id=9, name="Nameless"))
+
+        def ids(*exprs):
+            return [r['id'] for r in people.filtered(*exprs)]
+
+        assert ids(F('age') > 50) == [4, 6]
+        assert ids(F('age').in_([16, 21]), F('name').startswith("T")) == [3]
+        assert ids((F('age') < 20) | (F('name') == "Nameless")) == [3, 9]
+        assert ids(F('age') == None) == [9]
+        # Missing values are handled the same as for other data sets
+        assert ids(~(F('age') > 30)) == [1, 3, 7, 9]
+        assert ids(F('age') != 32, F('id') > 5) == [6, 7, 9]
+        assert people.filtered(F('name').startswith("J")).count() == 2
+
+        with pytest.raises(SQLASet.InvalidField):
+            ids(F('height') > 3)